@@ -0,0 +1,64 @@
+"""
+Microbenchmark: T3 token sampling with the HF logits processor chain vs the fused sampler.
+
+    python benchmarks/bench_t3_sampler.py --device cuda --batch-sizes 1 2 8
+"""
+import argparse
+import time
+
+import torch
+from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from chatterbox.models.t3.inference.sampler import sample_tokens, update_token_counts
+
+
+VOCAB = 8194  # T3 speech vocab
+
+
+def hf_chain(logits, generated_ids, temperature, repetition_penalty, min_p, top_p):
+    logits = logits / temperature
+    logits = RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty)(generated_ids, logits)
+    logits = MinPLogitsWarper(min_p=min_p)(None, logits)
+    logits = TopPLogitsWarper(top_p=top_p)(None, logits)
+    probs = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+
+def bench(fn, device, n_iters):
+    for _ in range(10):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / n_iters * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 8])
+    parser.add_argument("--history", type=int, default=500, help="number of tokens generated so far")
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--top-p", type=float, default=0.95)
+    parser.add_argument("--min-p", type=float, default=0.05)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    params = dict(temperature=0.8, repetition_penalty=1.2, min_p=args.min_p, top_p=args.top_p)
+
+    print(f"{'batch':>5} {'HF chain (us)':>14} {'fused (us)':>11} {'speedup':>8}")
+    for B in args.batch_sizes:
+        logits = 3 * torch.randn(B, VOCAB, device=device)
+        generated_ids = torch.randint(0, VOCAB, (B, args.history), device=device)
+        token_counts = update_token_counts(torch.zeros(B, VOCAB, dtype=torch.int32, device=device), generated_ids)
+
+        t_hf = bench(lambda: hf_chain(logits, generated_ids, **params), device, args.iters)
+        t_fused = bench(lambda: sample_tokens(logits, token_counts, **params), device, args.iters)
+        print(f"{B:>5} {t_hf:>14.1f} {t_fused:>11.1f} {t_hf / t_fused:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
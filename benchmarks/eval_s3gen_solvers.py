@@ -0,0 +1,94 @@
+"""
+Quality / speed of S3Gen's flow matching ODE solvers and step counts (see `ConditionalCFM.solve`) against the
+default, 10 Euler steps.
+
+The speech tokens of every text are sampled once with T3, then vocoded with each (solver, steps) setting from the
+same noise (S3Gen's is fixed), and compared to the default on:
+- mel error: mean absolute difference of the log-mel spectrograms,
+- speaker similarity (`VoiceEncoder.voice_similarity`) of the audio to the default's audio and to the voice prompt,
+- S3Gen time (flow matching and HiFT), and its number of estimator calls.
+
+    python benchmarks/eval_s3gen_solvers.py --device cuda --voice prompt.wav --steps 3 4 5 6 8
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from chatterbox.benchmarking import EVAL_TEXTS, load_model, prompt_embed, speaker_embed
+from chatterbox.models.s3gen import CFM_SOLVERS
+from chatterbox.models.voice_encoder import VoiceEncoder
+from chatterbox.models.s3tokenizer import drop_invalid_tokens
+from chatterbox.tts import ChatterboxTTS
+
+
+def speech_tokens(model: ChatterboxTTS, text, seed, cfg_weight):
+    torch.manual_seed(seed)
+    tokens = model.t3.inference(
+        t3_cond=model.conds.t3,
+        text_tokens=model._tokenize(text),
+        max_new_tokens=1000,
+        cfg_weight=cfg_weight,
+    )
+    tokens = drop_invalid_tokens(tokens[0])
+    return tokens[tokens < 6561]
+
+
+def vocode(model: ChatterboxTTS, tokens, solver, steps, seed, device):
+    s3gen = model.s3gen
+    torch.manual_seed(seed)  # HiFT's sine source is random
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    mels = s3gen.flow_inference(tokens, ref_dict=model.conds.gen, finalize=True, n_timesteps=steps, solver=solver)
+    wav, _ = s3gen.hift_inference(mels)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    return mels[0].cpu(), wav[0].cpu().numpy(), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--voice", help="voice prompt (defaults to the built-in voice)")
+    parser.add_argument("--texts", nargs="+", default=EVAL_TEXTS)
+    parser.add_argument("--solvers", nargs="+", choices=list(CFM_SOLVERS), default=list(CFM_SOLVERS))
+    parser.add_argument("--steps", type=int, nargs="+", default=[2, 3, 4, 5, 6, 8, 10])
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    model = load_model(args.device, args.voice)
+    voice_embed = prompt_embed(model)
+
+    all_tokens = [speech_tokens(model, text, args.seed, args.cfg_weight) for text in args.texts]
+    vocode(model, all_tokens[0], "euler", 10, args.seed, device)  # warm up
+    references = [vocode(model, tokens, "euler", 10, args.seed, device) for tokens in all_tokens]
+    reference_embeds = [speaker_embed(model, wav) for _, wav, _ in references]
+
+    print(f"{'solver':>8} {'steps':>5} {'calls':>5} {'mel err':>7} {'sim/ref':>7} {'sim/prompt':>10} {'S3Gen (s)':>9}")
+    for solver in args.solvers:
+        for steps in args.steps:
+            rows = []
+            for tokens, (ref_mels, _, _), ref_embed in zip(all_tokens, references, reference_embeds):
+                mels, wav, elapsed = vocode(model, tokens, solver, steps, args.seed, device)
+                embed = speaker_embed(model, wav)
+                rows.append((
+                    (mels - ref_mels).abs().mean().item(),
+                    VoiceEncoder.voice_similarity(embed, ref_embed),
+                    VoiceEncoder.voice_similarity(embed, voice_embed),
+                    elapsed,
+                ))
+            mel_err, sim_ref, sim_prompt, elapsed = np.mean(rows, axis=0)
+            calls = steps * CFM_SOLVERS[solver]
+            print(
+                f"{solver:>8} {steps:>5} {calls:>5} {mel_err:>7.3f} {sim_ref:>7.3f} {sim_prompt:>10.3f} "
+                f"{elapsed:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Quality / speed of T3 early exit (running only the first layers, see `T3.layers_for_depth`) against full depth.
+
+For each depth, every text is synthesized with the same seed as the full-depth reference, and compared on:
+- token agreement: the fraction of the reference's speech tokens matched at the same position, and the length of
+  the identical prefix (the fused sampler draws the same noise at each step, so tokens only diverge once the
+  distributions do),
+- speaker similarity (`VoiceEncoder.voice_similarity`) of the audio to the full-depth audio and to the voice prompt,
+- T3 decoding time.
+
+    python benchmarks/eval_t3_depth.py --device cuda --voice prompt.wav --depths 1.0 0.9 0.8 0.7
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from chatterbox.benchmarking import EVAL_TEXTS, load_model, prompt_embed, speaker_embed
+from chatterbox.models.voice_encoder import VoiceEncoder
+from chatterbox.tts import ChatterboxTTS
+
+
+def synthesize(model: ChatterboxTTS, text, depth, seed, cfg_weight, device):
+    torch.manual_seed(seed)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    tokens = model.t3.inference(
+        t3_cond=model.conds.t3,
+        text_tokens=model._tokenize(text),
+        max_new_tokens=1000,
+        cfg_weight=cfg_weight,
+        layers=model.t3.layers_for_depth(depth),
+    )
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    wav = model._vocode(tokens, model.conds.gen)
+    return tokens[0].cpu(), wav[0].numpy(), elapsed
+
+
+def token_agreement(tokens, reference):
+    n = min(len(tokens), len(reference))
+    same = (tokens[:n] == reference[:n]).numpy()
+    prefix = n if same.all() else int(np.argmin(same))
+    return same.sum() / len(reference), prefix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--voice", help="voice prompt (defaults to the built-in voice)")
+    parser.add_argument("--texts", nargs="+", default=EVAL_TEXTS)
+    parser.add_argument("--depths", type=float, nargs="+", default=[0.9, 0.8, 0.7, 0.5])
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    model = load_model(args.device, args.voice)
+    voice_embed = prompt_embed(model)
+
+    references = [synthesize(model, text, 1.0, args.seed, args.cfg_weight, device) for text in args.texts]
+    reference_embeds = [speaker_embed(model, wav) for _, wav, _ in references]
+    n_layers = len(model.t3.tfmr.layers)
+
+    print(f"{'depth':>5} {'layers':>6} {'agree':>6} {'prefix':>6} {'sim/full':>8} {'sim/prompt':>10} {'T3 (s)':>7}")
+    for depth in [1.0] + args.depths:
+        layers = model.t3.layers_for_depth(depth)
+        rows = []
+        for text, (ref_tokens, _, _), ref_embed in zip(args.texts, references, reference_embeds):
+            tokens, wav, elapsed = synthesize(model, text, depth, args.seed, args.cfg_weight, device)
+            embed = speaker_embed(model, wav)
+            agree, prefix = token_agreement(tokens, ref_tokens)
+            rows.append((
+                agree,
+                prefix,
+                VoiceEncoder.voice_similarity(embed, ref_embed),
+                VoiceEncoder.voice_similarity(embed, voice_embed),
+                elapsed,
+            ))
+        agree, prefix, sim_full, sim_prompt, elapsed = np.mean(rows, axis=0)
+        n = n_layers if layers is None else len(layers)
+        print(f"{depth:>5.2f} {n:>6} {agree:>6.1%} {prefix:>6.0f} {sim_full:>8.3f} {sim_prompt:>10.3f} {elapsed:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,7 @@ __version__ = version("chatterbox-tts")
 
 from .tts import ChatterboxTTS
 from .vc import ChatterboxVC
+from .scheduler import TTSScheduler
 from .audio_editing import (
     splice_audios,
     trim_audio,
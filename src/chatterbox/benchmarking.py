@@ -0,0 +1,33 @@
+"""
+Shared pieces of the quality checks: `python -m chatterbox.quantize --check` and the `benchmarks/eval_*.py` scripts.
+"""
+import numpy as np
+
+from .models.s3gen import S3GEN_SR
+from .tts import ChatterboxTTS
+
+
+# texts every quality check runs on: a pangram, a long sentence full of names, and two short sentences
+EVAL_TEXTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "Please call Stella. Ask her to bring these things with her from the store.",
+]
+
+
+def load_model(device, voice=None) -> ChatterboxTTS:
+    "The pretrained model on `device`, with the voice prompt `voice` prepared if given (else the built-in voice)."
+    model = ChatterboxTTS.from_pretrained(device)
+    if voice:
+        model.prepare_conditionals(voice)
+    return model
+
+
+def prompt_embed(model: ChatterboxTTS) -> np.ndarray:
+    "The speaker embedding of the prepared voice prompt."
+    return model.conds.t3.speaker_emb[0].cpu().numpy()
+
+
+def speaker_embed(model: ChatterboxTTS, wav: np.ndarray) -> np.ndarray:
+    "The speaker embedding of a synthesized waveform, to compare with `VoiceEncoder.voice_similarity`."
+    return model.ve.embeds_from_wavs([wav], sample_rate=S3GEN_SR, as_spk=True)
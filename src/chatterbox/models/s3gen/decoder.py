@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -33,6 +36,18 @@ def mask_to_bias(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
     return mask
 
 
+@dataclass
+class DecoderContext:
+    """
+    The part of `ConditionalDecoder.forward`'s work that only depends on its inputs other than `x` and `t`, which
+    are the same at every ODE step of an utterance: built once by `ConditionalDecoder.prepare`.
+    """
+    # (batch_size, channels, time): mu, the speaker embedding broadcast over time and cond, packed after x's channels
+    cond_input: torch.Tensor
+    # mask and attention bias of each resolution, from the input's to the mid blocks'
+    masks: List[torch.Tensor]
+    attn_biases: List[torch.Tensor]
+
 
 class Transpose(torch.nn.Module):
     def __init__(self, dim0: int, dim1: int):
@@ -230,7 +245,28 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def prepare(self, mask, mu, spks=None, cond=None) -> DecoderContext:
+        """
+        Precomputes what `forward` needs from `mask`, `mu`, `spks` and `cond`, to be passed as its `context` at
+        every ODE step: the input's conditioning channels, and the mask and attention bias of each resolution.
+        """
+        packed = [mu]
+        if spks is not None:
+            packed.append(repeat(spks, "b c -> b c t", t=mu.shape[-1]))
+        if cond is not None:
+            packed.append(cond)
+        cond_input = pack(packed, "b * t")[0]
+
+        masks, attn_biases = [], []
+        for _ in self.down_blocks:
+            mask_i = mask[:, :, ::2 ** len(masks)]
+            # attn_mask = torch.matmul(mask_i.transpose(1, 2).contiguous(), mask_i)
+            attn_mask = add_optional_chunk_mask(mask_i.transpose(1, 2), mask_i.bool(), False, False, 0, self.static_chunk_size, -1)
+            masks.append(mask_i)
+            attn_biases.append(mask_to_bias(attn_mask == 1, mu.dtype))
+        return DecoderContext(cond_input=cond_input, masks=masks, attn_biases=attn_biases)
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, context: DecoderContext = None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,6 +275,8 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            context (DecoderContext, optional): `prepare(mask, mu, spks, cond)`, to reuse over the ODE steps.
+                Defaults to computing it.
 
         Raises:
             ValueError: _description_
@@ -248,26 +286,20 @@ class ConditionalDecoder(nn.Module):
             _type_: _description_
         """
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        if context is None:
+            context = self.prepare(mask, mu, spks, cond)
 
-        x = pack([x, mu], "b * t")[0]
+        t = self.time_embeddings(t).to(x.dtype)
+        t = self.time_mlp(t)
 
-        if spks is not None:
-            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
-            x = pack([x, spks], "b * t")[0]
-        if cond is not None:
-            x = pack([x, cond], "b * t")[0]
+        x = pack([x, context.cond_input], "b * t")[0]
 
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for (resnet, transformer_blocks, downsample), mask_down, attn_mask in zip(
+            self.down_blocks, context.masks, context.attn_biases
+        ):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -277,16 +309,11 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
+        mask_mid, attn_mask = context.masks[-1], context.attn_biases[-1]
 
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -295,15 +322,13 @@ class ConditionalDecoder(nn.Module):
                 )
             x = rearrange(x, "b t c -> b c t").contiguous()
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for (resnet, transformer_blocks, upsample), mask_up, attn_mask in zip(
+            self.up_blocks, context.masks[::-1], context.attn_biases[::-1]
+        ):
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -130,10 +130,13 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
-        if self.fp16 is True:
-            prompt_feat = prompt_feat.half()
-            embedding = embedding.half()
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None):
+        # the reference mel and x-vector are computed in fp32; the flow may run in reduced precision, see `S3Gen.cast`
+        dtype = self.spk_embed_affine_layer.weight.dtype
+        prompt_feat = prompt_feat.to(dtype)
+        embedding = embedding.to(dtype)
 
         assert token.shape[0] == 1
         # xvec projection
@@ -163,9 +166,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            flow_cache=flow_cache
+            flow_cache=flow_cache,
+            solver=solver,
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -230,9 +234,6 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         self.token_mel_ratio = token_mel_ratio
         self.pre_lookahead_len = pre_lookahead_len
 
-        # FIXME: this was missing - just putting it in as false
-        self.fp16 = False
-
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -242,41 +243,84 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
-        if self.fp16 is True:
-            prompt_feat = prompt_feat.half()
-            embedding = embedding.half()
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  noise_offset=0):
+        """
+        Mels of a batch of utterances, each with its own prompt; every input is right-padded to its longest row.
+
+        Args:
+            token (torch.Tensor): speech tokens, (batch_size, time) with `token_len` (batch_size,)
+            prompt_token (torch.Tensor): prompt speech tokens, (batch_size, time) with `prompt_token_len`
+            prompt_feat (torch.Tensor): prompt mels, (batch_size, frames, 80) with `prompt_feat_len`, or None if
+                all their frames are used
+            embedding (torch.Tensor): x-vectors, (batch_size, 192)
+            finalize (bool): whether the tokens end the utterances; if False, the mels of the last
+                `pre_lookahead_len` tokens of each row, which need the tokens after them, are left out.
+            noise_offset (int): number of mel frames of the utterances before `token`, when it is only a window of
+                them (see `S3GenStream`); the frames of `token` get the decoder noise they get in a single pass.
+
+        Returns:
+            (batch_size, 80, frames) mels, right-padded, and their (batch_size,) number of frames
+        """
+        # the reference mel and x-vector are computed in fp32; the flow may run in reduced precision, see `S3Gen.cast`
+        dtype = self.spk_embed_affine_layer.weight.dtype
+        prompt_feat = prompt_feat.to(dtype)
+        embedding = embedding.to(dtype)
+        device = token.device
+        n_rows = token.size(0)
 
-        assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        # concat text and prompt_text, row by row, as prompts differ in length
+        token_len1, token_len2 = prompt_token_len.view(-1).tolist(), token_len.view(-1).tolist()
+        token_lens = [len1 + len2 for len1, len2 in zip(token_len1, token_len2)]
+        tokens = token.new_zeros(n_rows, max(token_lens))
+        for i, (len1, len2) in enumerate(zip(token_len1, token_len2)):
+            tokens[i, :len1] = prompt_token[i, :len1]
+            tokens[i, len1:len1 + len2] = token[i, :len2]
+        token_len = torch.tensor(token_lens, device=device)
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+        token = self.input_embedding(torch.clamp(tokens, min=0)) * mask
 
         # text encode
         h, h_lengths = self.encoder(token, token_len)
+        h_lens = [n * self.token_mel_ratio for n in token_lens]
         if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+            h_lens = [n - self.pre_lookahead_len * self.token_mel_ratio for n in h_lens]
+        h = h[:, :max(h_lens)]
+        if prompt_feat_len is None:
+            mel_len1 = [prompt_feat.shape[1]] * n_rows
+        else:
+            mel_len1 = prompt_feat_len.view(-1).tolist()
+        mel_len2 = [n - len1 for n, len1 in zip(h_lens, mel_len1)]
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        conds = torch.zeros([n_rows, h.shape[1], self.output_size], device=device).to(h.dtype)
+        for i, len1 in enumerate(mel_len1):
+            conds[i, :len1] = prompt_feat[i, :len1]
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = (~make_pad_mask(torch.tensor(h_lens), h.shape[1])).to(h)
+        noise_positions = None
+        if noise_offset > 0:
+            positions = torch.arange(h.shape[1], device=device)[None]
+            noise_positions = positions + noise_offset * (positions >= torch.tensor(mel_len1, device=device)[:, None])
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=n_timesteps,
+            solver=solver,
+            noise_positions=noise_positions,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None  # NOTE jrm: why are they returning None here?
+        # drop the prompts' frames
+        feats = torch.zeros([n_rows, feat.shape[1], max(mel_len2)], device=device)
+        for i, (len1, len2) in enumerate(zip(mel_len1, mel_len2)):
+            feats[i, :, :len2] = feat[i, :, len1:len1 + len2]
+        return feats, torch.tensor(mel_len2, device=device)
@@ -16,6 +16,11 @@ import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from .decoder import ConditionalDecoder
+
+
+# ODE solvers of `ConditionalCFM.solve`, with their number of estimator calls per step
+CFM_SOLVERS = {"euler": 1, "midpoint": 2, "heun": 2, "ab2": 1}
 
 
 class ConditionalCFM(BASECFM):
@@ -35,7 +40,7 @@ class ConditionalCFM(BASECFM):
         self.lock = threading.Lock()
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2), solver=None):
         """Forward diffusion
 
         Args:
@@ -48,6 +53,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, see `solve`.
 
         Returns:
             sample: generated mel-spectrogram
@@ -64,14 +70,27 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         flow_cache = torch.stack([z_cache, mu_cache], dim=-1)
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        t_span = self.t_span(n_timesteps, mu.device)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), flow_cache
+
+    def t_span(self, n_timesteps, device):
+        "The `n_timesteps + 1` times of the ODE steps, from 0 (noise) to 1 (data), in fp32."
+        t_span = torch.linspace(0, 1, n_timesteps + 1, device=device)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return t_span
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+    def solve(self, x, t_span, mu, mask, spks, cond, solver=None):
         """
-        Fixed euler solver for ODEs.
+        Integrates the flow from noise to a mel-spectrogram over the steps of `t_span`.
+
+        Solvers, with their number of (batch-2, CFG) estimator calls per step:
+            - "euler": 1.
+            - "midpoint": 2, explicit midpoint method (second order).
+            - "heun": 2, Heun's method (second order).
+            - "ab2": 1, second order Adams-Bashforth, a multistep solver that reuses the previous step's estimate
+              to get second order at the cost of Euler. Meant for few steps (4-6).
+
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -83,56 +102,100 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): one of `CFM_SOLVERS`. Defaults to `cfm_params.solver`.
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        solver = solver or self.solver
+        assert solver in CFM_SOLVERS, f"unknown CFM solver {solver!r}, expected one of {list(CFM_SOLVERS)}"
+        velocity = self._guided_velocity(mu, mask, spks, cond)
+        x = x.float()
+        if solver == "ab2":
+            return self._solve_ab2(x, t_span, velocity)
+
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            dphi_dt = velocity(x, t)
+            if solver == "euler":
+                x = x + dt * dphi_dt
+            elif solver == "midpoint":
+                x = x + dt * velocity(x + 0.5 * dt * dphi_dt, t + 0.5 * dt)
+            else:  # heun
+                x_next = x + dt * dphi_dt
+                x = x + 0.5 * dt * (dphi_dt + velocity(x_next, t_next))
+        return x
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+        "Fixed euler solver for ODEs, see `solve`."
+        return self.solve(x, t_span, mu, mask, spks, cond, solver="euler")
+
+    def _solve_ab2(self, x, t_span, velocity):
+        """
+        Second order Adams-Bashforth, for the uneven steps of the cosine schedule: a multistep solver (like
+        DPM-Solver++(2M)) that extrapolates the velocity over each step from the current and previous estimates.
+        The first step, without history, is Euler's.
+        """
+        prev = None  # (velocity, step size) of the previous step
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            dphi_dt = velocity(x, t)
+            if prev is None:
+                x = x + dt * dphi_dt
+            else:
+                prev_dphi_dt, prev_dt = prev
+                w = dt / (2 * prev_dt)
+                x = x + dt * ((1 + w) * dphi_dt - w * prev_dphi_dt)
+            prev = (dphi_dt, dt)
+        return x
 
+    def _guided_velocity(self, mu, mask, spks, cond):
+        """
+        The flow's velocity v(x, t) with classifier-free guidance, for the solvers: each call runs the estimator
+        once, on a batch of the conditional and unconditional inputs.
+        """
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1].float()
-
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+        # The estimator's inputs are in its dtype (`mu`'s), except for the time. The first B rows are conditional,
+        # the last B unconditional (zero mu, speaker and cond).
+        dtype = mu.dtype
+        B, n_frames = mu.size(0), mu.size(2)
+        x_in = torch.zeros([2 * B, 80, n_frames], device=mu.device, dtype=dtype)
+        mask_in = torch.zeros([2 * B, 1, n_frames], device=mu.device, dtype=dtype)
+        mu_in = torch.zeros([2 * B, 80, n_frames], device=mu.device, dtype=dtype)
+        t_in = torch.zeros([2 * B], device=mu.device)
+        spks_in = torch.zeros([2 * B, 80], device=mu.device, dtype=dtype)
+        cond_in = torch.zeros([2 * B, 80, n_frames], device=mu.device, dtype=dtype)
+        mask_in[:B] = mask
+        mask_in[B:] = mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+        # what the estimator derives from the inputs other than x and t, once for all the steps
+        context = None
+        if isinstance(self.estimator, ConditionalDecoder):
+            context = self.estimator.prepare(mask_in, mu_in, spks_in, cond_in)
+
+        def velocity(x, t):
+            x_in[:B] = x
+            x_in[B:] = x
+            t_in[:] = t
+            dphi_dt = self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in, context=context)
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt.float(), [B, B], dim=0)
+            # (a new tensor: the TensorRT estimator writes its output over `x_in`)
+            return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+
+        return velocity
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, context=None):
+        if context is not None:
+            return self.estimator.forward(x, mask, mu, t, spks, cond, context=context)
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator.forward(x, mask, mu, t, spks, cond)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('t', (x.size(0),))
+                self.estimator.set_input_shape('spks', (x.size(0), 80))
+                self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -191,7 +254,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver=None, noise_positions=None):
         """Forward diffusion
 
         Args:
@@ -204,15 +267,21 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, see `solve`.
+            noise_positions (torch.Tensor, optional): index of each frame's noise in `rand_noise`; frame i gets
+                noise i by default.
+                shape: (batch_size, mel_timesteps)
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
-        # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        # the ODE state and time steps stay in fp32 when the estimator runs in reduced precision
+        # (the same noise for every row of a batch, so that an utterance's mel doesn't depend on its batch)
+        if noise_positions is None:
+            z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).expand(mu.size(0), -1, -1) * temperature
+        else:
+            z = self.rand_noise[0][:, noise_positions.cpu()].transpose(0, 1).to(mu.device) * temperature
+        t_span = self.t_span(n_timesteps, mu.device)
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver), None
@@ -409,11 +409,16 @@ class HiFTGenerator(nn.Module):
                                         self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
+    @property
+    def dtype(self):
+        "dtype of the upsampling / fusion network; the F0 predictor, source module and (i)STFT run in fp32."
+        return self.source_downs[0].weight.dtype
+
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+        s_stft_real, s_stft_imag = self._stft(s.squeeze(1).float())
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1).to(self.dtype)
 
-        x = self.conv_pre(x)
+        x = self.conv_pre(x.to(self.dtype))
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
@@ -435,7 +440,7 @@ class HiFTGenerator(nn.Module):
             x = xs / self.num_kernels
 
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        x = self.conv_post(x).float()
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
@@ -17,8 +17,9 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
+from torch.nn.utils.rnn import pad_sequence
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional, Tuple, Union
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
@@ -31,6 +32,7 @@ from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
 from .configs import CFM_PARAMS
+from .streaming import S3GenStream
 
 
 def drop_invalid_tokens(x):
@@ -104,6 +106,14 @@ class S3Token2Mel(torch.nn.Module):
         params = self.tokenizer.parameters()
         return next(params).device
 
+    def cast(self, dtype: torch.dtype):
+        """
+        Runs the flow (token encoder and CFM estimator) in `dtype`, e.g. `torch.bfloat16`. The reference embedding
+        (mel extraction, tokenizer, speaker encoder) and the ODE state stay in fp32.
+        """
+        self.flow.to(dtype=dtype)
+        return self
+
     def embed_ref(
         self,
         ref_wav: torch.Tensor,
@@ -156,6 +166,65 @@ class S3Token2Mel(torch.nn.Module):
             embedding=ref_x_vector,
         )
 
+    def _cast_ref_dict(self, ref_dict: dict) -> dict:
+        # type/device casting (all values will be numpy if it's from a prod API call), into a new dict, as the
+        # caller's may be shared by concurrent requests
+        ref_dict = dict(ref_dict)
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(self.device)
+        return ref_dict
+
+    def batch_ref_dicts(self, ref_dicts: List[dict]) -> dict:
+        "One ref dict of the (right-padded) references of `ref_dicts`, for `forward_batch`."
+        ref_dicts = [self._cast_ref_dict(ref_dict) for ref_dict in ref_dicts]
+        prompt_tokens = [ref_dict["prompt_token"][0, :int(ref_dict["prompt_token_len"])] for ref_dict in ref_dicts]
+        prompt_feats = [ref_dict["prompt_feat"][0] for ref_dict in ref_dicts]
+        return dict(
+            prompt_token=pad_sequence(prompt_tokens, batch_first=True),
+            prompt_token_len=torch.tensor([len(tokens) for tokens in prompt_tokens], device=self.device),
+            prompt_feat=pad_sequence(prompt_feats, batch_first=True),
+            prompt_feat_len=torch.tensor([len(feat) for feat in prompt_feats], device=self.device),
+            embedding=torch.cat([ref_dict["embedding"] for ref_dict in ref_dicts]),
+        )
+
+    @torch.inference_mode()
+    def forward_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: Union[dict, List[dict]],
+        finalize: bool = True,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Mels of several utterances at once, in one flow matching batch.
+
+        Args
+        ----
+        - `speech_tokens`: S3 speech tokens of each utterance, 1D, of any lengths
+        - `ref_dicts`: pre-computed ref embedding (see `embed_ref`) of every utterance, or one per utterance
+        - `finalize`, `n_timesteps`, `solver`: see `forward`
+
+        Returns
+        -------
+        (B, 80, frames) mels, right-padded, and their (B,) number of frames
+        """
+        if isinstance(ref_dicts, dict):
+            ref_dicts = [ref_dicts] * len(speech_tokens)
+        assert len(ref_dicts) == len(speech_tokens), "Need one ref dict per utterance"
+        speech_tokens = [tokens.view(-1).to(self.device) for tokens in speech_tokens]
+        return self.flow.inference(
+            token=pad_sequence(speech_tokens, batch_first=True),
+            token_len=torch.tensor([len(tokens) for tokens in speech_tokens], device=self.device),
+            finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            **self.batch_ref_dicts(ref_dicts),
+        )
+
     def forward(
         self,
         speech_tokens: torch.LongTensor,
@@ -165,6 +234,9 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        noise_offset: int = 0,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -181,29 +253,32 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `n_timesteps`: number of ODE steps of the flow matching decoder; the speed / quality knob.
+        - `solver`: its ODE solver, one of `CFM_SOLVERS` (default: "euler"). The second order solvers reach the
+          quality of 10 Euler steps in fewer estimator calls, see `benchmarks/eval_s3gen_solvers.py`.
+        - `noise_offset`: number of mel frames of the utterance before `speech_tokens`, when they are a window of
+          it, see `CausalMaskedDiffWithXvec.inference`.
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
         if ref_dict is None:
             ref_dict = self.embed_ref(ref_wav, ref_sr)
         else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(self.device)
+            ref_dict = self._cast_ref_dict(ref_dict)
 
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
 
-        # assert speech_tokens.shape[0] == 1, "only batch size of one allowed for now"
+        assert speech_tokens.shape[0] == 1, "use `forward_batch` for batches"
         speech_token_lens = torch.LongTensor([speech_tokens.size(1)]).to(self.device)
 
         output_mels, _ = self.flow.inference(
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            noise_offset=noise_offset,
             **ref_dict,
         )
         return output_mels
@@ -235,6 +310,17 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+    def cast(self, dtype: torch.dtype):
+        """
+        Runs the flow and HiFT's upsampling / fusion network in `dtype`. HiFT's F0 predictor and sine source, and
+        the (i)STFT, stay in fp32, as does everything `S3Token2Mel.cast` keeps there.
+        """
+        super().cast(dtype)
+        self.mel2wav.to(dtype=dtype)
+        self.mel2wav.f0_predictor.float()
+        self.mel2wav.m_source.float()
+        return self
+
     def forward(
         self,
         speech_tokens,
@@ -243,9 +329,19 @@ class S3Token2Wav(S3Token2Mel):
         ref_sr: Optional[int],
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
-        finalize: bool = False
+        finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
     ):
-        output_mels = super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = super().forward(
+            speech_tokens,
+            ref_wav=ref_wav,
+            ref_sr=ref_sr,
+            ref_dict=ref_dict,
+            finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+        )
 
         # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
@@ -268,8 +364,20 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+        noise_offset: int = 0,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(
+            speech_tokens,
+            ref_wav=ref_wav,
+            ref_sr=ref_sr,
+            ref_dict=ref_dict,
+            finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+            noise_offset=noise_offset,
+        )
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -288,11 +396,62 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        "Waveform of `speech_tokens`; see `S3Token2Mel.forward` for `n_timesteps` and `solver`."
+        output_mels = self.flow_inference(
+            speech_tokens,
+            ref_wav=ref_wav,
+            ref_sr=ref_sr,
+            ref_dict=ref_dict,
+            finalize=finalize,
+            n_timesteps=n_timesteps,
+            solver=solver,
+        )
         output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: Union[dict, List[dict]],
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+    ) -> List[torch.Tensor]:
+        """
+        Waveforms of several utterances at once: their mels in one flow matching batch (see `forward_batch`), then
+        their waveforms in one HiFT batch. The mels are those of single utterances; in the waveforms of the shorter
+        ones, HiFT's convolutions see the padding after their last few frames, so these differ slightly (HiFT's
+        sine source is random anyway).
+
+        Returns the (1, L) waveform of each utterance.
+        """
+        output_mels, mel_lens = self.forward_batch(
+            speech_tokens, ref_dicts, finalize=True, n_timesteps=n_timesteps, solver=solver
+        )
+        output_wavs, _ = self.hift_inference(output_mels)
+        hop = output_wavs.size(1) // output_mels.size(2)
+
+        wavs = []
+        for output_wav, mel_len in zip(output_wavs, mel_lens.tolist()):
+            wav = output_wav[None, :mel_len * hop].clone()
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            wav[:, :len(self.trim_fade)] *= self.trim_fade
+            wavs.append(wav)
+        return wavs
+
+    def stream(
+        self,
+        ref_dict: dict,
+        context_tokens: Optional[int] = 50,
+        n_timesteps: int = 10,
+        solver: Optional[str] = None,
+    ) -> S3GenStream:
+        "Incremental synthesis of an utterance from chunks of its speech tokens, see `S3GenStream`."
+        return S3GenStream(self, ref_dict, context_tokens=context_tokens, n_timesteps=n_timesteps, solver=solver)
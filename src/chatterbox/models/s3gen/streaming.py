@@ -0,0 +1,147 @@
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+# HiFT re-synthesizes the last MEL_CACHE_LEN mel frames of a block with the next one, and the audio of these frames
+# is cross-faded between the two blocks
+MEL_CACHE_LEN = 8
+HOP_LEN = 480  # samples per mel frame
+SOURCE_CACHE_LEN = MEL_CACHE_LEN * HOP_LEN
+
+
+def fade_in_out(fade_in: torch.Tensor, fade_out: torch.Tensor, window: torch.Tensor) -> torch.Tensor:
+    "`fade_in` with its start cross-faded with the end of `fade_out`, over half the length of `window` each."
+    overlap = len(window) // 2
+    fade_in = fade_in.clone()
+    fade_in[..., :overlap] = fade_in[..., :overlap] * window[:overlap] + fade_out[..., -overlap:] * window[overlap:]
+    return fade_in
+
+
+class S3GenStream:
+    """
+    Incremental S3Gen synthesis of one utterance, from chunks of speech tokens as T3 emits them.
+
+    Each `push` runs the flow over the tokens received so far, with `finalize=False`: only the mels of the tokens
+    followed by `pre_lookahead_len` others are kept, the others are recomputed by the next push. To keep the cost
+    of a push bounded, the flow sees only the last `context_tokens` of the tokens already vocoded as left context
+    (and the reference prompt, as always); the decoder noise of the window's frames is carried over from their
+    position in the utterance (`noise_offset`), as it would be in a single pass.
+
+    NOTE: this is an approximation of `S3Gen.inference`. The encoder and the flow decoder attend to the whole
+    window, so the mels of a frame also depend on the tokens after its lookahead, which a single pass sees and a
+    push doesn't, and on the tokens before the window, which a push doesn't see. How far the blocks are from a
+    single pass depends on how local the trained model's attention is; `test_stream_approximates_offline` bounds
+    it for a random model (whose attention isn't local at all).
+
+    The new frames are vocoded by HiFT after the last `MEL_CACHE_LEN` frames of the previous block, continuing its
+    sine source from the previous block's (`cache_source`), and the audio of these cached frames is held back
+    and cross-faded with its re-synthesis by the next block.
+
+    Usage:
+        stream = s3gen.stream(ref_dict)
+        for tokens in token_chunks:
+            play(stream.push(tokens))
+        play(stream.flush())
+    """
+
+    def __init__(self, s3gen, ref_dict: dict, context_tokens: Optional[int]=50, n_timesteps=10, solver=None):
+        """
+        :param s3gen: an `S3Gen`.
+        :param ref_dict: the reference embedding of the voice, see `S3Gen.embed_ref`.
+        :param context_tokens: number of already vocoded tokens the flow sees before the new ones; all if None
+            (the cost of a push then grows with the utterance).
+        :param n_timesteps: see `S3Gen.inference`.
+        :param solver: see `S3Gen.inference`.
+        """
+        self.s3gen = s3gen
+        self.ref_dict = ref_dict
+        self.context_tokens = context_tokens
+        self.n_timesteps = n_timesteps
+        self.solver = solver
+
+        self.tokens = torch.zeros(0, dtype=torch.long, device=s3gen.device)
+        self.n_frames = 0  # number of mel frames vocoded
+        self.n_samples = 0  # number of samples returned
+        self.mel_cache = None  # last mel frames of the previous block, which HiFT re-synthesizes
+        self.source_cache = torch.zeros(1, 1, 0, device=s3gen.device)
+        self.speech_cache = None  # held back audio of the cached mel frames
+        self.window = torch.from_numpy(np.hamming(2 * SOURCE_CACHE_LEN)).float().to(s3gen.device)
+        self.finished = False
+
+    @torch.inference_mode()
+    def push(self, speech_tokens: torch.Tensor) -> torch.Tensor:
+        "Adds speech tokens (1D) to the utterance, and returns the (1, L) audio that became final, maybe empty."
+        assert not self.finished, "the stream was flushed"
+        self.tokens = torch.cat([self.tokens, speech_tokens.view(-1).to(self.tokens.device)])
+        return self._synthesize(finalize=False)
+
+    @torch.inference_mode()
+    def flush(self) -> torch.Tensor:
+        "Ends the utterance, and returns the rest of its (1, L) audio."
+        assert not self.finished, "the stream was flushed"
+        self.finished = True
+        return self._synthesize(finalize=True)
+
+    def _final_mels(self, finalize):
+        "The (1, 80, T) mels of the frames that became final since the last call."
+        flow = self.s3gen.flow
+        ratio = flow.token_mel_ratio
+        n_final = ratio * len(self.tokens) - (0 if finalize else ratio * flow.pre_lookahead_len)
+        if n_final <= self.n_frames and not finalize:
+            return torch.zeros(1, 80, 0, device=self.tokens.device)
+
+        # the flow's frames of a window of tokens are those of the utterance, from the window's first token
+        start = 0
+        if self.context_tokens is not None:
+            start = max(0, self.n_frames // ratio - self.context_tokens)
+        mels = self.s3gen.flow_inference(
+            self.tokens[start:],
+            ref_dict=self.ref_dict,
+            finalize=finalize,
+            n_timesteps=self.n_timesteps,
+            solver=self.solver,
+            noise_offset=ratio * start,
+        )
+        mels = mels[:, :, self.n_frames - ratio * start:]
+        self.n_frames += mels.size(2)
+        return mels
+
+    def _synthesize(self, finalize):
+        mels = self._final_mels(finalize)
+        if mels.size(2) == 0 and not finalize:
+            return self._empty()
+
+        if self.mel_cache is not None:
+            mels = torch.cat([self.mel_cache, mels], dim=2)
+        if mels.size(2) == 0:
+            return self._empty()
+        wav, source = self.s3gen.hift_inference(mels, self.source_cache)
+        if self.speech_cache is not None:
+            wav = fade_in_out(wav, self.speech_cache, self.window)
+
+        if not finalize:
+            # hold back the audio of the last frames, to cross-fade it with their re-synthesis by the next block
+            n_cache = min(MEL_CACHE_LEN, mels.size(2))
+            self.mel_cache = mels[:, :, -n_cache:]
+            self.source_cache = source[:, :, -n_cache * HOP_LEN:]
+            self.speech_cache = wav[:, -n_cache * HOP_LEN:]
+            wav = wav[:, :-n_cache * HOP_LEN]
+            if n_cache < MEL_CACHE_LEN:
+                # too short to cross-fade: re-synthesize the whole block next time instead
+                self.speech_cache = None
+        return self._fade_in(wav)
+
+    def _fade_in(self, wav):
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip, as `S3Gen.inference`.
+        trim_fade = self.s3gen.trim_fade
+        if self.n_samples < len(trim_fade):
+            n = min(len(trim_fade) - self.n_samples, wav.size(1))
+            wav = wav.clone()
+            wav[:, :n] *= trim_fade[self.n_samples:self.n_samples + n]
+        self.n_samples += wav.size(1)
+        return wav
+
+    def _empty(self):
+        return torch.zeros(1, 0, device=self.tokens.device)
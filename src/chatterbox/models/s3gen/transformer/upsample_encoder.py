@@ -276,8 +276,9 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               decoding_chunk_size,
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
-        # lookahead + conformer encoder
-        xs = self.pre_lookahead_layer(xs)
+        # lookahead + conformer encoder; padding frames are zeroed, as the lookahead reaches past the end of the
+        # shorter rows of a batch, and should see the zeros it pads a single row with
+        xs = self.pre_lookahead_layer(xs * mask_pad.transpose(1, 2))
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         # upsample + conformer encoder
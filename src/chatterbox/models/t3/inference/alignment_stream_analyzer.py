@@ -2,9 +2,12 @@
 # Author: John Meade, Jeremy Hsu
 # MIT License
 import logging
+from typing import List
+
 import torch
 from dataclasses import dataclass
-from types import MethodType
+
+from .attention_spy import AttentionSpy
 
 
 logger = logging.getLogger(__name__)
@@ -27,28 +30,63 @@ class AlignmentAnalysisResult:
 
 
 class AlignmentStreamAnalyzer:
-    def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
+    def __init__(
+        self,
+        tfmr,
+        text_lens: List[int],
+        text_end: int,
+        prefix_len: int,
+        max_new_tokens: int,
+        alignment_layer_idx=9,
+        eos_idx=0,
+    ):
         """
         Some transformer TTS models implicitly solve text-speech alignment in one or more of their self-attention
         activation maps. This module exploits this to perform online integrity checks which streaming.
         A hook is injected into the specified attention layer, and heuristics are used to determine alignment
         position, repetition, etc.
 
-        NOTE: currently requires no queues.
+        It follows N utterances at once, laid out as in `T3.inference_batch`: their texts are right-aligned in the
+        prefix, all ending at cache position `text_end`, and the first N rows of the batch are their conditional
+        rows. The alignment matrix and every per-utterance state live on the device, in buffers allocated here, so
+        that `step` only queues device work and never waits for it.
+
+        :param text_lens: number of text tokens of each utterance.
+        :param text_end: cache position right after the last text token.
+        :param prefix_len: length of the decoding prefix; the frames after `text_end` are its (BOS) speech tokens.
+        :param max_new_tokens: number of speech tokens to make room for.
         """
-        # self.queue = queue
-        self.text_tokens_slice = (i, j) = text_tokens_slice
+        device = tfmr.norm.weight.device
+        self.N = N = len(text_lens)
+        S = max(text_lens)
+        self.text_tokens_slice = (text_end - S, text_end)
+        self.n_prefix_frames = prefix_len - text_end
         self.eos_idx = eos_idx
-        self.alignment = torch.zeros(0, j-i)
-        # self.alignment_bin = torch.zeros(0, j-i)
+
+        # Text columns are right-aligned: column c of the (N, S) window is text position c - offset of a row, and
+        # the columns before the offset are padding or conditioning.
+        self.text_lens = torch.tensor(text_lens, device=device)
+        self.text_pos = torch.arange(S, device=device) - (S - self.text_lens)[:, None]  # (N, S)
+
+        self.alignment = torch.zeros(N, self.n_prefix_frames + max_new_tokens, S, device=device)
+        self.n_frames = 0
         self.curr_frame_pos = 0
-        self.text_position = 0
+        self.text_position = torch.zeros(N, dtype=torch.long, device=device)
+
+        self.started = torch.zeros(N, dtype=torch.bool, device=device)
+        self.started_at = torch.full((N,), -1, dtype=torch.long, device=device)
+        self.head_max = torch.zeros(N, device=device)  # strongest activation of the first 4 text tokens so far
 
-        self.started = False
-        self.started_at = None
+        self.complete = torch.zeros(N, dtype=torch.bool, device=device)
+        self.completed_at = torch.full((N,), -1, dtype=torch.long, device=device)
+        # activations since completion: of the last 3 text tokens, and the strongest one before the last 5
+        self.tail_mass = torch.zeros(N, 3, device=device)
+        self.repeat_mass = torch.zeros(N, device=device)
 
-        self.complete = False
-        self.completed_at = None
+        self.false_start = torch.zeros(N, dtype=torch.bool, device=device)
+        self.discontinuity = torch.zeros(N, dtype=torch.bool, device=device)
+        self.long_tail = torch.zeros(N, dtype=torch.bool, device=device)
+        self.repetition = torch.zeros(N, dtype=torch.bool, device=device)
 
         # Using `output_attentions=True` is incompatible with optimized attention kernels, so
         # using it for all layers slows things down too much. We can apply it to just one layer
@@ -64,91 +102,95 @@ class AlignmentStreamAnalyzer:
         (credit: jrm)
         """
 
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            step_attention = output[1].cpu() # (B, 16, N, N)
-            self.last_aligned_attn = step_attention[0].mean(0) # (N, N)
+        def on_attention(layer_idx, attn_weights):
+            # (rows, H, q, K) -> (N, q, K): the head average of the conditional rows
+            self.last_aligned_attn = attn_weights[:self.N].float().mean(1)
 
-        target_layer = tfmr.layers[alignment_layer_idx].self_attn
-        hook_handle = target_layer.register_forward_hook(attention_forward_hook)
+        self.attention_spy = AttentionSpy(tfmr, [alignment_layer_idx], callback=on_attention).attach()
 
-        # Backup original forward
-        original_forward = target_layer.forward
-        def patched_forward(self, *args, **kwargs):
-            kwargs['output_attentions'] = True
-            return original_forward(*args, **kwargs)
-
-        # TODO: how to unpatch it?
-        target_layer.forward = MethodType(patched_forward, target_layer)
+    def close(self):
+        "Removes the attention hook, restoring the fused attention path for the spied layer."
+        self.attention_spy.detach()
 
     def step(self, logits):
         """
-        Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+        Updates the alignment with the latest forward pass, and returns the (N, vocab) logits with EOS forced on
+        long tails and repetitions, or suppressed before the end of the text.
         """
         # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = self.last_aligned_attn # (N, N)
         i, j = self.text_tokens_slice
         if self.curr_frame_pos == 0:
             # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
+            A_chunk = self.last_aligned_attn[:, -self.n_prefix_frames:, i:j]  # (N, T, S)
         else:
             # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+            A_chunk = self.last_aligned_attn[:, :, i:j]  # (N, 1, S)
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
-        A_chunk[:, self.curr_frame_pos + 1:] = 0
-
-
-        self.alignment = torch.cat((self.alignment, A_chunk), dim=0)
+        text_pos = self.text_pos[:, None]
+        A_chunk = A_chunk.masked_fill((text_pos < 0) | (text_pos > self.curr_frame_pos), 0)
 
-        A = self.alignment
-        T, S = A.shape
+        T0, T = self.n_frames, self.n_frames + A_chunk.size(1)
+        self.alignment[:, T0:T] = A_chunk
+        self.n_frames = T
 
         # update position
-        cur_text_posn = A_chunk[-1].argmax()
-        discontinuity = not(-4 < cur_text_posn - self.text_position < 7) # NOTE: very lenient!
-        if not discontinuity:
-            self.text_position = cur_text_posn
+        last = A_chunk[:, -1].masked_fill(self.text_pos < 0, -1)  # so that an all-zero frame points at position 0
+        cur_text_posn = self.text_pos.gather(1, last.argmax(dim=1, keepdim=True))[:, 0]
+        delta = cur_text_posn - self.text_position
+        self.discontinuity = (delta <= -4) | (delta >= 7)  # NOTE: very lenient!
+        self.text_position = torch.where(self.discontinuity, self.text_position, cur_text_posn)
 
         # Hallucinations at the start of speech show up as activations at the bottom of the attention maps!
         # To mitigate this, we just wait until there are no activations far off-diagonal in the last 2 tokens,
         # and there are some strong activations in the first few tokens.
-        false_start = (not self.started) and (A[-2:, -2:].max() > 0.1 or A[:, :4].max() < 0.5)
-        self.started = not false_start
-        if self.started and self.started_at is None:
-            self.started_at = T
+        head = A_chunk.masked_fill(text_pos >= 4, 0).amax(dim=(1, 2))
+        self.head_max = torch.maximum(self.head_max, head)
+        last_frames = self.alignment[:, max(T - 2, 0):T, -2:].amax(dim=(1, 2))
+        self.false_start = ~self.started & ((last_frames > 0.1) | (self.head_max < 0.5))
+        self.started = ~self.false_start
+        self.started_at = torch.where(self.started & (self.started_at < 0), T, self.started_at)
+
+        # Frames after completion; completion itself is checked after accumulating them, as it is set after the
+        # frame that reached it.
+        after_completion = self.complete[:, None]
+        self.tail_mass += A_chunk[:, :, -3:].sum(dim=1) * after_completion
+        if A_chunk.size(2) > 5:
+            self.repeat_mass += A_chunk[:, :, :-5].amax(dim=2).sum(dim=1) * after_completion[:, 0]
 
         # Is generation likely complete?
-        self.complete = self.complete or self.text_position >= S - 3
-        if self.complete and self.completed_at is None:
-            self.completed_at = T
-
-        # NOTE: EOS rarely assigned activations, and second-last token is often punctuation, so use last 3 tokens.
-        # NOTE: due to the false-start behaviour, we need to make sure we skip activations for the first few tokens.
-        last_text_token_duration = A[15:, -3:].sum()
+        self.complete = self.complete | (self.text_position >= self.text_lens - 3)
+        self.completed_at = torch.where(self.complete & (self.completed_at < 0), T, self.completed_at)
 
         # Activations for the final token that last too long are likely hallucinations.
-        long_tail = self.complete and (A[self.completed_at:, -3:].sum(dim=0).max() >= 10) # 400ms
+        self.long_tail = self.complete & (self.tail_mass.amax(dim=1) >= 10)  # 400ms
 
         # If there are activations in previous tokens after generation has completed, assume this is a repetition error.
-        repetition = self.complete and (A[self.completed_at:, :-5].max(dim=1).values.sum() > 5)
+        self.repetition = self.complete & (self.repeat_mass > 5)
 
         # If a bad ending is detected, force emit EOS by modifying logits
         # NOTE: this means logits may be inconsistent with latents!
-        if long_tail or repetition:
-            logger.warn(f"forcing EOS token, {long_tail=}, {repetition=}")
-            # (±2**15 is safe for all dtypes >= 16bit)
-            logits = -(2**15) * torch.ones_like(logits)
-            logits[..., self.eos_idx] = 2**15
+        force_eos = (self.long_tail | self.repetition)[:, None]
+        # (±2**15 is safe for all dtypes >= 16bit)
+        forced = torch.full_like(logits, -(2**15))
+        forced[:, self.eos_idx] = 2**15
+        logits = torch.where(force_eos, forced, logits)
 
         # Suppress EoS to prevent early termination
-        if cur_text_posn < S - 3: # FIXME: arbitrary
-            logits[..., self.eos_idx] = -2**15
+        suppress_eos = (cur_text_posn < self.text_lens - 3)[:, None] & ~force_eos  # FIXME: arbitrary
+        is_eos = torch.arange(logits.size(1), device=logits.device) == self.eos_idx
+        logits = logits.masked_fill(suppress_eos & is_eos, -(2**15))
 
         self.curr_frame_pos += 1
         return logits
+
+    def result(self, row=0) -> AlignmentAnalysisResult:
+        "The analysis of the latest frame of an utterance. NOTE: this waits for the device."
+        return AlignmentAnalysisResult(
+            false_start=bool(self.false_start[row]),
+            long_tail=bool(self.long_tail[row]),
+            repetition=bool(self.repetition[row]),
+            discontinuity=bool(self.discontinuity[row]),
+            complete=bool(self.complete[row]),
+            position=int(self.text_position[row]),
+        )
@@ -0,0 +1,146 @@
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+import torch
+from torch import Tensor
+
+
+class AttentionSpy:
+    """
+    Captures the self-attention weights of selected Llama layers.
+
+    Using `output_attentions=True` on the whole model forces every layer onto the eager attention path and keeps all
+    of their weights alive, so instead only the spied layers are switched to eager attention (by intercepting their
+    kwargs) and their weights are handed to the spy (credit: jrm). All other layers keep using SDPA.
+
+    A spy only sees the forward passes of the thread that attached it, and only that thread's passes take the eager
+    path, so that concurrent calls on one model (e.g. `T3.inference` with `analyze_alignment=True`) don't see each
+    other's attention. The spied layers are patched while any spy is attached to them.
+
+    Usage:
+        with AttentionSpy(t3.tfmr, [9]) as spy:
+            t3.inference(...)
+            attn = spy.last[9]  # (B, H, N, N) for the first step, (B, H, 1, N+i) for the i-th
+    """
+
+    def __init__(
+        self,
+        tfmr,
+        layer_idxs: Iterable[int],
+        callback: Optional[Callable[[int, Tensor], None]] = None,
+    ):
+        """
+        :param tfmr: a `LlamaModel`
+        :param layer_idxs: indices of the layers to capture
+        :param callback: optional `callback(layer_idx, attn_weights)` called on every forward of a spied layer.
+            If not given, the latest weights of each layer are kept in `self.last`.
+        """
+        self.tfmr = tfmr
+        self.layer_idxs = list(layer_idxs)
+        self.callback = callback
+        self.last: Dict[int, Tensor] = {}
+        self._attached = False
+
+    def attach(self):
+        assert not self._attached, "already attached"
+        for layer_idx in self.layer_idxs:
+            _LayerTap.acquire(self.tfmr.layers[layer_idx].self_attn).spies.append((self, layer_idx))
+        self._attached = True
+        return self
+
+    def detach(self):
+        "Stops capturing; call from the thread that attached the spy."
+        if not self._attached:
+            return
+        for layer_idx in self.layer_idxs:
+            _LayerTap.release(self.tfmr.layers[layer_idx].self_attn, (self, layer_idx))
+        self._attached = False
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def _capture(self, layer_idx, attn_weights):
+        """
+        `attn_weights` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
+        """
+        if self.callback is not None:
+            self.callback(layer_idx, attn_weights)
+        else:
+            self.last[layer_idx] = attn_weights
+
+
+class _LayerTap:
+    """
+    The patched `forward` of one attention layer, shared by every spy on it. Each thread has its own list of
+    spies: the passes of threads without any run the original forward, untouched.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, layer):
+        self.n_spies = 0
+        self._local = threading.local()
+        original_forward = layer.forward
+
+        def forward(*args, **kwargs):
+            spies = self.spies
+            if not spies:
+                return original_forward(*args, **kwargs)
+            # See `LlamaAttention.forward`; the output is `attn_output, attn_weights, ...`.
+            # NOTE: When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
+            output = original_forward(*args, **_eager_kwargs(layer, args, kwargs))
+            for spy, layer_idx in spies:
+                spy._capture(layer_idx, output[1])
+            return output
+
+        layer.forward = forward
+
+    @property
+    def spies(self):
+        "The (spy, layer_idx) of the current thread"
+        if not hasattr(self._local, "spies"):
+            self._local.spies = []
+        return self._local.spies
+
+    @classmethod
+    def acquire(cls, layer) -> "_LayerTap":
+        with cls._lock:
+            tap = layer.__dict__.get("_attention_tap")
+            if tap is None:
+                tap = layer.__dict__["_attention_tap"] = cls(layer)
+            tap.n_spies += 1
+            return tap
+
+    @classmethod
+    def release(cls, layer, spy):
+        with cls._lock:
+            tap = layer.__dict__["_attention_tap"]
+            tap.spies.remove(spy)
+            tap.n_spies -= 1
+            if tap.n_spies == 0:
+                # drop the instance attributes set in `acquire`, exposing the class method again
+                del layer.__dict__["_attention_tap"]
+                layer.__dict__.pop("forward", None)
+
+
+def _eager_kwargs(layer, args, kwargs):
+    kwargs = dict(kwargs, output_attentions=True)
+    hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+    if kwargs.get("attention_mask") is None and hidden_states.size(1) > 1:
+        # SDPA can run without a mask via `is_causal`, but the eager path can't
+        kwargs["attention_mask"] = _causal_mask(hidden_states, kwargs.get("past_key_value"), layer.layer_idx)
+    return kwargs
+
+
+def _causal_mask(hidden_states: Tensor, past_key_value, layer_idx: int):
+    T = hidden_states.size(1)
+    past_len = past_key_value.get_seq_length(layer_idx) if past_key_value is not None else 0
+    device, dtype = hidden_states.device, hidden_states.dtype
+    key_pos = torch.arange(past_len + T, device=device)
+    query_pos = past_len + torch.arange(T, device=device)
+    masked = key_pos[None] > query_pos[:, None]
+    return torch.zeros(T, past_len + T, device=device, dtype=dtype).masked_fill(
+        masked, torch.finfo(dtype).min
+    )[None, None]
@@ -0,0 +1,45 @@
+import torch
+from torch import Tensor
+
+
+class AsyncHostFlag:
+    """
+    Reads a device-side boolean on the host without stalling the device queue.
+
+    On CUDA, `post` starts a non-blocking copy of the flag into pinned memory, and `poll` only looks at it once
+    the copy has landed (checked with an event), so the host keeps queueing work in the meantime and sees the flag
+    a step or two late. On CPU, where reading a tensor doesn't wait on any queue, `post` reads it right away.
+
+    Usage:
+        flag = AsyncHostFlag(device)
+        for i in range(n):
+            ...  # queue work that updates `done`, a 0-dim bool tensor
+            flag.post(done)
+            if flag.poll():
+                break
+    """
+
+    def __init__(self, device: torch.device):
+        self.is_cuda = device.type == "cuda"
+        self.host = torch.zeros((), dtype=torch.bool, pin_memory=self.is_cuda)
+        self.event = torch.cuda.Event() if self.is_cuda else None
+        self.in_flight = False
+        self.value = False
+
+    def post(self, flag: Tensor):
+        "Starts reading `flag`; ignored while the previous read is still in flight."
+        if self.in_flight:
+            return
+        if not self.is_cuda:
+            self.value = bool(flag)
+            return
+        self.host.copy_(flag, non_blocking=True)
+        self.event.record()
+        self.in_flight = True
+
+    def poll(self) -> bool:
+        "The latest value that has reached the host."
+        if self.in_flight and self.event.query():
+            self.in_flight = False
+            self.value = bool(self.host)
+        return self.value
@@ -0,0 +1,52 @@
+import math
+from typing import Optional, Sequence
+
+from ...s3tokenizer import S3_TOKEN_RATE
+
+
+class SpeechLengthModel:
+    """
+    Predicts how many speech tokens T3 needs for a text, to budget `max_new_tokens` per utterance instead of
+    decoding up to a fixed cap when the stop token is missed.
+
+    Speech tokens come at `S3_TOKEN_RATE` (25/s), and English text tokens (mostly single characters, with spaces)
+    are spoken at about `text_tokens_per_second`, so an utterance is expected to take
+    `n_text * S3_TOKEN_RATE / text_tokens_per_second` speech tokens. The budget adds a relative `margin` for slow
+    speakers and pauses, and `min_tokens` for very short texts.
+
+    Usage:
+        length_model = SpeechLengthModel()
+        max_new_tokens = length_model.budget(text_tokens.size(-1))
+    """
+
+    def __init__(self, text_tokens_per_second=14.0, margin=1.5, min_tokens=40, max_tokens: Optional[int]=None):
+        """
+        :param max_tokens: upper bound of the budget, e.g. `T3Config.max_speech_tokens`.
+        """
+        self.text_tokens_per_second = text_tokens_per_second
+        self.margin = margin
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+
+    @property
+    def speech_tokens_per_text_token(self):
+        return S3_TOKEN_RATE / self.text_tokens_per_second
+
+    def expected(self, n_text_tokens: int) -> float:
+        "Expected number of speech tokens for `n_text_tokens` text tokens."
+        return n_text_tokens * self.speech_tokens_per_text_token
+
+    def budget(self, n_text_tokens: int) -> int:
+        "`max_new_tokens` for `n_text_tokens` text tokens: the expected length, with its safety margin."
+        budget = math.ceil(self.margin * self.expected(n_text_tokens)) + self.min_tokens
+        return budget if self.max_tokens is None else min(budget, self.max_tokens)
+
+    @classmethod
+    def fit(cls, n_text_tokens: Sequence[int], n_speech_tokens: Sequence[int], **kwargs) -> "SpeechLengthModel":
+        """
+        Calibrates the speaking rate on (text, speech) token counts of reference utterances, e.g. a voice's own
+        recordings: the rate is their total text length over their total duration.
+        """
+        assert len(n_text_tokens) == len(n_speech_tokens) > 0
+        duration = sum(n_speech_tokens) / S3_TOKEN_RATE
+        return cls(text_tokens_per_second=sum(n_text_tokens) / duration, **kwargs)
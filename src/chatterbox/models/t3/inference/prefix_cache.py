@@ -0,0 +1,63 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import torch
+from transformers import DynamicCache
+
+from ..modules.cond_enc import T3Cond
+
+
+class PrefixKVCache:
+    """
+    An LRU cache of the transformer KV cache of conditioning prefixes, so that utterances in a voice that was
+    seen before only need their text prefilled.
+
+    The conditioning prefix (speaker embedding, prompt speech tokens / perceiver output, emotion) comes first in
+    the sequence, so under causal attention its keys and values don't depend on the text. `T3` keys entries on
+    `fingerprint(t3_cond)`, which covers the voice and the exaggeration (`emotion_adv`), and the dtype and device.
+
+    NOTE: entries are only valid for the weights they were computed with; `clear` it after changing them.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, DynamicCache]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(t3_cond: T3Cond) -> str:
+        "A digest of every conditioning input of `t3_cond`."
+        h = hashlib.sha1()
+        for name, value in sorted(vars(t3_cond).items()):
+            if name == "cond_prompt_speech_emb" and t3_cond.cond_prompt_speech_tokens is not None:
+                continue  # derived from the tokens
+            if torch.is_tensor(value):
+                value = value.detach().cpu()
+                h.update(f"{name}:{value.dtype}:{tuple(value.shape)}".encode())
+                h.update(value.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+            elif value is not None:
+                h.update(f"{name}:{value!r}".encode())
+        return h.hexdigest()
+
+    def get(self, key: Hashable) -> Optional[DynamicCache]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, past: DynamicCache):
+        with self._lock:
+            self._entries[key] = past
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
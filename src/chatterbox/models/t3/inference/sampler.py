@@ -0,0 +1,179 @@
+"""
+Fused speech token sampling for T3.
+
+Replaces the HF logits processor chain (`RepetitionPenaltyLogitsProcessor`, `MinPLogitsWarper`, `TopPLogitsWarper`,
+softmax, `torch.multinomial`) with a few element-wise passes over the speech vocab:
+- the repetition penalty reads a running (B, vocab) token count buffer instead of gathering the whole history,
+- min-p compares logits to the max logit in log space, without a softmax,
+- top-p searches for its probability threshold with a few histograms instead of sorting the vocab every step,
+- the token is drawn with the exponential race trick (argmax of `logits - log(Exp(1) noise)`), which samples
+  exactly from the softmax distribution and, unlike `torch.multinomial`, doesn't need a normalized distribution
+  or a device-to-host sync.
+
+Every parameter can be a float (shared by the batch) or a (B,) tensor (one value per row). Results match the HF
+chain up to float rounding at the top-p boundary; the sampled tokens differ for the same seed, since the random
+draws are used differently.
+"""
+from typing import Optional, Union
+
+import torch
+from torch import Tensor
+
+
+Param = Union[float, Tensor]
+
+# Top-p threshold search: TOP_P_LEVELS histograms of TOP_P_BINS bins, the first one spanning TOP_P_LOG_SPAN nats
+# below the most likely token. 3 levels of 1024 bins resolve log-probabilities to ~4e-8, below float32 precision.
+TOP_P_BINS = 1024
+TOP_P_LEVELS = 3
+TOP_P_LOG_SPAN = 40.0
+
+
+def _column(param: Param, logits: Tensor):
+    "A float, or a (B,) tensor as a (B, 1) column broadcasting against (B, vocab) logits"
+    if torch.is_tensor(param):
+        return param.to(device=logits.device, dtype=logits.dtype).view(-1, 1)
+    return param
+
+
+def _is_noop(param: Param, value: float):
+    return not torch.is_tensor(param) and param == value
+
+
+def apply_cfg(logits: Tensor, cfg_weight: Param, n: int):
+    """
+    Mixes (2n, vocab) conditional-then-unconditional logits into (n, vocab). Logits with only n rows (no CFG) are
+    returned as is. Either way they are cast to fp32, so that sampling doesn't depend on the model's dtype.
+    """
+    logits = logits.float()
+    if logits.size(0) == n:
+        return logits
+    logits_cond = logits[:n]
+    logits_uncond = logits[n:]
+    return logits_cond + _column(cfg_weight, logits_cond) * (logits_cond - logits_uncond)
+
+
+def apply_repetition_penalty(logits: Tensor, token_counts: Tensor, penalty: Param):
+    "CTRL-style penalty (as `RepetitionPenaltyLogitsProcessor`) for every token with a non-zero count."
+    if _is_noop(penalty, 1.0):
+        return logits
+    penalty = _column(penalty, logits)
+    penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+    return torch.where(token_counts > 0, penalized, logits)
+
+
+def apply_min_p(logits: Tensor, min_p: Param):
+    "Drops tokens less likely than `min_p` times the most likely one (as `MinPLogitsWarper`)."
+    if _is_noop(min_p, 0.0):
+        return logits
+    min_p = torch.as_tensor(_column(min_p, logits), dtype=logits.dtype, device=logits.device)
+    threshold = logits.max(dim=-1, keepdim=True).values + min_p.log()
+    return logits.masked_fill(logits < threshold, float("-inf"))
+
+
+def apply_top_p(logits: Tensor, top_p: Param):
+    """
+    Nucleus filtering (as `TopPLogitsWarper`): drops the least likely tokens whose total probability stays within
+    `1 - top_p`, always keeping the most likely one.
+
+    Instead of sorting the vocab, the cut-off is found with a radix-style threshold search over log-probabilities:
+    tokens are histogrammed (weighted by probability) into `TOP_P_BINS` bins, the bin where the cumulative mass
+    crosses `1 - top_p` is located, and only the tokens in that bin are refined at the next level. Tokens below
+    that bin are dropped and those above it kept.
+    """
+    if _is_noop(top_p, 1.0):
+        return logits
+    probs = torch.softmax(logits, dim=-1)
+    x = logits - logits.max(dim=-1, keepdim=True).values  # log(p / p_max), in [-inf, 0]
+    budget = 1 - _column(top_p, logits)
+
+    B = logits.size(0)
+    lo = torch.full((B, 1), -TOP_P_LOG_SPAN, dtype=x.dtype, device=x.device)  # lower edge of the searched range
+    width = TOP_P_LOG_SPAN
+    mass_below = torch.zeros_like(lo)  # mass of the tokens already dropped
+    undecided = torch.ones_like(probs, dtype=torch.bool)
+    keep = torch.zeros_like(undecided)
+    for _ in range(TOP_P_LEVELS):
+        # the first level lumps everything below its range in bin 0
+        bins = ((x - lo) * (TOP_P_BINS / width)).clamp(0, TOP_P_BINS - 1).long()
+        mass = torch.zeros(B, TOP_P_BINS, dtype=probs.dtype, device=probs.device)
+        mass.scatter_add_(1, bins, probs * undecided)
+        cum_mass = mass_below + mass.cumsum(dim=-1)
+        boundary = (cum_mass <= budget).sum(dim=-1, keepdim=True).clamp(max=TOP_P_BINS - 1)
+        mass_below = torch.where(boundary > 0, cum_mass.gather(1, (boundary - 1).clamp(min=0)), mass_below)
+
+        keep |= undecided & (bins > boundary)
+        undecided &= bins == boundary
+        width = width / TOP_P_BINS
+        lo = lo + boundary * width
+
+    # tokens left in the last boundary bin are (up to float resolution) the one crossing the budget
+    keep |= undecided & (probs > 0)
+    return logits.masked_fill(~keep, float("-inf"))
+
+
+def sample_from_logits(logits: Tensor, generator: Optional[torch.Generator] = None):
+    "Draws one token per row of (B, vocab) unnormalized logits: (B, 1)"
+    noise = torch.empty_like(logits, dtype=torch.float32).exponential_(generator=generator)
+    return (logits.float() - noise.log()).argmax(dim=-1, keepdim=True)
+
+
+def sample_tokens(
+    logits: Tensor,
+    token_counts: Tensor,
+    *,
+    temperature: Param = 0.8,
+    repetition_penalty: Param = 1.2,
+    min_p: Param = 0.05,
+    top_p: Param = 1.0,
+    generator: Optional[torch.Generator] = None,
+):
+    """
+    The full sampling step of T3 (after CFG, see `apply_cfg`): temperature, repetition penalty, min-p, top-p and
+    sampling, in the order of the HF chain it replaces.
+
+    :param logits: (B, vocab) logits.
+    :param token_counts: (B, vocab) occurrences of each token so far, see `update_token_counts`.
+    :return: (B, 1) sampled tokens.
+    """
+    if not _is_noop(temperature, 1.0):
+        logits = logits / _column(temperature, logits)
+    logits = apply_repetition_penalty(logits, token_counts, repetition_penalty)
+    logits = apply_min_p(logits, min_p)
+    logits = apply_top_p(logits, top_p)
+    return sample_from_logits(logits, generator)
+
+
+def update_token_counts(token_counts: Tensor, tokens: Tensor):
+    "Counts (B, 1) new tokens into a (B, vocab) buffer, in place."
+    return token_counts.scatter_add_(1, tokens, torch.ones_like(tokens, dtype=token_counts.dtype))
+
+
+class TokenHistory:
+    """
+    The tokens sampled so far for each of B rows, in a pre-allocated (B, capacity) buffer, along with their
+    (B, vocab) occurrence counts for the repetition penalty. Appending a step costs the same however long the
+    history is, instead of re-allocating it (`torch.cat`) and re-gathering it every step.
+    """
+
+    def __init__(self, batch_size: int, capacity: int, vocab_size: int, device, initial_token: Optional[int] = None):
+        """
+        :param initial_token: counted once in every row (e.g. the BOS token the HF processors saw at the start of
+            `generated_ids`), but not stored in `tokens`.
+        """
+        self.buffer = torch.empty(batch_size, capacity, dtype=torch.long, device=device)
+        self.counts = torch.zeros(batch_size, vocab_size, dtype=torch.int32, device=device)
+        if initial_token is not None:
+            self.counts[:, initial_token] = 1
+        self.length = 0
+
+    def append(self, tokens: Tensor):
+        "Records (B, 1) new tokens."
+        self.buffer[:, self.length] = tokens[:, 0]
+        update_token_counts(self.counts, tokens)
+        self.length += 1
+
+    @property
+    def tokens(self):
+        "(B, length) tokens so far"
+        return self.buffer[:, :self.length]
@@ -0,0 +1,332 @@
+import logging
+import queue
+import threading
+from concurrent.futures import CancelledError, Future
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+from transformers import DynamicCache, StaticCache
+
+from ..modules.cond_enc import T3Cond
+from .sampler import apply_cfg, sample_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+class SlotKVCache(StaticCache):
+    """
+    A `StaticCache` whose rows ("slots") are independent sequences, each with its own length.
+
+    Only the first `n_rows` rows take part in a forward pass, so the active sequences are kept packed at the start
+    of the cache (see `T3BatchScheduler._retire`). When `write_positions` is set, each row writes its single new
+    key / value at its own position instead of the shared `cache_position`; attention is then restricted with a
+    per-row 4D mask (see `slot_attention_mask`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_positions: Optional[Tensor] = None
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        n_rows = key_states.size(0)
+        k_out = self.key_cache[layer_idx][:n_rows]
+        v_out = self.value_cache[layer_idx][:n_rows]
+        if self.write_positions is None:
+            cache_position = cache_kwargs.get("cache_position")
+            k_out.index_copy_(2, cache_position, key_states.to(k_out.dtype))
+            v_out.index_copy_(2, cache_position, value_states.to(v_out.dtype))
+            return k_out, v_out
+        rows = torch.arange(n_rows, device=key_states.device)
+        k_out[rows, :, self.write_positions] = key_states[:, :, 0].to(k_out.dtype)
+        v_out[rows, :, self.write_positions] = value_states[:, :, 0].to(v_out.dtype)
+        return k_out, v_out
+
+    def copy_in(self, row: int, past: DynamicCache):
+        "Copies a prefilled (n, heads, len, head_dim) cache into rows [row, row + n)."
+        for layer_idx in range(len(self.key_cache)):
+            k, v = past.key_cache[layer_idx], past.value_cache[layer_idx]
+            self.key_cache[layer_idx][row:row + k.size(0), :, :k.size(2)] = k
+            self.value_cache[layer_idx][row:row + v.size(0), :, :v.size(2)] = v
+
+    def move_rows(self, src: int, dst: int, n: int, length: int):
+        "Moves rows [src, src + n) to [dst, dst + n), copying their first `length` positions."
+        for cache in (self.key_cache, self.value_cache):
+            for layer in cache:
+                layer[dst:dst + n, :, :length] = layer[src:src + n, :, :length].clone()
+
+
+def slot_attention_mask(lengths: Tensor, max_len: int, dtype):
+    "(n_rows, 1, 1, max_len) additive mask letting each row see its first `lengths[i]` positions."
+    visible = torch.arange(max_len, device=lengths.device)[None] < lengths[:, None]
+    mask = torch.zeros(lengths.size(0), max_len, device=lengths.device, dtype=dtype)
+    return mask.masked_fill(~visible, torch.finfo(dtype).min)[:, None, None]
+
+
+@dataclass
+class T3Request:
+    t3_cond: T3Cond
+    text_tokens: Tensor
+    max_new_tokens: int
+    temperature: float = 0.8
+    min_p: float = 0.05
+    top_p: float = 1.0
+    repetition_penalty: float = 1.2
+    cfg_weight: float = 0.0
+    future: Future = field(default_factory=Future)
+
+
+@dataclass
+class _Sequence:
+    "A request admitted into the running batch."
+    request: T3Request
+    row: int  # first cache row; CFG sequences also own `row + 1`
+    n_rows: int
+    length: int  # number of cache positions filled so far
+    logits: Tensor  # (n_rows, vocab) logits for the next token
+    tokens: List[int] = field(default_factory=list)  # generated so far
+
+
+class T3BatchScheduler:
+    """
+    Continuous batching for T3: requests are admitted into the running decode batch at token boundaries, and leave
+    it as soon as they emit `stop_speech_token` (or reach their `max_new_tokens`), resolving their future with the
+    generated speech tokens. The decode loop runs on a background thread; `submit` can be called from any thread.
+
+    Every sequence lives in one row of a `SlotKVCache` (two for CFG: conditional, then unconditional). A new request
+    is prefilled on its own, and its cache copied into free rows; finished sequences are compacted out so each step
+    only computes the rows in use. The cache is sized for `max_rows` rows of `max_len` positions, so a request can
+    only be admitted if its prefix and `max_new_tokens` fit in `max_len`.
+
+    Usage:
+        scheduler = T3BatchScheduler(t3, max_rows=8)
+        future = scheduler.submit(t3_cond, text_tokens, max_new_tokens=1000, cfg_weight=0.5)
+        speech_tokens = future.result()  # (1, T), ending with `stop_speech_token` unless cut short
+        scheduler.close()
+    """
+
+    def __init__(self, t3, max_rows=8, max_len=2048):
+        self.t3 = t3
+        self.max_rows = max_rows
+        self.max_len = max_len
+        self.backend = t3.patched_model
+        dtype = t3.speech_emb.weight.dtype
+        self.past = SlotKVCache(config=t3.cfg, batch_size=max_rows, max_cache_len=max_len, device=t3.device, dtype=dtype)
+        # repetition penalty counts of each sequence, in the row of its conditional cache row
+        self.token_counts = torch.zeros(max_rows, t3.hp.speech_tokens_dict_size, dtype=torch.int32, device=t3.device)
+
+        self._pending = queue.Queue()
+        self._waiting: List[T3Request] = []  # dequeued, but waiting for free rows
+        self._active: List[_Sequence] = []
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="t3-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        max_new_tokens=1000,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.0,
+        repetition_penalty=1.2,
+        cfg_weight=0.0,
+    ) -> Future:
+        """
+        Queues one utterance (same arguments as `T3.inference`, but `text_tokens` is a single unbatched row) and
+        returns a future of its (1, T) speech tokens.
+        """
+        assert not self._closed.is_set(), "scheduler is closed"
+        request = T3Request(
+            t3_cond=t3_cond,
+            text_tokens=torch.atleast_2d(text_tokens)[:1],
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+        )
+        self._pending.put(request)
+        return request.future
+
+    def close(self):
+        "Stops the decode loop; unfinished requests are cancelled."
+        self._closed.set()
+        self._pending.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def rows_in_use(self):
+        return sum(seq.n_rows for seq in self._active)
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                self._admit(block=not self._active)
+                if self._active:
+                    self._step()
+            except Exception as e:
+                logger.exception("T3 scheduler step failed")
+                for seq in self._active:
+                    seq.request.future.set_exception(e)
+                self._active = []
+
+        for request in self._waiting:
+            request.future.cancel()
+        for seq in self._active:  # running futures can't be cancelled anymore
+            seq.request.future.set_exception(CancelledError())
+        while not self._pending.empty():
+            request = self._pending.get_nowait()
+            if request is not None:
+                request.future.cancel()
+
+    def _admit(self, block):
+        "Moves queued requests into the batch while there are free rows; blocks for one if the batch is empty."
+        while True:
+            try:
+                request = self._pending.get(block=block and not self._waiting)
+            except queue.Empty:
+                break
+            if request is None:  # woken up by `close`
+                return
+            self._waiting.append(request)
+            block = False
+
+        while self._waiting:
+            request = self._waiting[0]
+            n_rows = 2 if request.cfg_weight > 0.0 else 1
+            if self.rows_in_use + n_rows > self.max_rows and n_rows <= self.max_rows:
+                break
+            self._waiting.pop(0)
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if n_rows > self.max_rows:  # would never fit
+                request.future.set_exception(ValueError(f"request needs {n_rows} rows > {self.max_rows=}"))
+                continue
+            try:
+                self._active.append(self._prefill(request, row=self.rows_in_use, n_rows=n_rows))
+            except Exception as e:
+                request.future.set_exception(e)
+
+    @torch.inference_mode()
+    def _prefill(self, request: T3Request, row: int, n_rows: int):
+        t3 = self.t3
+        embeds, len_cond = t3.prepare_inference_embeds(
+            t3_cond=request.t3_cond,
+            text_tokens=request.text_tokens,
+            cfg_weight=request.cfg_weight,
+        )
+        length = embeds.size(1)
+        if length + request.max_new_tokens > self.max_len:
+            raise ValueError(f"prefix ({length}) + max_new_tokens ({request.max_new_tokens}) > {self.max_len=}")
+
+        prefixes = t3.cached_prefixes([request.t3_cond], [(embeds, len_cond)])
+        output = t3.prefill(
+            embeds,
+            DynamicCache(),
+            shared_prefix_len=len_cond if n_rows == 2 or prefixes else 0,
+            prefixes=prefixes,
+        )
+        self.past.copy_in(row, output.past_key_values)
+        self.token_counts[row] = 0
+        self.token_counts[row, t3.hp.start_speech_token] = 1
+
+        return _Sequence(request=request, row=row, n_rows=n_rows, length=length, logits=output.logits[:, -1, :])
+
+    @torch.inference_mode()
+    def _step(self):
+        "Samples the next token of every active sequence, retires the finished ones, and runs one forward pass."
+        t3 = self.t3
+        active = self._active
+        logits = torch.cat([seq.logits for seq in active])  # (rows, vocab), in cache row order
+        device = logits.device
+
+        def per_sequence(values, dtype=torch.float32):
+            return torch.tensor(values, dtype=dtype, device=device)
+
+        # Every sequence is sampled with its own parameters, in one batch
+        cond_rows = per_sequence([seq.row for seq in active], torch.long)
+        uncond_rows = per_sequence([seq.row + seq.n_rows - 1 for seq in active], torch.long)
+        cfg_weights = per_sequence([seq.request.cfg_weight if seq.n_rows == 2 else 0.0 for seq in active])
+        logits = apply_cfg(torch.cat([logits[cond_rows], logits[uncond_rows]]), cfg_weights, len(active))
+        next_tokens = sample_tokens(
+            logits,
+            self.token_counts[cond_rows],
+            temperature=per_sequence([seq.request.temperature for seq in active]),
+            repetition_penalty=per_sequence([seq.request.repetition_penalty for seq in active]),
+            min_p=per_sequence([seq.request.min_p for seq in active]),
+            top_p=per_sequence([seq.request.top_p for seq in active]),
+        )  # (n_sequences, 1)
+        self.token_counts.index_put_(
+            (cond_rows, next_tokens[:, 0]), torch.ones_like(cond_rows, dtype=torch.int32), accumulate=True
+        )
+
+        # Sequences leave the batch as soon as they stop
+        finished, kept = [], []
+        for i, (seq, token) in enumerate(zip(active, next_tokens[:, 0].tolist())):
+            seq.tokens.append(token)
+            if token == t3.hp.stop_speech_token or len(seq.tokens) >= seq.request.max_new_tokens:
+                finished.append(seq)
+            else:
+                kept.append(i)
+        self._retire(finished)
+        if not self._active:
+            return
+
+        # One new token per row; CFG rows repeat their sequence's token
+        row_sequences, positions, lengths = [], [], []
+        for i, seq in zip(kept, self._active):
+            row_sequences += [i] * seq.n_rows
+            positions += [len(seq.tokens)] * seq.n_rows
+            lengths += [seq.length] * seq.n_rows
+        tokens = next_tokens[per_sequence(row_sequences, torch.long)]
+        positions = per_sequence(positions, torch.long)
+        lengths = per_sequence(lengths, torch.long)
+
+        embeds = t3.speech_emb(tokens) + t3.speech_pos_emb.get_fixed_embedding(positions[:, None])
+        self.past.write_positions = lengths
+        try:
+            output = self.backend(
+                inputs_embeds=embeds,
+                past_key_values=self.past,
+                return_dict=True,
+                cache_position=lengths,
+                position_ids=lengths[:, None],
+                attention_mask=slot_attention_mask(lengths + 1, self.max_len, embeds.dtype),
+            )
+        finally:
+            self.past.write_positions = None
+
+        logits = output.logits[:, -1, :]
+        for seq in self._active:
+            seq.logits = logits[seq.row:seq.row + seq.n_rows]
+            seq.length += 1
+
+    def _retire(self, finished: List[_Sequence]):
+        "Resolves finished sequences, and packs the remaining ones at the start of the cache."
+        if not finished:
+            return
+        for seq in finished:
+            seq.request.future.set_result(torch.tensor([seq.tokens], device=self.t3.device))
+
+        active, row = [], 0
+        for seq in self._active:
+            if any(seq is f for f in finished):
+                continue
+            if seq.row != row:
+                self.past.move_rows(seq.row, row, seq.n_rows, seq.length)
+                self.token_counts[row] = self.token_counts[seq.row]
+                seq.row = row
+            active.append(seq)
+            row += seq.n_rows
+        self._active = active
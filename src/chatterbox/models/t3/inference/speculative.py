@@ -0,0 +1,41 @@
+from typing import Dict, List, Tuple
+
+
+class NGramDraft:
+    """
+    Drafts the next speech tokens of one sequence by prompt lookup: finds the latest earlier occurrence of the
+    last `max_ngram` (down to `min_ngram`) tokens, and proposes the tokens that followed it. Speech tokens repeat
+    a lot (silences, held vowels, repeated words), and drafting costs no forward pass.
+
+    Usage:
+        draft = NGramDraft()
+        for token in tokens:
+            draft.append(token)
+        proposal = draft.propose(4)  # up to 4 tokens, possibly none
+    """
+
+    def __init__(self, max_ngram=3, min_ngram=1):
+        assert 1 <= min_ngram <= max_ngram
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.tokens: List[int] = []
+        # n-gram -> index of the token that followed its latest occurrence
+        self._continuations: Dict[Tuple[int, ...], int] = {}
+
+    def append(self, token: int):
+        tokens = self.tokens
+        tokens.append(token)
+        end = len(tokens) - 1  # the n-grams ending right before the new token are now followed by it
+        for n in range(self.min_ngram, min(self.max_ngram, end) + 1):
+            self._continuations[tuple(tokens[end - n:end])] = end
+
+    def propose(self, k: int) -> List[int]:
+        "Up to `k` tokens following the longest n-gram suffix seen before."
+        if k <= 0:
+            return []
+        tokens = self.tokens
+        for n in range(min(self.max_ngram, len(tokens)), self.min_ngram - 1, -1):
+            start = self._continuations.get(tuple(tokens[-n:]))
+            if start is not None:
+                return tokens[start:start + k]
+        return []
@@ -76,8 +76,11 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         past_key_values: Optional[torch.Tensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
+        cache_position: Optional[torch.LongTensor]=None,
+        position_ids: Optional[torch.LongTensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
     ):
         """
         This is a method used by huggingface's generate() method.
@@ -85,12 +88,20 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
         S should be 1.
+        :param output_hidden_states: also return the hidden states of every layer. Off by default, since decoding
+        only needs the final one; to inspect attention maps of a few layers, see `AttentionSpy`.
+        :param cache_position: (S,) int64 tensor of the cache slots written by this call. Required when
+        `past_key_values` is a pre-allocated `StaticCache`, which is non-empty even before the first step. A
+        `SlotKVCache` takes one position per row instead.
+        :param position_ids: (B, S) int64 tensor of RoPE positions, needed when rows contain padding.
+        :param attention_mask: (B, T) padding mask (1 = attend) over the cache, or a (B, 1, S, T) additive mask,
+        which is used as is; see `LlamaModel.forward`.
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
+        if cache_position is None:
+            is_large_input = inputs_embeds.size(1) != 1
+            has_cache = past_key_values is not None and len(past_key_values) > 0
+            assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
@@ -99,14 +110,17 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
+            cache_position=cache_position,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim)
 
         logits = self.speech_head(hidden_states)
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
-        # NOTE: hallucination handler may modify logits to force emit an EOS token
-        # logits = self.alignment_stream_analyzer.step(logits)
+        # NOTE: the hallucination handler, which may modify logits to force emit an EOS token, runs on the CFG-mixed
+        # logits of each step, see `T3.inference_batch(analyze_alignment=True)`
 
         return CausalLMOutputWithCrossAttentions(
             logits=logits,
@@ -16,6 +16,9 @@ class T3Config:
     input_pos_emb = "learned"
     speech_cond_prompt_len = 150
 
+    # attention layer whose maps align speech to text, see `AlignmentStreamAnalyzer`
+    alignment_layer_idx = 9
+
     # For T3CondEnc
     encoder_type = "voice_encoder"
     speaker_embed_size = 256
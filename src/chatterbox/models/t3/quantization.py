@@ -0,0 +1,301 @@
+"""
+Weight-only int8 / int4 quantization of the T3 backbone.
+
+Decoding at small batch sizes is bound by reading the weights, so storing the transformer's linear layers and the
+speech head in 8 or 4 bits (with one fp32 scale per output channel, or per group of input channels) cuts the bytes
+read per token by about 4x / 8x against fp32. Embeddings, norms and the conditioning encoder stay in full precision.
+
+Usage:
+    quantize_t3(t3, bits=8)                           # in place, from the loaded fp32 weights
+    save_quantized_t3(t3, "t3_cfg_int8.safetensors")  # see `python -m chatterbox.quantize`
+    t3 = load_quantized_t3("t3_cfg_int8.safetensors")
+"""
+from typing import Dict, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from .t3 import T3
+from .modules.cond_enc import T3Cond
+from .modules.t3_config import T3Config
+
+
+QUANTIZATION_BITS = {"int8": 8, "int4": 4}
+
+
+def _fbgemm_available():
+    return "fbgemm" in torch.backends.quantized.supported_engines
+
+
+class QuantizedLinear(nn.Module):
+    """
+    An `nn.Linear` with symmetric int8 or int4 weights: `weight ~= qweight * scale`, with one scale per output
+    channel, or per `group_size` input channels of each output channel.
+
+    int4 weights are packed two per byte (the even input channels in the low nibble). The forward pass casts the
+    integer weights to the activations' dtype and applies the scales to the output (per-channel) or to the weights
+    (groups); under `torch.compile` the cast fuses into the matmul, so only the packed weights are read.
+
+    With `quantize_activations`, per-channel int8 layers on CPU run fbgemm's int8 GEMM instead, which also quantizes
+    the activations (per tensor, on the fly): several times faster than the fp32 matmul, where casting the weights
+    in eager mode is slower, but no longer weight-only, so its quality has to be checked on its own (see
+    `compare_t3` and `python -m chatterbox.quantize --check`).
+    """
+
+    def __init__(
+        self,
+        in_features,
+        out_features,
+        bits=8,
+        group_size: Optional[int]=None,
+        bias=False,
+        device=None,
+        quantize_activations=False,
+    ):
+        super().__init__()
+        assert bits in (8, 4), f"unsupported bit width {bits}"
+        if bits == 4:
+            assert in_features % 2 == 0, "int4 packing needs an even number of input features"
+        if group_size is not None:
+            assert in_features % group_size == 0, f"{in_features=} is not a multiple of {group_size=}"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.quantize_activations = quantize_activations
+        n_groups = 1 if group_size is None else in_features // group_size
+        if bits == 8:
+            qweight = torch.zeros(out_features, in_features, dtype=torch.int8, device=device)
+        else:
+            qweight = torch.zeros(out_features, in_features // 2, dtype=torch.uint8, device=device)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scale", torch.ones(out_features, n_groups, device=device))
+        self.register_buffer("bias", torch.zeros(out_features, device=device) if bias else None)
+        # (cache key, fbgemm prepacked weight), see `_fbgemm_weight`
+        self._packed = None
+
+    @classmethod
+    def from_linear(
+        cls, linear: nn.Linear, bits=8, group_size: Optional[int]=None, quantize_activations=False
+    ) -> "QuantizedLinear":
+        weight = linear.weight.detach().float()
+        layer = cls(
+            linear.in_features,
+            linear.out_features,
+            bits=bits,
+            group_size=group_size,
+            bias=linear.bias is not None,
+            device=weight.device,
+            quantize_activations=quantize_activations,
+        )
+        layer.quantize_(weight)
+        if linear.bias is not None:
+            layer.bias.copy_(linear.bias.detach())
+        return layer
+
+    @torch.no_grad()
+    def quantize_(self, weight: Tensor):
+        "Sets the integer weights and scales from a float (out_features, in_features) `weight`."
+        qmax = 2 ** (self.bits - 1) - 1
+        grouped = weight.float().view(self.out_features, self.scale.size(1), -1)
+        scale = grouped.abs().amax(dim=2, keepdim=True).clamp(min=1e-8) / qmax
+        q = torch.round(grouped / scale).clamp(-qmax, qmax).to(torch.int8).view(self.out_features, -1)
+        if self.bits == 4:
+            q = (q + 8).to(torch.uint8)
+            q = q[:, 0::2] | (q[:, 1::2] << 4)
+        self.qweight.copy_(q)
+        self.scale.copy_(scale[..., 0])
+
+    def int_weight(self) -> Tensor:
+        "The (out_features, in_features) integer weights, unpacked."
+        if self.bits == 8:
+            return self.qweight
+        low = (self.qweight & 0xF).to(torch.int8) - 8
+        high = (self.qweight >> 4).to(torch.int8) - 8
+        return torch.stack([low, high], dim=-1).view(self.out_features, self.in_features)
+
+    def dequantize(self, dtype=torch.float32) -> Tensor:
+        "The (out_features, in_features) weights in `dtype`."
+        q = self.int_weight().to(dtype).view(self.out_features, self.scale.size(1), -1)
+        return (q * self.scale.to(dtype)[..., None]).view(self.out_features, self.in_features)
+
+    def _fbgemm_weight(self):
+        "The weights prepacked for `quantized::linear_dynamic`, rebuilt when the buffers were replaced or updated."
+        key = (self.qweight.data_ptr(), self.qweight._version, self.scale.data_ptr(), self.scale._version)
+        if self._packed is None or self._packed[0] != key:
+            weight = torch._make_per_channel_quantized_tensor(
+                self.qweight,
+                self.scale[:, 0].double(),
+                torch.zeros(self.out_features, dtype=torch.long),
+                0,
+            )
+            self._packed = (key, torch.ops.quantized.linear_prepack(weight, self.bias))
+        return self._packed[1]
+
+    def forward(self, x: Tensor) -> Tensor:
+        if (
+            self.quantize_activations
+            and self.bits == 8
+            and self.group_size is None
+            and x.device.type == "cpu"
+            and x.dtype == torch.float32
+            and _fbgemm_available()
+            and not torch.compiler.is_compiling()
+        ):
+            # reduce_range: 7-bit activations, which avoid overflowing fbgemm's int16 accumulation on x86
+            return torch.ops.quantized.linear_dynamic(x, self._fbgemm_weight(), True)
+
+        if self.group_size is None:
+            out = F.linear(x, self.int_weight().to(x.dtype)) * self.scale[:, 0].to(x.dtype)
+        else:
+            out = F.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out
+
+    def extra_repr(self):
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, "
+            f"group_size={self.group_size}, bias={self.bias is not None}, "
+            f"quantize_activations={self.quantize_activations}"
+        )
+
+
+def _quantized_linears(t3: T3):
+    "(parent module, attribute name, linear) of each linear layer that gets quantized."
+    for layer in t3.tfmr.layers:
+        for parent in (layer.self_attn, layer.mlp):
+            for name, child in parent.named_children():
+                if isinstance(child, (nn.Linear, QuantizedLinear)):
+                    yield parent, name, child
+    yield t3, "speech_head", t3.speech_head
+
+
+def quantize_t3(
+    t3: T3, bits=8, group_size: Optional[int]=None, from_weights=True, quantize_activations=False
+) -> T3:
+    """
+    Replaces the transformer's linear layers and the speech head of `t3` with `QuantizedLinear`s, in place.
+
+    :param bits: 8 or 4.
+    :param group_size: number of input channels sharing a scale; one scale per output channel if None.
+    :param from_weights: quantize the current weights; if False, the layers are left empty, to load a quantized
+        state dict into.
+    :param quantize_activations: run per-channel int8 layers on CPU with fbgemm's int8 GEMM, which also quantizes
+        the activations; see `QuantizedLinear` and `set_activation_quantization`.
+    """
+    for parent, name, linear in list(_quantized_linears(t3)):
+        assert isinstance(linear, nn.Linear), "T3 is already quantized"
+        if from_weights:
+            quantized = QuantizedLinear.from_linear(
+                linear, bits=bits, group_size=group_size, quantize_activations=quantize_activations
+            )
+        else:
+            quantized = QuantizedLinear(
+                linear.in_features,
+                linear.out_features,
+                bits=bits,
+                group_size=group_size,
+                bias=linear.bias is not None,
+                device=linear.weight.device,
+                quantize_activations=quantize_activations,
+            )
+        setattr(parent, name, quantized)
+
+    # the inference wrappers, compiled steps and cached prefixes were built with the float layers
+    t3.__dict__["_patched_model"] = None
+    t3._layer_backends.clear()
+    t3._compiled_steps.clear()
+    if t3.prefix_cache is not None:
+        t3.prefix_cache.clear()
+    return t3
+
+
+def set_activation_quantization(t3: T3, enabled: bool) -> T3:
+    "Switches the int8 layers of a quantized `t3` between weight-only and fbgemm's W8A8 CPU path, in place."
+    for _, _, linear in _quantized_linears(t3):
+        assert isinstance(linear, QuantizedLinear), "T3 is not quantized"
+        linear.quantize_activations = enabled
+    return t3
+
+
+def quantization_metadata(t3: T3) -> Dict[str, str]:
+    "The quantization settings of `t3`, as stored in the metadata of a quantized checkpoint."
+    linear = t3.speech_head
+    assert isinstance(linear, QuantizedLinear), "T3 is not quantized"
+    return {
+        "format": "pt",
+        "quantization": f"int{linear.bits}",
+        "group_size": str(linear.group_size or 0),
+    }
+
+
+def save_quantized_t3(t3: T3, fpath):
+    state = {k: v.contiguous() for k, v in t3.state_dict().items()}
+    save_file(state, str(fpath), metadata=quantization_metadata(t3))
+
+
+def load_quantized_t3(fpath, hp: T3Config=T3Config()) -> T3:
+    "Builds a T3 from a checkpoint written by `save_quantized_t3`, on CPU."
+    with safe_open(str(fpath), framework="pt") as f:
+        metadata = f.metadata() or {}
+    assert "quantization" in metadata, f"{fpath} is not a quantized T3 checkpoint"
+    group_size = int(metadata.get("group_size", 0)) or None
+    t3 = T3(hp)
+    quantize_t3(t3, bits=QUANTIZATION_BITS[metadata["quantization"]], group_size=group_size, from_weights=False)
+    t3.load_state_dict(load_file(str(fpath)))
+    return t3
+
+
+@torch.inference_mode()
+def compare_t3(
+    reference: T3,
+    quantized: T3,
+    t3_cond: T3Cond,
+    text_tokens: Tensor,
+    max_new_tokens=300,
+    seed=0,
+) -> Dict[str, float]:
+    """
+    Quality check of a quantized T3 against the full-precision `reference`: speech tokens are sampled with the
+    reference, then teacher-forced through both models, and their next-token distributions compared.
+
+    :param text_tokens: (1, len) text tokens, with start / stop tokens.
+    :returns: dict with `top1_agreement` (fraction of positions where both models' most likely token matches),
+        `mean_kl` (KL divergence of the quantized distributions from the reference, averaged over positions) and
+        `n_tokens`.
+    """
+    hp = reference.hp
+    torch.manual_seed(seed)
+    speech_tokens = reference.inference(
+        t3_cond=t3_cond,
+        text_tokens=text_tokens,
+        max_new_tokens=max_new_tokens,
+        cfg_weight=0.0,
+    )
+    speech_tokens = speech_tokens[:, speech_tokens[0] < hp.start_speech_token]
+    bos = torch.full((1, 1), hp.start_speech_token, dtype=torch.long, device=speech_tokens.device)
+    speech_tokens = torch.cat([bos, speech_tokens], dim=1)
+
+    logits = []
+    for model in (reference, quantized):
+        out = model(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            text_token_lens=torch.tensor([text_tokens.size(1)]),
+            speech_tokens=speech_tokens,
+            speech_token_lens=torch.tensor([speech_tokens.size(1)]),
+        )
+        logits.append(out.speech_logits[0].float())
+    ref_logp, quant_logp = (l.log_softmax(dim=-1) for l in logits)
+
+    kl = (ref_logp.exp() * (ref_logp - quant_logp)).sum(dim=-1)
+    agreement = (ref_logp.argmax(dim=-1) == quant_logp.argmax(dim=-1)).float()
+    return {
+        "top1_agreement": agreement.mean().item(),
+        "mean_kl": kl.mean().item(),
+        "n_tokens": speech_tokens.size(1),
+    }
@@ -1,14 +1,17 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
+import copy
 import logging
-from typing import Union, Optional, List
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Union, Optional, List, Callable, Sequence, Tuple
 
-from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
-from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+from transformers import LlamaModel, LlamaConfig, DynamicCache, StaticCache
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -16,12 +19,45 @@ from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
+from .inference.sampler import TokenHistory, apply_cfg, sample_tokens
+from .inference.host_flag import AsyncHostFlag
+from .inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from .inference.prefix_cache import PrefixKVCache
+from .inference.speculative import NGramDraft
 from ..utils import AttrDict
 
 
 logger = logging.getLogger(__name__)
 
 
+# Compiled decode steps size their static KV cache in multiples of this
+COMPILED_CACHE_LEN_MULTIPLE = 256
+
+
+@dataclass
+class _CompiledStep:
+    fn: Callable
+    past: StaticCache
+    lock: threading.Lock
+
+
+def _copy_into_cache(past, prefixes: List[DynamicCache], length: int, n_copies=1):
+    """
+    Writes the first `length` positions of per-utterance prefix caches, stacked and repeated `n_copies` times (e.g.
+    for the CFG rows), into the (empty) static or dynamic cache `past`.
+    """
+    for layer_idx in range(len(prefixes[0])):
+        if not torch.is_tensor(prefixes[0].key_cache[layer_idx]):
+            continue  # a skipped layer, see `T3.backend`
+        k = torch.cat([prefix.key_cache[layer_idx][:, :, :length] for prefix in prefixes]).repeat(n_copies, 1, 1, 1)
+        v = torch.cat([prefix.value_cache[layer_idx][:, :, :length] for prefix in prefixes]).repeat(n_copies, 1, 1, 1)
+        if isinstance(past, StaticCache):
+            past.key_cache[layer_idx][:, :, :length] = k
+            past.value_cache[layer_idx][:, :, :length] = v
+        else:
+            past.update(k, v, layer_idx)
+
+
 def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     B = text_tokens.size(0)
     assert (text_tokens == hp.start_text_token).int().sum() >= B, "missing start_text_token"
@@ -62,19 +98,104 @@ class T3(nn.Module):
         # logit projection
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
-        self.compiled = False
+
+        # inference wrapper, built on first use, see `patched_model`
+        self._patched_model = None
+        self._patched_model_lock = threading.Lock()
+
+        # inference wrappers running a subset of the layers, by layer indices, see `backend`
+        self._layer_backends = {}
+
+        # compiled decode steps, by (batch size, CFG, compile mode, layers), least recently used first; each one holds
+        # a graph and a static KV cache, so only the last `max_compiled_steps` are kept, see `_get_compiled_step`
+        self.max_compiled_steps = 4
+        self._compiled_steps: "OrderedDict[tuple, _CompiledStep]" = OrderedDict()
+        self._compiled_steps_lock = threading.Lock()
+
+        # KV cache of the conditioning prefix of recently seen voices, off unless set, see `cached_prefixes`
+        self.prefix_cache: Optional[PrefixKVCache] = None
 
     @property
     def device(self):
-        return self.speech_head.weight.device
+        return self.speech_emb.weight.device
+
+    @property
+    def patched_model(self) -> T3HuggingfaceBackend:
+        """
+        The HF wrapper used for inference, built once on first use (constructing a `PreTrainedModel` isn't free).
+        It shares this model's layers, and is kept out of the module tree so it doesn't show up in `state_dict`.
+        """
+        if self._patched_model is None:
+            with self._patched_model_lock:
+                if self._patched_model is None:
+                    # Note the llama-specific logic. Other tfmr types can be added later.
+                    self.__dict__["_patched_model"] = T3HuggingfaceBackend(
+                        config=self.cfg,
+                        llama=self.tfmr,
+                        speech_enc=self.speech_emb,
+                        speech_head=self.speech_head,
+                        alignment_stream_analyzer=None,
+                    )
+        return self._patched_model
+
+    def backend(self, layers: Optional[Sequence[int]]=None) -> T3HuggingfaceBackend:
+        """
+        The inference wrapper running only the transformer layers at the (increasing) indices `layers`, then the
+        final norm and the speech head; `patched_model` if None or all of them. Skipping layers trades quality for
+        speed, see `layers_for_depth`. Wrappers are built once per subset, and share this model's weights.
+        """
+        layers = self._normalize_layers(layers)
+        if layers is None:
+            return self.patched_model
+        with self._patched_model_lock:
+            backend = self._layer_backends.get(layers)
+            if backend is None:
+                # a shallow copy of the transformer with its own list of (shared) layers; each layer keeps its
+                # `layer_idx`, so KV caches are sized and indexed as for the full model
+                llama = copy.copy(self.tfmr)
+                llama._modules = dict(self.tfmr._modules)
+                llama.layers = nn.ModuleList([self.tfmr.layers[i] for i in layers])
+                backend = T3HuggingfaceBackend(
+                    config=self.cfg,
+                    llama=llama,
+                    speech_enc=self.speech_emb,
+                    speech_head=self.speech_head,
+                    alignment_stream_analyzer=None,
+                )
+                self._layer_backends[layers] = backend
+            return backend
+
+    def _normalize_layers(self, layers: Optional[Sequence[int]]) -> Optional[Tuple[int, ...]]:
+        "`layers` as a hashable tuple, or None for all layers"
+        if layers is None:
+            return None
+        layers = tuple(layers)
+        n_layers = len(self.tfmr.layers)
+        assert len(layers) > 0 and list(layers) == sorted(set(layers)), f"{layers=} must be increasing indices"
+        assert 0 <= layers[0] and layers[-1] < n_layers, f"{layers=} out of range for {n_layers} layers"
+        return None if len(layers) == n_layers else layers
+
+    def layers_for_depth(self, depth: float) -> Optional[List[int]]:
+        """
+        The layers to run at a relative `depth` in (0, 1]: the first `depth` fraction of them (at least one), i.e.
+        exiting early through the speech head. None (all layers) at depth 1.
+        """
+        assert 0.0 < depth <= 1.0, f"{depth=} must be in (0, 1]"
+        n_layers = len(self.tfmr.layers)
+        n = max(1, round(depth * n_layers))
+        return None if n == n_layers else list(range(n))
 
     def prepare_conditioning(self, t3_cond: T3Cond):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
+        `t3_cond` is left as is, as it may be shared by concurrent requests.
         """
         if t3_cond.cond_prompt_speech_tokens is not None and t3_cond.cond_prompt_speech_emb is None:
-            t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens) + \
-                self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
+            t3_cond = replace(
+                t3_cond,
+                cond_prompt_speech_emb=self.speech_emb(t3_cond.cond_prompt_speech_tokens) + \
+                    self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens),
+            )
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
     def prepare_input_embeds(
@@ -222,150 +343,675 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0,
+        cache_implementation="static",
+        compile_mode=None,
+        eos_check_interval=1,
+        draft_tokens=0,
+        layers: Optional[Sequence[int]]=None,
+        analyze_alignment=False,
+        progress_callback: Optional[Callable[[int], None]]=None,
+        token_callback: Optional[Callable[[Tensor], None]]=None,
     ):
         """
         Args:
-            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor. Only the first row is decoded; for CFG, the
+                unconditional row is derived from it.
+            cache_implementation: "static" pre-allocates the KV cache for the whole utterance (conditioning + text
+                + `max_new_tokens`) and writes each step into it in-place, so per-token latency stays flat. "dynamic"
+                uses the default HF cache, which is re-allocated and grown by one token every step.
+            compile_mode, eos_check_interval, draft_tokens, layers, analyze_alignment, progress_callback,
+                token_callback: see `inference_batch`.
+
+        Returns:
+            (1, T) speech tokens, ending with `stop_speech_token` unless `max_new_tokens` was reached.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
-        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        text_tokens = torch.atleast_2d(text_tokens)
+
+        return self.inference_batch(
+            t3_conds=[t3_cond],
+            text_tokens=[text_tokens[0]],
+            initial_speech_tokens=initial_speech_tokens,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            cache_implementation=cache_implementation,
+            compile_mode=compile_mode,
+            eos_check_interval=eos_check_interval,
+            draft_tokens=draft_tokens,
+            layers=layers,
+            analyze_alignment=analyze_alignment,
+            progress_callback=progress_callback,
+            token_callback=token_callback,
+        )[0]
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_conds: List[T3Cond],
+        text_tokens: List[Tensor],
+        initial_speech_tokens: Optional[Tensor]=None,
+        max_new_tokens: Union[int, Sequence[int], None]=None,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.00,
+        repetition_penalty=1.2,
+        cfg_weight=0,
+        cache_implementation="static",
+        compile_mode=None,
+        eos_check_interval=1,
+        draft_tokens=0,
+        layers: Optional[Sequence[int]]=None,
+        analyze_alignment=False,
+        progress_callback: Optional[Callable[[int], None]]=None,
+        token_callback: Optional[Callable[[Tensor], None]]=None,
+    ):
+        """
+        Decodes N utterances together, one T3 forward pass per step for all of them.
+
+        Each utterance is laid out as in `inference`, i.e. [cond | text | speech]; shorter ones are padded between
+        their conditioning and their text, so that every row ends on the same cache slot and the padding is masked
+        out of attention. Rows that have emitted `stop_speech_token` keep being stepped (emitting more stop tokens)
+        until every row is finished or `max_new_tokens` is reached.
+
+        Args:
+            t3_conds: one `T3Cond` per utterance.
+            text_tokens: one 1D (or (1, T)) tensor per utterance, including start / stop text tokens.
+            max_new_tokens: budget of speech tokens, shared by all utterances or one per utterance (see
+                `SpeechLengthModel`); `hp.max_speech_tokens` if None. Caches are sized for the largest one.
+            cfg_weight: CFG weight shared by all utterances; each one gets a conditional and an unconditional row.
+            compile_mode: if set, the decode step (token embedding, transformer, speech head and CFG mix) runs through
+                `torch.compile` with this mode, e.g. "reduce-overhead" to replay it as a CUDA graph. Compiled steps
+                and their static KV cache are built on first use for each (batch size, CFG) and reused by later
+                calls; calls sharing one are serialized. Requires the static cache.
+            eos_check_interval: how often (in steps) to check whether every row has stopped. The check never blocks
+                the GPU queue (see `AsyncHostFlag`), so decoding runs a few steps past the last stop token; those
+                extra tokens are trimmed.
+            draft_tokens: if > 0, decodes speculatively: each forward pass also verifies up to this many tokens
+                drafted from the utterance's own history (see `NGramDraft`), and yields every drafted token that all
+                rows sample in agreement. Tokens are still sampled one by one from T3's distribution, so the output
+                is unchanged (for a given seed, up to float rounding); only the number of forward passes drops.
+                The host checks every token, so this doesn't combine with `compile_mode`.
+            layers: indices of the transformer layers to run, e.g. from `layers_for_depth`; all of them if None.
+                Fewer layers decode faster, at some cost in quality. See `backend`.
+            analyze_alignment: if True, follows each utterance's text-speech alignment in the attention maps of
+                `hp.alignment_layer_idx` (see `AlignmentStreamAnalyzer`), forcing a stop token on hallucinated long
+                tails and repetitions and suppressing it before the end of the text. The analysis stays on the
+                device. That layer runs the (slower) eager attention for this call only; concurrent calls on other
+                threads are analyzed separately (see `AttentionSpy`).
+            progress_callback: called with the number of tokens decoded so far after each step.
+            token_callback: called with the (N, 1) tokens of each step, as they are decoded (finished rows get stop
+                tokens), e.g. to vocode them while decoding goes on. The tokens stay on the device, so the callback
+                doesn't wait for the GPU unless it reads them.
+
+        Returns:
+            a list of N (1, T_i) speech token tensors, each ending with `stop_speech_token` unless `max_new_tokens`
+            was reached.
+        """
+        # Validate / sanitize inputs
+        assert len(t3_conds) == len(text_tokens) > 0
+        assert cache_implementation in ("static", "dynamic"), f"unknown {cache_implementation=}"
+        assert compile_mode is None or cache_implementation == "static", "compiling needs the static cache"
+        assert compile_mode is None or draft_tokens == 0, "speculative decoding isn't compiled"
+        assert not analyze_alignment or (compile_mode is None and draft_tokens == 0), \
+            "alignment analysis needs plain eager decoding"
+        device = self.device
+        N = len(text_tokens)
+        if not isinstance(max_new_tokens, Sequence):
+            max_new_tokens = [max_new_tokens] * N
+        assert len(max_new_tokens) == N, "need one `max_new_tokens` per utterance"
+        budgets = [budget or self.hp.max_speech_tokens for budget in max_new_tokens]
+        max_new_tokens = max(budgets)
 
         # Default initial speech to a single start-of-speech token
         if initial_speech_tokens is None:
-            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+            initial_speech_tokens = torch.tensor([[self.hp.start_speech_token]], device=device)
+        initial_speech_tokens = torch.atleast_2d(initial_speech_tokens).to(dtype=torch.long, device=device)
+
+        # Prepare custom input embeds, one utterance at a time so each gets its own text positions
+        seqs = [
+            self.prepare_inference_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text,
+                initial_speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+            for t3_cond, text in zip(t3_conds, text_tokens)
+        ]
+
+        # With a prefix cache, only the text and speech prefix of a voice seen before needs a forward pass
+        layers = self._normalize_layers(layers)
+        prefixes = self.cached_prefixes(t3_conds, seqs, layers=layers)
+        shared_prefix_len = min(len_cond for _, len_cond in seqs) if cfg_weight > 0.0 or prefixes else 0
+
+        # Pad to a common length: (rows, len, dim), with all conditional rows first
+        inputs_embeds, padding_mask = self._pad_between_cond_and_text(seqs)
+        n_real = padding_mask.sum(dim=1)  # (rows,) number of unpadded prefix tokens per row
+        prefix_len = inputs_embeds.size(1)
+        is_padded = bool((n_real < prefix_len).any())
+
+        # Pre-size the kv_cache for the prefix and every token we may generate, so no step needs to re-allocate it.
+        # A compiled step brings its own (reused) cache.
+        analyzer = None
+        if analyze_alignment:
+            assert layers is None or self.hp.alignment_layer_idx in layers, "the alignment layer is skipped"
+            n_speech_prefix = initial_speech_tokens.size(1) + (1 if cfg_weight > 0.0 else 0)
+            analyzer = AlignmentStreamAnalyzer(
+                self.tfmr,
+                text_lens=[torch.atleast_2d(text).size(1) for text in text_tokens],
+                text_end=prefix_len - n_speech_prefix,
+                prefix_len=prefix_len,
+                max_new_tokens=max_new_tokens,
+                alignment_layer_idx=self.hp.alignment_layer_idx,
+                eos_idx=self.hp.stop_speech_token,
+            )
 
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
-            cfg_weight=cfg_weight,
+        compiled_step = None
+        if compile_mode is not None:
+            compiled_step = self._get_compiled_step(
+                N, cfg_weight > 0.0, prefix_len + max_new_tokens, compile_mode, layers=layers
+            )
+            compiled_step.lock.acquire()
+        try:
+            return self._decode(
+                inputs_embeds=inputs_embeds,
+                padding_mask=padding_mask,
+                n_real=n_real,
+                is_padded=is_padded,
+                N=N,
+                shared_prefix_len=shared_prefix_len,
+                prefixes=prefixes,
+                speech_pos_offset=initial_speech_tokens.size(1),
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                min_p=min_p,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                cfg_weight=cfg_weight,
+                cache_implementation=cache_implementation,
+                compiled_step=compiled_step,
+                eos_check_interval=eos_check_interval,
+                budgets=torch.tensor(budgets, device=device) if min(budgets) < max_new_tokens else None,
+                draft_tokens=draft_tokens,
+                layers=layers,
+                analyzer=analyzer,
+                progress_callback=progress_callback,
+                token_callback=token_callback,
+            )
+        finally:
+            if compiled_step is not None:
+                compiled_step.lock.release()
+            if analyzer is not None:
+                analyzer.close()
+
+    def _decode(
+        self,
+        *,
+        inputs_embeds,
+        padding_mask,
+        n_real,
+        is_padded,
+        N,
+        shared_prefix_len,
+        prefixes,
+        speech_pos_offset,
+        max_new_tokens,
+        temperature,
+        min_p,
+        top_p,
+        repetition_penalty,
+        cfg_weight,
+        cache_implementation,
+        compiled_step: Optional["_CompiledStep"],
+        eos_check_interval,
+        budgets: Optional[Tensor],
+        draft_tokens,
+        layers,
+        analyzer: Optional[AlignmentStreamAnalyzer],
+        progress_callback,
+        token_callback,
+    ):
+        "The prefill and decoding loop of `inference_batch`."
+        device = inputs_embeds.device
+        prefix_len = inputs_embeds.size(1)
+
+        # Track the predicted tokens and their counts for the repetition penalty; the count starts with the BOS token.
+        history = TokenHistory(
+            N, max_new_tokens, self.hp.speech_tokens_dict_size, device, initial_token=self.hp.start_speech_token
         )
+        finished = torch.zeros(N, dtype=torch.bool, device=device)
+        lengths = torch.zeros(N, dtype=torch.long, device=device)
+
+        past = DynamicCache()
+        cache_position = torch.arange(prefix_len, device=device)
+        if compiled_step is not None:
+            past = compiled_step.past
+            past.reset()
+        elif cache_implementation == "static":
+            past = StaticCache(
+                config=self.cfg,
+                batch_size=inputs_embeds.size(0),
+                max_cache_len=prefix_len + max_new_tokens,
+                device=device,
+                dtype=inputs_embeds.dtype,
+            )
+        backend = self.backend(layers)
+        decode_step = partial(self._decode_step, backend) if compiled_step is None else compiled_step.fn
+        cfg_weight_t = torch.tensor(float(cfg_weight), device=device)
+
+        # Padding is only masked when present, so that unpadded batches keep SDPA's mask-free causal path
+        attention_mask = None
+        if is_padded:
+            mask_len = past.max_cache_len if isinstance(past, StaticCache) else prefix_len + max_new_tokens
+            attention_mask = torch.ones(inputs_embeds.size(0), mask_len, dtype=torch.long, device=device)
+            attention_mask[:, :prefix_len] = padding_mask
+
+        # ---- Initial Forward Pass (empty kv_cache) ----
+        output = self.prefill(
+            inputs_embeds,
+            past,
+            shared_prefix_len=shared_prefix_len,
+            prefixes=prefixes,
+            layers=layers,
+            position_ids=(padding_mask.cumsum(dim=1) - 1).clamp(min=0),
+            attention_mask=self._step_attention_mask(attention_mask, past, prefix_len),
+        )
+        # Initialize kv_cache with the full context.
+        past = output.past_key_values
+        logits = apply_cfg(output.logits[:, -1, :], cfg_weight_t, N)
+        if analyzer is not None:
+            logits = analyzer.step(logits)
+
+        if draft_tokens > 0:
+            self._decode_speculative(
+                backend=backend,
+                logits=logits,
+                history=history,
+                finished=finished,
+                lengths=lengths,
+                past=past,
+                prefix_len=prefix_len,
+                n_real=n_real,
+                attention_mask=attention_mask,
+                speech_pos_offset=speech_pos_offset,
+                max_new_tokens=max_new_tokens,
+                sampling=dict(temperature=temperature, repetition_penalty=repetition_penalty, min_p=min_p, top_p=top_p),
+                cfg_weight=cfg_weight_t,
+                budgets=budgets,
+                draft_tokens=draft_tokens,
+                progress_callback=progress_callback,
+                token_callback=token_callback,
+            )
+            return [row[None, :n] for row, n in zip(history.tokens, lengths.tolist())]
 
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
+        # Step position counters stay on device, so no step needs a host-to-device copy
+        speech_pos = torch.tensor(speech_pos_offset, device=device)
+        position_ids = n_real[:, None]
+        all_finished = AsyncHostFlag(device)
 
-        self.compiled = False
+        # ---- Generation Loop using kv_cache ----
+        for i in range(max_new_tokens):
+            # Temperature, repetition penalty, min-p / top-p filtering and sampling, fused.
+            next_token = sample_tokens(
+                logits,
+                history.counts,
+                temperature=temperature,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+            )  # shape: (N, 1)
+
+            # Finished rows keep emitting EOS, and don't count towards their length. Rows also finish when they
+            # reach their own budget.
+            next_token = next_token.masked_fill(finished[:, None], self.hp.stop_speech_token)
+            lengths += ~finished
+            finished |= next_token.view(-1) == self.hp.stop_speech_token
+            if budgets is not None:
+                finished |= lengths >= budgets
+
+            history.append(next_token)
+            if progress_callback is not None:
+                progress_callback(i + 1)
+            if token_callback is not None:
+                token_callback(next_token)
+            if i == max_new_tokens - 1:
+                break  # out of budget: the logits of another step would never be sampled
+
+            # Check for EOS token, without waiting for it: finished rows only emit more (trimmed) stop tokens
+            if (i + 1) % eos_check_interval == 0:
+                all_finished.post(finished.all())
+            if all_finished.poll():
+                break
 
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=None,
+            # Forward pass with only the new token and the cached past.
+            cache_position = cache_position[-1:] + 1
+            logits = decode_step(
+                next_token=next_token,
+                speech_pos=speech_pos + i,
+                past=past,
+                cache_position=cache_position,
+                position_ids=position_ids + i,
+                attention_mask=self._step_attention_mask(attention_mask, past, prefix_len + i + 1),
+                cfg_weight=cfg_weight_t,
             )
-            self.patched_model = patched_model
-            self.compiled = True
-
-        # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
-        #     inputs=initial_speech_tokens,
-        #     decoder_cond=embeds,
-        #     bos_token_id=self.hp.start_speech_token,
-        #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
-        #     pad_token_id=self.hp.stop_speech_token,
-        #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
-        #     num_return_sequences=num_return_sequences,
-        #     temperature=temperature,
-        #     min_p=min_p,
-        #     length_penalty=length_penalty,
-        #     repetition_penalty=repetition_penalty,
-        #     do_sample=do_sample,
-        #     # cache_implementation=None if not self.compiled else "static",
-        # )
-
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input if cfg_weight > 0
-        if cfg_weight > 0:
-            inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-        else:
-            inputs_embeds = embeds
+            if compiled_step is not None:
+                logits = logits.clone()  # the output buffer of a CUDA graph is overwritten by its next replay
+            if analyzer is not None:
+                logits = analyzer.step(logits)
 
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
+        # Split the rows of the predicted tokens, shape: (N, num_tokens)
+        return [row[None, :n] for row, n in zip(history.tokens, lengths.tolist())]
 
-        # Instantiate the logits processors.
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+    def _decode_speculative(
+        self,
+        *,
+        backend: T3HuggingfaceBackend,
+        logits,
+        history: TokenHistory,
+        finished,
+        lengths,
+        past,
+        prefix_len,
+        n_real,
+        attention_mask,
+        speech_pos_offset,
+        max_new_tokens,
+        sampling,
+        cfg_weight,
+        budgets,
+        draft_tokens,
+        progress_callback,
+        token_callback,
+    ):
+        """
+        The decoding loop of `_decode` with speculative decoding, filling `history`, `finished` and `lengths`.
 
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
+        Each forward pass feeds the last sampled token followed by up to `draft_tokens` drafted ones, and returns
+        the logits after each of them. Tokens are then sampled from these logits in order, exactly as the plain
+        loop would, and as long as every row samples its drafted token, the logits after it are valid for the next
+        one. The first token that doesn't match a draft (or the one after the last draft) is fed by the next pass.
+        """
+        N = finished.size(0)
+        stop = self.hp.stop_speech_token
+        drafts = [NGramDraft() for _ in range(N)]
+
+        def emit(logits):
+            "Samples, records and returns (N, 1) tokens, and their host copy"
+            token = sample_tokens(logits, history.counts, **sampling)
+            token = token.masked_fill(finished[:, None], stop)
+            lengths.add_(~finished)
+            finished.logical_or_(token.view(-1) == stop)
+            if budgets is not None:
+                finished.logical_or_(lengths >= budgets)
+            history.append(token)
+            if progress_callback is not None:
+                progress_callback(history.length)
+            if token_callback is not None:
+                token_callback(token)
+            token_list = token.view(-1).tolist()
+            for draft, t in zip(drafts, token_list):
+                draft.append(t)
+            return token, token_list
+
+        token, token_list = emit(logits)
+        while history.length < max_new_tokens and not all(t == stop for t in token_list):
+            n_fed = history.length - 1  # tokens fed to the model so far, i.e. all but `token`
+            proposals = [draft.propose(min(draft_tokens, max_new_tokens - history.length - 1)) for draft in drafts]
+            k = max(map(len, proposals))
+            fed = torch.tensor([p + [stop] * (k - len(p)) for p in proposals], dtype=torch.long, device=token.device)
+            step_logits = self._verify_step(
+                backend,
+                tokens=torch.cat([token, fed.view(N, k)], dim=1),
+                speech_pos=speech_pos_offset + n_fed,
+                past=past,
+                cache_position=torch.arange(prefix_len + n_fed, prefix_len + n_fed + k + 1, device=token.device),
+                position_ids=n_real[:, None] + n_fed + torch.arange(k + 1, device=token.device),
+                attention_mask=self._step_attention_mask(attention_mask, past, prefix_len + n_fed + k + 1),
+                cfg_weight=cfg_weight,
+            )  # (N, k + 1, vocab)
+            for j in range(k + 1):
+                token, token_list = emit(step_logits[:, j])
+                # finished rows don't care what was fed after their stop token
+                if j == k or not all(t == stop or (j < len(p) and t == p[j]) for t, p in zip(token_list, proposals)):
+                    break
+            if isinstance(past, DynamicCache):
+                past.crop(prefix_len + n_fed + j + 1)  # drop the rejected drafts
+
+    def _verify_step(
+        self,
+        backend: T3HuggingfaceBackend,
+        *,
+        tokens: Tensor,
+        speech_pos: int,
+        past,
+        cache_position: Tensor,
+        position_ids: Tensor,
+        attention_mask: Optional[Tensor],
+        cfg_weight: Tensor,
+    ):
+        "As `_decode_step` for (N, T) tokens from speech position `speech_pos` on, returning (N, T, vocab) logits."
+        speech_pos = torch.arange(speech_pos, speech_pos + tokens.size(1), device=tokens.device)
+        embeds = self.speech_emb(tokens) + self.speech_pos_emb.get_fixed_embedding(speech_pos)
+        N = tokens.size(0)
+        if position_ids.size(0) > N:  # CFG rows
+            embeds = torch.cat([embeds, embeds])
+
+        output = backend(
+            inputs_embeds=embeds,
+            past_key_values=past,
             return_dict=True,
+            cache_position=cache_position,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
         )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
+        return apply_cfg(output.logits, cfg_weight, N)
 
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits = output.logits[:, -1, :]
+    @torch.inference_mode()
+    def prefill(
+        self,
+        inputs_embeds: Tensor,
+        past,
+        *,
+        shared_prefix_len=0,
+        prefixes: Optional[List[DynamicCache]]=None,
+        layers: Optional[Sequence[int]]=None,
+        position_ids: Optional[Tensor]=None,
+        attention_mask: Optional[Tensor]=None,
+    ):
+        """
+        Runs the (rows, len, dim) decoding prefix through the transformer, filling the empty cache `past`.
 
-            # CFG
-            if cfg_weight > 0.0:
-                logits_cond = logits[0:1]
-                logits_uncond = logits[1:2]
-                logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
+        The first `shared_prefix_len` positions, i.e. (part of) the conditioning, don't go through the transformer
+        with the rest: their cache is taken from `prefixes`, the cached conditioning of each utterance (see
+        `cached_prefixes`), if given. Otherwise they must be shared by the two halves of CFG rows: the first half is
+        conditional and the second half unconditional, and both only differ by their text (zeroed for the
+        unconditional rows), so the conditioning is computed for the first half only and copied to the second half.
 
-            logits = logits.squeeze(1)
+        `layers` selects the transformer layers to run, see `backend`.
+        """
+        backend = self.backend(layers)
+        start = 0
+        cache_position = torch.arange(inputs_embeds.size(1), device=inputs_embeds.device)
+        if position_ids is None:
+            position_ids = cache_position[None].expand(inputs_embeds.size(0), -1)
+        if shared_prefix_len > 0:
+            start = shared_prefix_len
+            if prefixes is None:
+                N = inputs_embeds.size(0) // 2
+                shared = self._prefix_kv(inputs_embeds[:N, :start], position_ids[:N, :start], layers=layers)
+                _copy_into_cache(past, [shared], start, n_copies=2)
+            else:
+                _copy_into_cache(past, prefixes, start, n_copies=inputs_embeds.size(0) // len(prefixes))
+
+        return backend(
+            inputs_embeds=inputs_embeds[:, start:],
+            past_key_values=past,
+            use_cache=True,
+            return_dict=True,
+            cache_position=cache_position[start:],
+            position_ids=position_ids[:, start:],
+            attention_mask=attention_mask,
+        )
 
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
+    def _prefix_kv(self, inputs_embeds: Tensor, position_ids: Optional[Tensor]=None, layers=None) -> DynamicCache:
+        "The cache of a (rows, len, dim) prefix; only the cache is needed, so this skips the speech head."
+        return self.backend(layers).model(
+            inputs_embeds=inputs_embeds,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            return_dict=True,
+            position_ids=position_ids,
+        ).past_key_values
 
-            # Apply repetition penalty and top‑p filtering.
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = min_p_warper(None, logits)
-            logits = top_p_warper(None, logits)
+    @torch.inference_mode()
+    def cached_prefixes(
+        self, t3_conds: List[T3Cond], seqs, layers: Optional[Sequence[int]]=None
+    ) -> Optional[List[DynamicCache]]:
+        """
+        The cache of the conditioning prefix of each utterance, looked up in `prefix_cache` by voice and
+        exaggeration (see `PrefixKVCache.fingerprint`), and computed and stored on a miss. None without a prefix
+        cache.
 
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
+        :param seqs: the (embeddings, conditioning length) of each utterance, from `prepare_inference_embeds`.
+        """
+        if self.prefix_cache is None:
+            return None
+        prefixes = []
+        for t3_cond, (embeds, len_cond) in zip(t3_conds, seqs):
+            key = (self.prefix_cache.fingerprint(t3_cond), embeds.dtype, embeds.device, self._normalize_layers(layers))
+            prefix = self.prefix_cache.get(key)
+            if prefix is None:
+                prefix = self._prefix_kv(embeds[:1, :len_cond], layers=layers)
+                self.prefix_cache.put(key, prefix)
+            prefixes.append(prefix)
+        return prefixes
+
+    def _decode_step(
+        self,
+        backend: T3HuggingfaceBackend,
+        *,
+        next_token: Tensor,
+        speech_pos: Tensor,
+        past,
+        cache_position: Tensor,
+        position_ids: Tensor,
+        attention_mask: Optional[Tensor],
+        cfg_weight: Tensor,
+    ):
+        """
+        One decoding step: embeds the (N, 1) sampled tokens at speech position `speech_pos` (a 0-dim tensor, so
+        that compiled steps don't specialize on it), feeds them to every row of the batch, and returns the
+        CFG-mixed (N, vocab) logits of the next token.
+        """
+        next_token_embed = self.speech_emb(next_token) + self.speech_pos_emb.get_fixed_embedding(speech_pos)
+        N = next_token.size(0)
+        if position_ids.size(0) > N:  # CFG rows
+            next_token_embed = torch.cat([next_token_embed, next_token_embed])
+
+        output = backend(
+            inputs_embeds=next_token_embed,
+            past_key_values=past,
+            return_dict=True,
+            cache_position=cache_position,
+            position_ids=position_ids,
+            attention_mask=attention_mask,
+        )
+        return apply_cfg(output.logits[:, -1, :], cfg_weight, N)
 
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
+    def _get_compiled_step(self, N: int, cfg: bool, min_cache_len: int, compile_mode: str, layers=None):
+        """
+        The compiled decode step for N utterances, with its static KV cache. The cache length is rounded up, so
+        that close utterance lengths share one compiled graph; a longer utterance replaces the step with a bigger
+        one (and compiles it again). Past `max_compiled_steps` keys, the least recently used step is dropped (a call
+        still running it keeps it until it returns).
+        """
+        key = (N, cfg, compile_mode, layers)
+        with self._compiled_steps_lock:
+            step = self._compiled_steps.get(key)
+            if step is not None:
+                self._compiled_steps.move_to_end(key)
+            if step is None or step.past.max_cache_len < min_cache_len:
+                past = StaticCache(
+                    config=self.cfg,
+                    batch_size=N * (2 if cfg else 1),
+                    max_cache_len=-(-min_cache_len // COMPILED_CACHE_LEN_MULTIPLE) * COMPILED_CACHE_LEN_MULTIPLE,
+                    device=self.device,
+                    dtype=self.speech_emb.weight.dtype,
+                )
+                fn = torch.compile(partial(self._decode_step, self.backend(layers)), mode=compile_mode, dynamic=False)
+                step = _CompiledStep(fn=fn, past=past, lock=threading.Lock())
+                self._compiled_steps[key] = step
+                while len(self._compiled_steps) > self.max_compiled_steps:
+                    self._compiled_steps.popitem(last=False)
+            return step
+
+    def prepare_inference_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        initial_speech_tokens: Optional[Tensor]=None,
+        cfg_weight: float = 0.0,
+    ):
+        """
+        Embeds the decoding prefix of a single utterance: [cond | text | speech], as (1, len, dim), or as
+        (2, len, dim) conditional / unconditional rows for CFG (which also get a second BOS token).
 
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                break
+        Returns the embeddings and the conditioning length.
+        """
+        device = self.device
+        n_rows = 2 if cfg_weight > 0.0 else 1
+        if initial_speech_tokens is None:
+            initial_speech_tokens = torch.tensor([[self.hp.start_speech_token]], device=device)
+        initial_speech_tokens = torch.atleast_2d(initial_speech_tokens).to(dtype=torch.long, device=device)
 
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+        text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=device)
+        _ensure_BOT_EOT(text_tokens[:1], self.hp)
+        embeds, len_cond = self.prepare_input_embeds(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens[:1].expand(n_rows, -1),
+            speech_tokens=initial_speech_tokens[:1].expand(n_rows, -1),
+            cfg_weight=cfg_weight,
+        )
 
-            #  For CFG
-            if cfg_weight > 0.0:
-                next_token_embed = torch.cat([next_token_embed, next_token_embed])
+        # CFG rows get a second BOS token
+        if cfg_weight > 0.0:
+            bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
+            bos_embed = self.speech_emb(bos_token)  # shape: (1, 1, embed_dim)
+            bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
+            embeds = torch.cat([embeds, bos_embed.expand(n_rows, -1, -1)], dim=1)
+        return embeds, len_cond
 
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
-            )
-            # Update the kv_cache.
-            past = output.past_key_values
+    def _pad_between_cond_and_text(self, seqs):
+        """
+        Stacks per-utterance (n_rows, len_i, dim) embeddings into (n_rows * N, len, dim), ordered with the n-th
+        row of every utterance in the n-th block of N. Shorter sequences are padded right after their conditioning,
+        so the conditioning prefix stays at the start of the cache and all text / speech tokens are right-aligned.
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+        Returns the padded embeddings, and a (n_rows * N, len) padding mask (1 = real token, 0 = padding).
+        """
+        length = max(embeds.size(1) for embeds, _ in seqs)
+        n_rows = seqs[0][0].size(0)
+        padded, masks = [], []
+        for r in range(n_rows):
+            for embeds, len_cond in seqs:
+                embeds = embeds[r]
+                pad = length - embeds.size(0)
+                padded.append(torch.cat([embeds[:len_cond], embeds.new_zeros(pad, embeds.size(1)), embeds[len_cond:]]))
+                mask = torch.ones(length, dtype=torch.long, device=embeds.device)
+                mask[len_cond:len_cond + pad] = 0
+                masks.append(mask)
+        return torch.stack(padded), torch.stack(masks)
+
+    @staticmethod
+    def _step_attention_mask(attention_mask, past, length):
+        "The 2D mask covers the whole static cache, or only the tokens seen so far with a dynamic cache."
+        if attention_mask is None or isinstance(past, StaticCache):
+            return attention_mask
+        return attention_mask[:, :length]
@@ -0,0 +1,80 @@
+"""
+Converts a T3 checkpoint to weight-only int8 / int4, writing `t3_cfg_<int8|int4>.safetensors` next to it for
+`ChatterboxTTS.from_local(..., quantization=...)` to pick up, and optionally checks it against the fp32 model (on
+CPU, int8 is also checked with activation quantization, see `set_activation_quantization`).
+
+    python -m chatterbox.quantize --bits 8 --check                # the Hugging Face checkpoint
+    python -m chatterbox.quantize --ckpt-dir ckpt --bits 4 --group-size 128 --check
+"""
+import argparse
+from pathlib import Path
+
+import torch
+import torch.nn.functional as F
+from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
+
+from .benchmarking import EVAL_TEXTS
+from .models.t3 import T3
+from .models.t3.quantization import compare_t3, quantize_t3, save_quantized_t3, set_activation_quantization
+from .models.tokenizers import EnTokenizer
+from .tts import REPO_ID, Conditionals, punc_norm
+
+
+def check(reference: T3, quantized: T3, ckpt_dir: Path, device):
+    "Prints the agreement of the quantized model with the reference on `EVAL_TEXTS`, in the built-in voice."
+    tokenizer = EnTokenizer(str(ckpt_dir / "tokenizer.json"))
+    t3_cond = Conditionals.load(ckpt_dir / "conds.pt", map_location="cpu").to(device).t3
+    hp = reference.hp
+    for text in EVAL_TEXTS:
+        text_tokens = tokenizer.text_to_tokens(punc_norm(text)).to(device)
+        text_tokens = F.pad(text_tokens, (1, 0), value=hp.start_text_token)
+        text_tokens = F.pad(text_tokens, (0, 1), value=hp.stop_text_token)
+        stats = compare_t3(reference, quantized, t3_cond, text_tokens)
+        print(
+            f"top-1 agreement {stats['top1_agreement']:6.1%}  mean KL {stats['mean_kl']:.4f}  "
+            f"({stats['n_tokens']} tokens)  {text!r}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ckpt-dir", help="directory with t3_cfg.safetensors (defaults to the Hugging Face one)")
+    parser.add_argument("--bits", type=int, choices=[8, 4], default=8)
+    parser.add_argument("--group-size", type=int, help="input channels per scale (default: one per output channel)")
+    parser.add_argument("--out", help="output file (default: <ckpt-dir>/t3_cfg_int<bits>.safetensors)")
+    parser.add_argument("--check", action="store_true", help="compare against the fp32 model")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    if args.ckpt_dir is None:
+        for fpath in ["t3_cfg.safetensors", "tokenizer.json", "conds.pt"]:
+            local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
+        ckpt_dir = Path(local_path).parent
+    else:
+        ckpt_dir = Path(args.ckpt_dir)
+    out = Path(args.out) if args.out else ckpt_dir / f"t3_cfg_int{args.bits}.safetensors"
+
+    t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
+    if "model" in t3_state.keys():
+        t3_state = t3_state["model"][0]
+    t3 = T3()
+    t3.load_state_dict(t3_state)
+    quantize_t3(t3, bits=args.bits, group_size=args.group_size)
+    save_quantized_t3(t3, out)
+    print(f"wrote {out} ({out.stat().st_size / 2**20:.0f} MiB)")
+
+    if args.check:
+        reference = T3()
+        reference.load_state_dict(t3_state)
+        reference, t3 = reference.to(args.device).eval(), t3.to(args.device).eval()
+        print("weight-only:")
+        check(reference, t3, ckpt_dir, args.device)
+        if args.device == "cpu" and args.bits == 8 and args.group_size is None:
+            # the opt-in fbgemm path also quantizes the activations, so it gets its own check
+            print("int8 weights and activations (fbgemm):")
+            check(reference, set_activation_quantization(t3, True), ckpt_dir, args.device)
+
+
+if __name__ == "__main__":
+    main()
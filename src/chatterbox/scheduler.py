@@ -0,0 +1,151 @@
+import threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+import torch
+
+from .audio_editing import splice_audios
+from .models.t3.inference.scheduler import T3BatchScheduler
+from .tts import ChatterboxTTS, Conditionals, chunk_text
+
+
+def _resolve(future: Future, result=None, exception=None):
+    "Resolves `future`, unless its caller already cancelled it."
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class TTSScheduler:
+    """
+    Serves concurrent requests on one `ChatterboxTTS` model.
+
+    Speech tokens of all in-flight requests are decoded together by a `T3BatchScheduler`, which admits new
+    requests into the running T3 batch at token boundaries. As soon as a request emits its stop token, its tokens
+    are handed off to S3Gen on a separate worker thread, so vocoding overlaps with the decoding of the others; the
+    requests that finish while S3Gen is busy are vocoded together, in one batch (see `S3Gen.inference_batch`).
+
+    Usage:
+        with TTSScheduler(model) as scheduler:
+            futures = [scheduler.submit(text) for text in texts]  # e.g. from several server threads
+            wavs = [f.result() for f in futures]
+    """
+
+    def __init__(self, model: ChatterboxTTS, max_rows=8, max_len=2048, max_vocoder_batch=8):
+        """
+        :param model: the model to serve; its `t3` and `s3gen` must not be used elsewhere while serving.
+        :param max_rows: T3 batch capacity, in rows. A request with CFG takes two rows.
+        :param max_len: per-row KV cache length; must fit conditioning + text + `max_new_tokens`.
+        :param max_vocoder_batch: maximum number of requests vocoded in one S3Gen batch.
+        """
+        self.model = model
+        self.t3_scheduler = T3BatchScheduler(model.t3, max_rows=max_rows, max_len=max_len)
+        self.max_vocoder_batch = max_vocoder_batch
+        self._vocoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="s3gen")
+        # (speech tokens, ref dict, (s3gen_steps, s3gen_solver), wav future) of the requests waiting for S3Gen
+        self._to_vocode = []
+        self._to_vocode_lock = threading.Lock()
+
+    def submit(
+        self,
+        text,
+        conds: Conditionals = None,
+        audio_prompt_path=None,
+        exaggeration=None,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        cfg_weight=0.5,
+        temperature=0.8,
+        max_new_tokens=None,
+        s3gen_steps=10,
+        s3gen_solver=None,
+    ) -> Future:
+        """
+        Queues a single segment of text (no chunking), and returns a future of its (1, L) waveform.
+        The voice is `audio_prompt_path`'s if given, else `conds`, else the model's prepared conditionals (see
+        `ChatterboxTTS.request_conditionals`). `max_new_tokens` defaults to a budget predicted
+        from the text length (see `ChatterboxTTS.length_model`), so that short requests hold their batch slot for
+        a bounded number of steps even if they miss their stop token. `s3gen_steps` and `s3gen_solver` are S3Gen's
+        ODE steps and solver, see `ChatterboxTTS.generate_batch`.
+        """
+        conds = self.model.request_conditionals(conds, audio_prompt_path, exaggeration)
+
+        text_tokens = self.model._tokenize(text)
+        tokens_future = self.t3_scheduler.submit(
+            conds.t3,
+            text_tokens,
+            max_new_tokens=max_new_tokens or self.model.length_model.budget(text_tokens.size(1)),
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+        )
+
+        wav_future = Future()
+
+        def hand_off(f: Future):
+            if f.cancelled():
+                wav_future.cancel()
+            elif f.exception() is not None:
+                _resolve(wav_future, exception=f.exception())
+            elif not wav_future.cancelled():
+                with self._to_vocode_lock:
+                    self._to_vocode.append((f.result(), conds.gen, (s3gen_steps, s3gen_solver), wav_future))
+                self._vocoder.submit(self._vocode_waiting)
+
+        tokens_future.add_done_callback(hand_off)
+        return wav_future
+
+    def _vocode_waiting(self):
+        "Vocodes the requests handed off since the last call, in batches of the same S3Gen settings."
+        with self._to_vocode_lock:
+            waiting, self._to_vocode = self._to_vocode, []
+        by_settings = {}
+        for request in waiting:
+            if request[-1].cancelled():
+                continue
+            by_settings.setdefault(request[2], []).append(request)
+
+        for (s3gen_steps, s3gen_solver), requests in by_settings.items():
+            for start in range(0, len(requests), self.max_vocoder_batch):
+                batch = requests[start:start + self.max_vocoder_batch]
+                try:
+                    wavs = self.model._vocode_batch(
+                        [speech_tokens for speech_tokens, *_ in batch],
+                        [ref_dict for _, ref_dict, *_ in batch],
+                        s3gen_steps=s3gen_steps,
+                        s3gen_solver=s3gen_solver,
+                    )
+                except Exception as e:
+                    for *_, wav_future in batch:
+                        _resolve(wav_future, exception=e)
+                    continue
+                for (*_, wav_future), wav in zip(batch, wavs):
+                    _resolve(wav_future, wav)
+
+    def generate(self, text, chunk_size: int = 300, **kwargs):
+        """
+        Blocking counterpart of `ChatterboxTTS.generate`. Long texts are split in ``chunk_size`` character chunks,
+        which are all decoded concurrently.
+        """
+        if len(text) <= chunk_size:
+            return self.submit(text, **kwargs).result()
+
+        futures = [self.submit(chunk, **kwargs) for chunk in chunk_text(text, chunk_size)]
+        merged = splice_audios([f.result().squeeze(0).cpu().numpy() for f in futures])
+        return torch.from_numpy(merged).unsqueeze(0)
+
+    def close(self):
+        self.t3_scheduler.close()
+        self._vocoder.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,5 +1,13 @@
-from dataclasses import dataclass
+import copy
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from dataclasses import dataclass, replace
 from pathlib import Path
+from typing import Iterator, List, Optional
 
 import librosa
 import torch
@@ -15,6 +23,9 @@ from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.prefix_cache import PrefixKVCache
+from .models.t3.inference.length_model import SpeechLengthModel
+from .models.t3.quantization import QUANTIZATION_BITS, load_quantized_t3, quantize_t3
 from .audio_editing import splice_audios
 
 
@@ -109,6 +120,118 @@ class Conditionals:
         kwargs = torch.load(fpath, map_location=map_location, weights_only=True)
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
+    def with_exaggeration(self, exaggeration) -> "Conditionals":
+        "A copy of these conditionals with another exaggeration; the tensors are shared."
+        device = self.t3.speaker_emb.device
+        return Conditionals(
+            replace(self.t3, emotion_adv=exaggeration * torch.ones(1, 1, 1, device=device)),
+            dict(self.gen),
+        )
+
+
+class ConditionalsCache:
+    """
+    `Conditionals` of recently used voice prompts, so that requests with a reference clip seen before skip feature
+    extraction (loading and resampling, S3Gen's reference embedding, S3 tokenization, voice encoder).
+
+    Entries are keyed on a hash of the clip's bytes and the exaggeration (see `key`), in an in-memory LRU, and, if
+    `cache_dir` is given, in `Conditionals.save` files there, which survive restarts and are shared by processes.
+
+    NOTE: entries are only valid for the checkpoint that computed them; use one `cache_dir` per checkpoint.
+    """
+
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._entries: "OrderedDict[str, Conditionals]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(wav_fpath, exaggeration) -> str:
+        "A digest of the audio file's content (not its path), and the exaggeration."
+        digest = hashlib.sha1(Path(wav_fpath).read_bytes()).hexdigest()
+        return f"{digest}-{float(exaggeration)!r}"
+
+    def _fpath(self, key):
+        return self.cache_dir / f"{key}.pt"
+
+    def get(self, key: str, map_location="cpu") -> Optional[Conditionals]:
+        """
+        The cached conditionals, or None. They are a copy, so callers may replace their fields; the tensors are
+        shared.
+        """
+        with self._lock:
+            conds = self._entries.get(key)
+            if conds is not None:
+                self._entries.move_to_end(key)
+        if conds is None and self.cache_dir is not None and self._fpath(key).exists():
+            conds = Conditionals.load(self._fpath(key), map_location=map_location)
+            self._remember(key, conds)
+        if conds is None:
+            return None
+        return Conditionals(copy.copy(conds.t3), dict(conds.gen))
+
+    def put(self, key: str, conds: Conditionals):
+        conds = Conditionals(copy.copy(conds.t3), dict(conds.gen))
+        self._remember(key, conds)
+        if self.cache_dir is not None:
+            # write then rename, so that concurrent readers never see a partial file
+            tmp_fpath = self._fpath(key).with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            conds.save(tmp_fpath)
+            os.replace(tmp_fpath, self._fpath(key))
+
+    def _remember(self, key, conds):
+        with self._lock:
+            self._entries[key] = conds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        "Empties the in-memory cache; files in `cache_dir` are kept."
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+@dataclass
+class SegmentMetadata:
+    """
+    How T3 decoded one segment of text.
+
+    - n_text_tokens: length of the tokenized text, including start / stop tokens
+    - max_new_tokens: the speech token budget, predicted from the text length (see `SpeechLengthModel`)
+    - n_speech_tokens: number of speech tokens decoded
+    - stopped: whether T3 emitted its stop token, i.e. didn't run out of budget
+    """
+    n_text_tokens: int
+    max_new_tokens: int
+    n_speech_tokens: int
+    stopped: bool
+
+
+@dataclass
+class AudioChunk:
+    """
+    A block of audio of `ChatterboxTTS.generate_stream`.
+
+    - wav: (1, L) watermarked waveform, at `ChatterboxTTS.sr`
+    - start, end: its time span in the utterance, in seconds
+    - segment: index of the text chunk it belongs to (see `chunk_text`)
+    """
+    wav: torch.Tensor
+    start: float
+    end: float
+    segment: int
+
+
+class _StreamClosed(Exception):
+    "Stops the T3 decoding of a stream whose consumer went away."
+
 
 class ChatterboxTTS:
     ENC_COND_LEN = 6 * S3_SR
@@ -125,15 +248,33 @@ class ChatterboxTTS:
     ):
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
+        if self.t3.prefix_cache is None:
+            # repeated calls with the same voice skip re-running its conditioning through T3
+            self.t3.prefix_cache = PrefixKVCache()
+        # budgets `max_new_tokens` from the text length
+        self.length_model = SpeechLengthModel(max_tokens=self.t3.hp.max_speech_tokens)
         self.s3gen = s3gen
         self.ve = ve
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        # conditionals of recent voice prompts, by content; set `ConditionalsCache(cache_dir=...)` to persist them
+        self.conds_cache = ConditionalsCache()
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(cls, ckpt_dir, device, quantization=None, dtype=torch.float32) -> 'ChatterboxTTS':
+        """
+        Parameters
+        ----------
+        quantization : {None, "int8", "int4"}
+            Weight-only quantization of T3's transformer and speech head. Loads `t3_cfg_<quantization>.safetensors`
+            if it was converted offline (``python -m chatterbox.quantize``), otherwise quantizes the fp32 weights.
+        dtype : torch.dtype
+            Precision of T3, the flow decoder and HiFT, e.g. ``torch.bfloat16``. The voice encoder, the S3 tokenizer,
+            mel extraction, HiFT's F0 predictor and sine source, the iSTFT and sampling stay in fp32, see
+            `S3Gen.cast`.
+        """
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -148,17 +289,24 @@ class ChatterboxTTS:
         )
         ve.to(device).eval()
 
-        t3 = T3()
-        t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
-        if "model" in t3_state.keys():
-            t3_state = t3_state["model"][0]
-        t3.load_state_dict(t3_state)
-        t3.to(device).eval()
+        assert quantization in (None, *QUANTIZATION_BITS), f"unknown {quantization=}"
+        if quantization is not None and (quantized_ckpt := ckpt_dir / f"t3_cfg_{quantization}.safetensors").exists():
+            t3 = load_quantized_t3(quantized_ckpt)
+        else:
+            t3 = T3()
+            t3_state = load_file(ckpt_dir / "t3_cfg.safetensors")
+            if "model" in t3_state.keys():
+                t3_state = t3_state["model"][0]
+            t3.load_state_dict(t3_state)
+            if quantization is not None:
+                quantize_t3(t3, bits=QUANTIZATION_BITS[quantization])
+        t3.to(device=device, dtype=dtype).eval()
 
         s3gen = S3Gen()
         s3gen.load_state_dict(
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
+        s3gen.cast(dtype)
         s3gen.to(device).eval()
 
         tokenizer = EnTokenizer(
@@ -172,7 +320,7 @@ class ChatterboxTTS:
         return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(cls, device, quantization=None, dtype=torch.float32) -> 'ChatterboxTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -184,33 +332,75 @@ class ChatterboxTTS:
         for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, quantization=quantization, dtype=dtype)
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
-        ## Load reference wav
-        s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
-
-        ref_16k_wav = librosa.resample(s3gen_ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
-
-        s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
-
-        # Speech cond prompt tokens
-        if plen := self.t3.hp.speech_cond_prompt_len:
-            s3_tokzr = self.s3gen.tokenizer
-            t3_cond_prompt_tokens, _ = s3_tokzr.forward([ref_16k_wav[:self.ENC_COND_LEN]], max_len=plen)
-            t3_cond_prompt_tokens = torch.atleast_2d(t3_cond_prompt_tokens).to(self.device)
-
-        # Voice-encoder speaker embedding
-        ve_embed = torch.from_numpy(self.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR))
-        ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
-
-        t3_cond = T3Cond(
-            speaker_emb=ve_embed,
-            cond_prompt_speech_tokens=t3_cond_prompt_tokens,
-            emotion_adv=exaggeration * torch.ones(1, 1, 1),
-        ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        "Sets the voice of the next generations to the one of the reference clip `wav_fpath`."
+        self.conds = self.get_conditionals(wav_fpath, exaggeration=exaggeration)
+
+    def get_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
+        "The `Conditionals` of a reference clip, from `conds_cache` if it was seen before."
+        key = self.conds_cache.key(wav_fpath, exaggeration)
+        conds = self.conds_cache.get(key, map_location=self.device)
+        if conds is None:
+            conds = self._compute_conditionals(wav_fpath, exaggeration)
+            self.conds_cache.put(key, conds)
+        return conds
+
+    def _compute_conditionals(self, wav_fpath, exaggeration) -> Conditionals:
+        return self.compute_conditionals([wav_fpath], exaggeration=exaggeration)[0]
+
+    def compute_conditionals(self, wav_fpaths, exaggeration=0.5, batch_size=16) -> List[Conditionals]:
+        """
+        The `Conditionals` of each reference clip of `wav_fpaths`, bypassing `conds_cache`, e.g. to enroll voices
+        in a `VoiceRegistry`. The S3 tokenizer and the voice encoder process `batch_size` clips at a time, S3Gen's
+        reference embedding one clip at a time.
+        """
+        all_conds = []
+        for start in range(0, len(wav_fpaths), batch_size):
+            ## Load reference wavs
+            s3gen_ref_wavs = [librosa.load(fpath, sr=S3GEN_SR)[0] for fpath in wav_fpaths[start:start + batch_size]]
+            ref_16k_wavs = [librosa.resample(wav, orig_sr=S3GEN_SR, target_sr=S3_SR) for wav in s3gen_ref_wavs]
+
+            # Speech cond prompt tokens
+            all_prompt_tokens = [None] * len(ref_16k_wavs)
+            if plen := self.t3.hp.speech_cond_prompt_len:
+                s3_tokzr = self.s3gen.tokenizer
+                prompt_tokens, prompt_token_lens = s3_tokzr.forward(
+                    [wav[:self.ENC_COND_LEN] for wav in ref_16k_wavs], max_len=plen
+                )
+                all_prompt_tokens = [
+                    tokens[None, :n].to(self.device) for tokens, n in zip(prompt_tokens, prompt_token_lens.tolist())
+                ]
+
+            # Voice-encoder speaker embeddings, one per clip
+            ve_embeds = torch.from_numpy(self.ve.embeds_from_wavs(ref_16k_wavs, sample_rate=S3_SR))
+
+            for s3gen_ref_wav, prompt_tokens, ve_embed in zip(s3gen_ref_wavs, all_prompt_tokens, ve_embeds):
+                s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
+                s3gen_ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+
+                t3_cond = T3Cond(
+                    speaker_emb=ve_embed[None].to(self.device),
+                    cond_prompt_speech_tokens=prompt_tokens,
+                    emotion_adv=exaggeration * torch.ones(1, 1, 1),
+                ).to(device=self.device)
+                all_conds.append(Conditionals(t3_cond, s3gen_ref_dict))
+        return all_conds
+
+    def request_conditionals(self, conds: Conditionals=None, audio_prompt_path=None, exaggeration=0.5) -> Conditionals:
+        """
+        The voice of one request: the one of `audio_prompt_path` if given, else `conds`, else the prepared
+        `self.conds`, with `exaggeration` (None keeps the one of `conds`, 0.5 for `audio_prompt_path`). Nothing is
+        mutated, so that requests can run concurrently.
+        """
+        if audio_prompt_path:
+            return self.get_conditionals(audio_prompt_path, exaggeration=0.5 if exaggeration is None else exaggeration)
+        conds = self.conds if conds is None else conds
+        assert conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path` or `conds`"
+        if exaggeration is not None and exaggeration != conds.t3.emotion_adv[0, 0, 0]:
+            conds = conds.with_exaggeration(exaggeration)
+        return conds
 
     def _generate_segment(
         self,
@@ -218,71 +408,347 @@ class ChatterboxTTS:
         repetition_penalty=1.2,
         min_p=0.05,
         top_p=1.0,
+        conds=None,
         audio_prompt_path=None,
         exaggeration=0.5,
         cfg_weight=0.5,
         temperature=0.8,
+        compile_mode=None,
+        draft_tokens=0,
+        t3_depth=1.0,
+        analyze_alignment=False,
+        max_new_tokens=None,
+        s3gen_steps=10,
+        s3gen_solver=None,
     ):
-        if audio_prompt_path:
-            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
-        else:
-            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
-
-        # Update exaggeration if needed
-        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
-
-        # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+        "Synthesizes one segment, returning its (1, L) waveform and `SegmentMetadata`"
+        conds = self.request_conditionals(conds, audio_prompt_path, exaggeration)
 
-        if cfg_weight > 0.0:
-            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
-
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        text_tokens = self._tokenize(text)  # T3 adds the unconditional CFG row itself
+        max_new_tokens = max_new_tokens or self.length_model.budget(text_tokens.size(1))
 
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
+                t3_cond=conds.t3,
                 text_tokens=text_tokens,
-                max_new_tokens=1000,  # TODO: use the value in config
+                max_new_tokens=max_new_tokens,
                 temperature=temperature,
                 cfg_weight=cfg_weight,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                compile_mode=compile_mode,
+                draft_tokens=draft_tokens,
+                layers=self.t3.layers_for_depth(t3_depth),
+                analyze_alignment=analyze_alignment,
             )
-            # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
+            metadata = self._segment_metadata(text_tokens, max_new_tokens, speech_tokens)
+            wav = self._vocode(speech_tokens, conds.gen, s3gen_steps=s3gen_steps, s3gen_solver=s3gen_solver)
+            return wav, metadata
+
+    def _segment_metadata(self, text_tokens, max_new_tokens, speech_tokens):
+        n_speech_tokens = speech_tokens.size(1)
+        return SegmentMetadata(
+            n_text_tokens=text_tokens.size(1),
+            max_new_tokens=max_new_tokens,
+            n_speech_tokens=n_speech_tokens,
+            stopped=n_speech_tokens > 0 and speech_tokens[0, -1].item() == self.t3.hp.stop_speech_token,
+        )
 
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            
-            speech_tokens = speech_tokens[speech_tokens < 6561]
+    def _tokenize(self, text):
+        "Norm and tokenize text, adding start / stop text tokens: (1, T)"
+        text = punc_norm(text)
+        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
 
-            speech_tokens = speech_tokens.to(self.device)
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
+        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
-            )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+    def _valid_speech_tokens(self, speech_tokens):
+        "The S3Gen tokens of T3 speech tokens (1, T), 1D"
+        # Extract only the conditional batch.
+        speech_tokens = speech_tokens[0]
+
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+
+        speech_tokens = speech_tokens[speech_tokens < 6561]
+
+        return speech_tokens.to(self.device)
+
+    def _watermark(self, wav):
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
         return torch.from_numpy(watermarked_wav).unsqueeze(0)
 
+    @torch.inference_mode()
+    def _vocode(self, speech_tokens, ref_dict, s3gen_steps=10, s3gen_solver=None):
+        "T3 speech tokens (1, T) to a watermarked waveform (1, L)"
+        wav, _ = self.s3gen.inference(
+            speech_tokens=self._valid_speech_tokens(speech_tokens),
+            ref_dict=ref_dict,
+            n_timesteps=s3gen_steps,
+            solver=s3gen_solver,
+        )
+        return self._watermark(wav)
+
+    @torch.inference_mode()
+    def _vocode_batch(self, all_speech_tokens, ref_dicts, s3gen_steps=10, s3gen_solver=None):
+        "T3 speech tokens (1, T) of several utterances to their watermarked waveforms (1, L), in one S3Gen batch"
+        wavs = self.s3gen.inference_batch(
+            [self._valid_speech_tokens(speech_tokens) for speech_tokens in all_speech_tokens],
+            ref_dicts,
+            n_timesteps=s3gen_steps,
+            solver=s3gen_solver,
+        )
+        return [self._watermark(wav) for wav in wavs]
+
+    def _decode_stream(self, text_tokens, conds, tokens: queue.Queue, closed: threading.Event, **t3_options):
+        "Decodes the speech tokens of `text_tokens` into `tokens` as they come, then None (or the error)."
+        def put(next_token):
+            if closed.is_set():
+                raise _StreamClosed
+            tokens.put(next_token[0])
+
+        try:
+            self.t3.inference(t3_cond=conds.t3, text_tokens=text_tokens, token_callback=put, **t3_options)
+            tokens.put(None)
+        except _StreamClosed:
+            pass
+        except BaseException as e:
+            tokens.put(e)
+
+    def _stream_segment(
+        self,
+        text,
+        conds,
+        first_chunk_tokens,
+        chunk_tokens,
+        t3_options: dict,
+        max_new_tokens,
+        s3gen_steps,
+        s3gen_solver,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Yields the (1, L) waveform blocks of one segment, not watermarked, while T3 decodes it in a thread with
+        `t3_options` (`T3.inference` arguments).
+        """
+        text_tokens = self._tokenize(text)
+        tokens, closed = queue.Queue(), threading.Event()
+        decoder = threading.Thread(
+            target=self._decode_stream,
+            args=(text_tokens, conds, tokens, closed),
+            kwargs=dict(
+                max_new_tokens=max_new_tokens or self.length_model.budget(text_tokens.size(1)),
+                **t3_options,
+            ),
+            daemon=True,
+        )
+        decoder.start()
+        stream = self.s3gen.stream(conds.gen, n_timesteps=s3gen_steps, solver=s3gen_solver)
+        try:
+            pending, n_chunk = [], first_chunk_tokens
+            while True:
+                token = tokens.get()
+                if isinstance(token, BaseException):
+                    raise token
+                if token is not None:
+                    pending.append(token)
+                if pending and (token is None or len(pending) >= n_chunk):
+                    # the stop token and what follows it aren't S3Gen tokens
+                    chunk = torch.cat(pending).to(self.device)
+                    yield stream.push(chunk[chunk < 6561])
+                    pending, n_chunk = [], chunk_tokens
+                if token is None:
+                    yield stream.flush()
+                    return
+        finally:
+            closed.set()
+            decoder.join()
+
+    def generate_stream(
+        self,
+        text,
+        conds=None,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        first_chunk_tokens: int = 10,
+        chunk_tokens: int = 25,
+        chunk_size: int = 300,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        cfg_weight=0.5,
+        temperature=0.8,
+        compile_mode=None,
+        draft_tokens=0,
+        t3_depth=1.0,
+        analyze_alignment=False,
+        max_new_tokens=None,
+        s3gen_steps=10,
+        s3gen_solver=None,
+    ) -> Iterator[AudioChunk]:
+        """Generate speech from ``text`` block by block, vocoding the speech tokens while T3 decodes the rest.
+
+        T3 decodes in a background thread; every ``chunk_tokens`` speech tokens (25 per second of audio), the
+        audio that became final is synthesized with ``S3Gen.stream``, watermarked and yielded. The audio of the last
+        7 tokens of a block (S3Gen's lookahead, and the cross-faded overlap of HiFT blocks) only comes with the next
+        block. Closing the generator stops the decoding.
+
+        Parameters
+        ----------
+        text : str
+            Text to synthesize. Long texts are processed in ``chunk_size`` character chunks, one after the other.
+        conds, audio_prompt_path, exaggeration
+            The voice, see ``request_conditionals``.
+        first_chunk_tokens : int, optional
+            Speech tokens of the first block of each text chunk. Smaller means sooner first audio, but it needs more
+            than 7. Defaults to 10.
+        chunk_tokens : int, optional
+            Speech tokens of the next blocks. Larger blocks cost fewer S3Gen passes, smaller ones arrive sooner;
+            either way, S3Gen has to keep up with T3 for the audio to be gapless. Defaults to 25.
+        chunk_size : int, optional
+            Size of each text chunk when splitting long text. Defaults to 300.
+        repetition_penalty, min_p, top_p, cfg_weight, temperature
+            T3's sampling options, with the defaults of ``generate``.
+        compile_mode, draft_tokens, t3_depth, analyze_alignment, max_new_tokens, s3gen_steps, s3gen_solver
+            T3 and S3Gen options, see ``generate_batch``.
+
+        Yields
+        ------
+        AudioChunk
+            Watermarked blocks of audio, with their time span in the utterance.
+        """
+        assert first_chunk_tokens > 7 and chunk_tokens > 0
+        conds = self.request_conditionals(conds, audio_prompt_path, exaggeration)
+        t3_options = dict(
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            compile_mode=compile_mode,
+            draft_tokens=draft_tokens,
+            layers=self.t3.layers_for_depth(t3_depth),
+            analyze_alignment=analyze_alignment,
+        )
+        n_samples = 0
+        for segment, segment_text in enumerate(chunk_text(text, chunk_size)):
+            blocks = self._stream_segment(
+                segment_text,
+                conds,
+                first_chunk_tokens,
+                chunk_tokens,
+                t3_options,
+                max_new_tokens=max_new_tokens,
+                s3gen_steps=s3gen_steps,
+                s3gen_solver=s3gen_solver,
+            )
+            with closing(blocks):  # stops its decoding if we are closed
+                for wav in blocks:
+                    if wav.size(1) == 0:
+                        continue
+                    wav = self._watermark(wav)
+                    start = n_samples / self.sr
+                    n_samples += wav.size(1)
+                    yield AudioChunk(wav=wav, start=start, end=n_samples / self.sr, segment=segment)
+
+    def generate_batch(
+        self,
+        texts,
+        conds=None,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        cfg_weight=0.5,
+        temperature=0.8,
+        max_new_tokens=None,
+        compile_mode=None,
+        draft_tokens=0,
+        t3_depth=1.0,
+        analyze_alignment=False,
+        s3gen_steps=10,
+        s3gen_solver=None,
+        return_metadata=False,
+    ):
+        """Generate speech for several ``texts`` at once, decoding their speech tokens in a single T3 batch, and
+        their waveforms in a single S3Gen batch (see ``S3Gen.inference_batch``).
+
+        Parameters
+        ----------
+        texts : list of str
+            Texts to synthesize. Each one is synthesized as a single segment (no chunking).
+        conds : Conditionals or list of Conditionals, optional
+            Voice for every text, or one voice per text. Defaults to the prepared ``self.conds``.
+        max_new_tokens : int, optional
+            Speech token budget of every text. By default, each text gets its own budget, predicted from its
+            length by ``self.length_model``.
+        compile_mode : str, optional
+            ``torch.compile`` mode for the T3 decode step, e.g. ``"reduce-overhead"``. The first call for each
+            batch size compiles it, later ones reuse it. See ``T3.inference_batch``.
+        draft_tokens : int, optional
+            Number of speech tokens to draft per T3 forward pass for speculative decoding; 0 (default) disables
+            it. The output is unchanged, see ``T3.inference_batch``.
+        t3_depth : float, optional
+            Fraction of T3's transformer layers to run, in (0, 1]. Lower is faster, at some cost in quality;
+            see ``benchmarks/eval_t3_depth.py``. Defaults to 1 (all layers).
+        analyze_alignment : bool, optional
+            Watch T3's text-speech alignment to stop hallucinated long tails and repetitions early. See
+            ``T3.inference_batch``.
+        s3gen_steps : int, optional
+            Number of ODE steps of S3Gen's flow matching decoder. Defaults to 10.
+        s3gen_solver : str, optional
+            Its ODE solver: ``"euler"`` (default), ``"midpoint"``, ``"heun"`` or ``"ab2"``. Fewer steps
+            of a second order solver are faster at the same quality, e.g. ``s3gen_steps=5`` with ``"ab2"``;
+            see ``benchmarks/eval_s3gen_solvers.py``.
+        return_metadata : bool, optional
+            Also return a ``SegmentMetadata`` per text, with its speech token budget.
+
+        Returns
+        -------
+        list of torch.Tensor
+            One (1, L) waveform per text, and their list of ``SegmentMetadata`` if ``return_metadata``.
+        """
+        conds = self.conds if conds is None else conds
+        assert conds is not None, "Please `prepare_conditionals` first or specify `conds`"
+        if isinstance(conds, Conditionals):
+            conds = [conds] * len(texts)
+        assert len(conds) == len(texts), "Need one `Conditionals` per text"
+
+        all_text_tokens = [self._tokenize(text) for text in texts]
+        budgets = [max_new_tokens or self.length_model.budget(tokens.size(1)) for tokens in all_text_tokens]
+        with torch.inference_mode():
+            all_speech_tokens = self.t3.inference_batch(
+                t3_conds=[c.t3 for c in conds],
+                text_tokens=all_text_tokens,
+                max_new_tokens=budgets,
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+                compile_mode=compile_mode,
+                draft_tokens=draft_tokens,
+                layers=self.t3.layers_for_depth(t3_depth),
+                analyze_alignment=analyze_alignment,
+            )
+        wavs = self._vocode_batch(
+            all_speech_tokens, [c.gen for c in conds], s3gen_steps=s3gen_steps, s3gen_solver=s3gen_solver
+        )
+        if not return_metadata:
+            return wavs
+        return wavs, [
+            self._segment_metadata(*args) for args in zip(all_text_tokens, budgets, all_speech_tokens)
+        ]
+
     def generate(
         self,
         text,
         chunk_size: int = 300,
         max_retries: int = 1,
+        return_metadata: bool = False,
         **kwargs,
     ):
         """Generate speech from ``text``. Long texts are processed in ``chunk_size`` character chunks.
@@ -295,6 +761,17 @@ class ChatterboxTTS:
             Size of each chunk when splitting long text. Defaults to 300.
         max_retries : int, optional
             Number of retries if a CUDA out-of-memory error occurs. Defaults to 1.
+        return_metadata : bool, optional
+            Also return the list of ``SegmentMetadata`` of the chunks, e.g. their speech token budgets.
+        **kwargs
+            Options of each segment's generation, e.g. ``audio_prompt_path``, ``exaggeration``, ``cfg_weight``,
+            ``temperature``. The voice is ``audio_prompt_path``'s if given, else ``conds``, else the prepared
+            ``self.conds``; none of them is modified, so one model can serve concurrent requests in different
+            voices (see ``request_conditionals``). ``t3_depth`` is the speed / quality knob: the fraction of
+            T3's transformer layers to run, in (0, 1], see ``generate_batch``. ``max_new_tokens`` overrides the
+            speech token budget of each chunk, which is otherwise predicted from its length by
+            ``self.length_model``. ``s3gen_steps`` and ``s3gen_solver`` set S3Gen's ODE steps and solver, see
+            ``generate_batch``.
         """
 
         def _safe_generate_segment(segment_text):
@@ -311,12 +788,15 @@ class ChatterboxTTS:
                     raise
 
         if len(text) <= chunk_size:
-            return _safe_generate_segment(text)
+            wav, metadata = _safe_generate_segment(text)
+            return (wav, [metadata]) if return_metadata else wav
 
         chunks = chunk_text(text, chunk_size)
-        audio_segments = []
+        audio_segments, all_metadata = [], []
         for chunk in chunks:
-            wav = _safe_generate_segment(chunk)
+            wav, metadata = _safe_generate_segment(chunk)
             audio_segments.append(wav.squeeze(0).cpu().numpy())
+            all_metadata.append(metadata)
         merged = splice_audios(audio_segments)
-        return torch.from_numpy(merged).unsqueeze(0)
+        wav = torch.from_numpy(merged).unsqueeze(0)
+        return (wav, all_metadata) if return_metadata else wav
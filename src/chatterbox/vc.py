@@ -36,7 +36,8 @@ class ChatterboxVC:
             }
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxVC':
+    def from_local(cls, ckpt_dir, device, dtype=torch.float32) -> 'ChatterboxVC':
+        "`dtype`: precision of the flow decoder and HiFT, see `S3Gen.cast`."
         ckpt_dir = Path(ckpt_dir)
         
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -54,12 +55,13 @@ class ChatterboxVC:
         s3gen.load_state_dict(
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
+        s3gen.cast(dtype)
         s3gen.to(device).eval()
 
         return cls(s3gen, device, ref_dict=ref_dict)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxVC':
+    def from_pretrained(cls, device, dtype=torch.float32) -> 'ChatterboxVC':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -71,24 +73,38 @@ class ChatterboxVC:
         for fpath in ["s3gen.safetensors", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, dtype=dtype)
 
     def set_target_voice(self, wav_fpath):
+        "Sets the voice of the next conversions to the one of the reference clip `wav_fpath`."
+        self.ref_dict = self.get_ref_dict(wav_fpath)
+
+    def get_ref_dict(self, wav_fpath) -> dict:
+        "The S3Gen reference embedding of a reference clip."
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
         s3gen_ref_wav = s3gen_ref_wav[:self.DEC_COND_LEN]
-        self.ref_dict = self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
+        return self.s3gen.embed_ref(s3gen_ref_wav, S3GEN_SR, device=self.device)
 
     def generate(
         self,
         audio,
         target_voice_path=None,
+        ref_dict=None,
+        s3gen_steps=10,
+        s3gen_solver=None,
     ):
+        """
+        Converts `audio` to the voice of `target_voice_path` if given, else of `ref_dict`, else of the one set with
+        `set_target_voice`. Nothing is mutated, so that one model can serve concurrent requests. `s3gen_steps` and
+        `s3gen_solver` are S3Gen's ODE steps and solver, see `S3Token2Mel.forward`.
+        """
         if target_voice_path:
-            self.set_target_voice(target_voice_path)
+            ref_dict = self.get_ref_dict(target_voice_path)
         else:
-            assert self.ref_dict is not None, "Please `prepare_conditionals` first or specify `target_voice_path`"
+            ref_dict = self.ref_dict if ref_dict is None else ref_dict
+            assert ref_dict is not None, "Please `set_target_voice` first or specify `target_voice_path` or `ref_dict`"
 
         with torch.inference_mode():
             audio_16, _ = librosa.load(audio, sr=S3_SR)
@@ -97,7 +113,9 @@ class ChatterboxVC:
             s3_tokens, _ = self.s3gen.tokenizer(audio_16)
             wav, _ = self.s3gen.inference(
                 speech_tokens=s3_tokens,
-                ref_dict=self.ref_dict,
+                ref_dict=ref_dict,
+                n_timesteps=s3gen_steps,
+                solver=s3gen_solver,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
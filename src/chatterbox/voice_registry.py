@@ -0,0 +1,175 @@
+"""
+A catalogue of enrolled voices, precomputed into one safetensors bundle, so that serving a voice by id takes no
+feature extraction.
+
+Enroll a directory of reference clips (voice id = file name without extension), adding to the bundle if it
+exists:
+
+    python -m chatterbox.voice_registry enroll clips/ voices.safetensors --device cuda
+
+then, at request time:
+
+    registry = VoiceRegistry("voices.safetensors")
+    wav = model.generate(text, conds=registry.get("alice", device=model.device))
+"""
+import argparse
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from .models.t3.modules.cond_enc import T3Cond
+from .tts import ChatterboxTTS, Conditionals
+
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".mp3", ".ogg", ".m4a"}
+
+# Every voice's tensors are concatenated along their first dimension, into one tensor per field. The fields below
+# vary in length between voices, and also get an `<name>_offsets` tensor: voice i spans `offsets[i]:offsets[i + 1]`.
+_FIXED_FIELDS = ["speaker_emb", "emotion_adv", "embedding"]  # (V, ...)
+_RAGGED_FIELDS = ["cond_prompt_speech_tokens", "prompt_token", "prompt_feat"]  # (sum of lengths, ...)
+
+
+def _fields(conds: Conditionals) -> Dict[str, torch.Tensor]:
+    "The tensors of one voice that go in a bundle, without their batch dimension, on CPU."
+    t3, gen = conds.t3, conds.gen
+    assert t3.cond_prompt_speech_tokens is not None, "voices need their prompt speech tokens"
+    fields = dict(
+        speaker_emb=t3.speaker_emb.view(-1),
+        emotion_adv=torch.as_tensor(t3.emotion_adv, dtype=torch.float32).view(1),
+        embedding=gen["embedding"].view(-1),
+        cond_prompt_speech_tokens=t3.cond_prompt_speech_tokens[0],
+        prompt_token=gen["prompt_token"][0],
+        prompt_feat=gen["prompt_feat"][0],
+    )
+    return {k: v.detach().cpu() for k, v in fields.items()}
+
+
+def save_voices(fpath, voices: Dict[str, Conditionals]):
+    "Writes `voices` (by voice id) to a bundle for `VoiceRegistry`."
+    ids = list(voices)
+    per_voice = [_fields(voices[voice_id]) for voice_id in ids]
+    tensors = {}
+    for name in _FIXED_FIELDS:
+        tensors[name] = torch.stack([fields[name] for fields in per_voice])
+    for name in _RAGGED_FIELDS:
+        parts = [fields[name] for fields in per_voice]
+        tensors[name] = torch.cat(parts)
+        tensors[f"{name}_offsets"] = torch.tensor([0] + [len(p) for p in parts]).cumsum(0)
+    # write then rename: processes serving the bundle have it memory-mapped, and keep their (old) version of it
+    fpath = Path(fpath)
+    tmp_fpath = fpath.with_name(f"{fpath.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    save_file(tensors, str(tmp_fpath), metadata={"format": "pt", "voice_ids": json.dumps(ids)})
+    os.replace(tmp_fpath, fpath)
+
+
+class VoiceRegistry:
+    """
+    Voices of a bundle written by `save_voices` (or `enroll`), by voice id.
+
+    The bundle is memory-mapped, not read: `get` returns views into the mapping, so a voice costs no disk I/O
+    beyond the pages it touches, and no copy on CPU. Thousands of voices take a few MB each of address space,
+    shared by every process that opens the bundle.
+    """
+
+    def __init__(self, fpath):
+        self.fpath = Path(fpath)
+        with safe_open(str(self.fpath), framework="pt") as f:
+            self.ids: List[str] = json.loads(f.metadata()["voice_ids"])
+            # safetensors maps the file; these are views into the mapping
+            self._tensors = {name: f.get_tensor(name) for name in f.keys()}
+        self._offsets = {name: self._tensors.pop(f"{name}_offsets").tolist() for name in _RAGGED_FIELDS}
+        self._index = {voice_id: i for i, voice_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, voice_id):
+        return voice_id in self._index
+
+    def _field(self, name, i):
+        if name in _FIXED_FIELDS:
+            return self._tensors[name][i]
+        offsets = self._offsets[name]
+        return self._tensors[name][offsets[i]:offsets[i + 1]]
+
+    def get(self, voice_id, device="cpu", exaggeration=None) -> Conditionals:
+        """
+        The `Conditionals` of a voice, on `device`, with the exaggeration it was enrolled with unless
+        `exaggeration` is given.
+        """
+        i = self._index[voice_id]
+        field = lambda name: self._field(name, i).to(device)
+        prompt_token = field("prompt_token")[None]
+        emotion_adv = field("emotion_adv") if exaggeration is None else torch.tensor([float(exaggeration)], device=device)
+        t3_cond = T3Cond(
+            speaker_emb=field("speaker_emb")[None],
+            cond_prompt_speech_tokens=field("cond_prompt_speech_tokens")[None],
+            emotion_adv=emotion_adv.view(1, 1, 1),
+        )
+        gen = dict(
+            prompt_token=prompt_token,
+            prompt_token_len=torch.tensor([prompt_token.size(1)], device=device),
+            prompt_feat=field("prompt_feat")[None],
+            prompt_feat_len=None,
+            embedding=field("embedding")[None],
+        )
+        return Conditionals(t3_cond, gen)
+
+    def all(self) -> Dict[str, Conditionals]:
+        "Every voice, on CPU."
+        return {voice_id: self.get(voice_id) for voice_id in self.ids}
+
+
+def enroll(model: ChatterboxTTS, wav_fpaths: Dict[str, Path], fpath, exaggeration=0.5, batch_size=16):
+    """
+    Computes the conditionals of reference clips (by voice id) with `ChatterboxTTS.compute_conditionals`, and
+    writes them to the bundle `fpath`, along with the voices it already has; a voice id enrolled again is replaced.
+    """
+    voices = VoiceRegistry(fpath).all() if Path(fpath).exists() else {}
+    ids = list(wav_fpaths)
+    all_conds = model.compute_conditionals(
+        [wav_fpaths[voice_id] for voice_id in ids], exaggeration=exaggeration, batch_size=batch_size
+    )
+    voices.update(zip(ids, all_conds))
+    save_voices(fpath, voices)
+    return voices
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enroll_parser = subparsers.add_parser("enroll", help="add the clips of a directory to a bundle")
+    enroll_parser.add_argument("clips", help="directory of reference clips; voice ids are their file names")
+    enroll_parser.add_argument("bundle", help="voice bundle (.safetensors), created or extended")
+    enroll_parser.add_argument("--exaggeration", type=float, default=0.5)
+    enroll_parser.add_argument("--batch-size", type=int, default=16)
+    enroll_parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+    list_parser = subparsers.add_parser("list", help="list the voice ids of a bundle")
+    list_parser.add_argument("bundle")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        print("\n".join(VoiceRegistry(args.bundle).ids))
+        return
+
+    wav_fpaths = {
+        fpath.stem: fpath
+        for fpath in sorted(Path(args.clips).iterdir())
+        if fpath.suffix.lower() in AUDIO_EXTENSIONS
+    }
+    assert wav_fpaths, f"no audio files in {args.clips}"
+    model = ChatterboxTTS.from_pretrained(args.device)
+    voices = enroll(model, wav_fpaths, args.bundle, exaggeration=args.exaggeration, batch_size=args.batch_size)
+    print(f"enrolled {len(wav_fpaths)} voices, {len(voices)} in {args.bundle}")
+
+
+if __name__ == "__main__":
+    main()
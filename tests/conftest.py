@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.tts import Conditionals
+
+
+@pytest.fixture
+def make_conds():
+    "Builds random `Conditionals` of the real models' shapes, the same for the same seed."
+    def make(seed=0):
+        g = torch.Generator().manual_seed(seed)
+        t3_cond = T3Cond(
+            speaker_emb=torch.randn(1, 256, generator=g),
+            cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 150), generator=g),
+            emotion_adv=0.5 * torch.ones(1, 1, 1),
+        )
+        gen = dict(
+            prompt_token=torch.randint(0, 6561, (1, 25), generator=g),
+            prompt_token_len=torch.tensor([25]),
+            prompt_feat=torch.randn(1, 50, 80, generator=g),
+            prompt_feat_len=None,
+            embedding=torch.randn(1, 192, generator=g),
+        )
+        return Conditionals(t3_cond, gen)
+    return make
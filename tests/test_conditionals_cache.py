@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from chatterbox.tts import ConditionalsCache
+
+
+def test_key_is_the_content_and_exaggeration(tmp_path):
+    (tmp_path / "a.wav").write_bytes(b"RIFF0")
+    (tmp_path / "b.wav").write_bytes(b"RIFF0")
+    (tmp_path / "c.wav").write_bytes(b"RIFF1")
+    key = ConditionalsCache.key
+    assert key(tmp_path / "a.wav", 0.5) == key(tmp_path / "b.wav", 0.5)
+    assert key(tmp_path / "a.wav", 0.5) != key(tmp_path / "c.wav", 0.5)
+    assert key(tmp_path / "a.wav", 0.5) != key(tmp_path / "a.wav", 0.7)
+
+
+def test_lru_eviction(make_conds):
+    cache = ConditionalsCache(max_entries=2)
+    for key in "abc":
+        cache.put(key, make_conds())
+    assert len(cache) == 2 and cache.get("a") is None and cache.get("c") is not None
+
+
+def test_entries_are_copies(make_conds):
+    cache = ConditionalsCache()
+    cache.put("a", make_conds())
+    conds = cache.get("a")
+    conds.t3 = None
+    conds.gen["embedding"] = None
+    conds = cache.get("a")
+    assert conds.t3 is not None and conds.gen["embedding"] is not None
+
+
+def test_disk_store(tmp_path, make_conds):
+    conds = make_conds()
+    ConditionalsCache(cache_dir=tmp_path).put("a", conds)
+    loaded = ConditionalsCache(cache_dir=tmp_path).get("a")  # a new process, say
+    assert torch.equal(loaded.t3.speaker_emb, conds.t3.speaker_emb)
+    assert torch.equal(loaded.gen["prompt_feat"], conds.gen["prompt_feat"])
+    assert [p.name for p in tmp_path.iterdir()] == ["a.pt"]
+
+
+def test_with_exaggeration_is_a_copy(make_conds):
+    conds = make_conds()
+    other = conds.with_exaggeration(0.9)
+    assert conds.t3.emotion_adv.item() == 0.5 and other.t3.emotion_adv.item() == pytest.approx(0.9)
+    assert other.t3.speaker_emb is conds.t3.speaker_emb and other.gen is not conds.gen
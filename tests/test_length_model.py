@@ -0,0 +1,16 @@
+from chatterbox.models.t3.inference.length_model import SpeechLengthModel
+
+
+def test_budget_grows_with_text_and_is_capped():
+    model = SpeechLengthModel(text_tokens_per_second=12.5, margin=1.5, min_tokens=40, max_tokens=500)
+    assert model.speech_tokens_per_text_token == 2.0
+    assert model.budget(0) == 40
+    assert model.budget(100) == 1.5 * 200 + 40
+    assert model.budget(1000) == 500
+
+
+def test_fit_recovers_the_speaking_rate():
+    # 2 speech tokens (80 ms) per text token
+    model = SpeechLengthModel.fit([50, 100, 150], [100, 200, 300], margin=1.0, min_tokens=0)
+    assert model.text_tokens_per_second == 12.5
+    assert model.budget(30) == 60
@@ -0,0 +1,168 @@
+import math
+
+import pytest
+import torch
+from torch import nn
+
+from chatterbox.models.s3gen import CFM_SOLVERS, S3Gen
+from chatterbox.models.s3gen.flow_matching import CausalConditionalCFM
+
+
+@pytest.fixture(scope="module")
+def s3gen():
+    torch.manual_seed(0)
+    return S3Gen().eval()
+
+
+def make_ref_dict(seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return dict(
+        prompt_token=torch.randint(0, 6561, (1, 25), generator=g),
+        prompt_token_len=torch.tensor([25]),
+        prompt_feat=torch.randn(1, 50, 80, generator=g) - 5,
+        prompt_feat_len=None,
+        embedding=torch.randn(1, 192, generator=g),
+    )
+
+
+def synthesize(s3gen, speech_tokens, ref_dict=None, seed=0):
+    torch.manual_seed(seed)  # HiFT's sine source is random
+    wav, _ = s3gen.inference(speech_tokens=speech_tokens, ref_dict=ref_dict or make_ref_dict())
+    return wav
+
+
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16])
+def test_reduced_precision_parity(s3gen, dtype):
+    speech_tokens = torch.randint(0, 6561, (1, 20), generator=torch.Generator().manual_seed(1))
+    reference = synthesize(s3gen, speech_tokens)
+    try:
+        s3gen.cast(dtype)
+        assert s3gen.mel2wav.f0_predictor.classifier.weight.dtype == torch.float32
+        wav = synthesize(s3gen, speech_tokens)
+    finally:
+        s3gen.cast(torch.float32)
+    assert wav.dtype == torch.float32 and wav.shape == reference.shape
+    assert (wav - reference).norm() / reference.norm() < 0.05
+    assert (wav - reference).abs().max() < 0.02
+
+
+def test_ref_dict_is_left_as_is(s3gen):
+    ref_dict = make_ref_dict()
+    ref_dict["embedding"] = ref_dict["embedding"].numpy()
+    values = dict(ref_dict)
+    s3gen.flow_inference(torch.randint(0, 6561, (1, 10)), ref_dict=ref_dict)
+    assert all(ref_dict[k] is v for k, v in values.items())
+
+
+class GaussianVelocity(nn.Module):
+    "The exact flow towards N(mu, scale**2), elementwise, as an estimator."
+
+    def __init__(self, sigma_min, scale=0.5):
+        super().__init__()
+        self.a = 1 - sigma_min
+        self.scale = scale
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        t = t[:, None, None]
+        var = (t * self.scale) ** 2 + (1 - self.a * t) ** 2
+        dvar = t * self.scale ** 2 - self.a * (1 - self.a * t)
+        return mu + dvar / var * (x - t * mu)
+
+
+def test_solvers_converge():
+    cfm = CausalConditionalCFM()
+    cfm.estimator = GaussianVelocity(cfm.sigma_min)
+    cfm.inference_cfg_rate = 0.0
+    n_frames = 40
+    mu = torch.randn(1, 80, n_frames, generator=torch.Generator().manual_seed(0))
+    inputs = dict(mask=torch.ones(1, 1, n_frames), spks=torch.zeros(1, 80), cond=torch.zeros(1, 80, n_frames))
+    exact = mu + math.sqrt(0.5 ** 2 + cfm.sigma_min ** 2) * cfm.rand_noise[:, :, :n_frames]
+
+    def error(n_timesteps, solver):
+        out, _ = cfm(mu, n_timesteps=n_timesteps, solver=solver, **inputs)
+        return ((out - exact).norm() / exact.norm()).item()
+
+    euler_error = error(10, "euler")
+    for solver in CFM_SOLVERS:
+        # halving the step size divides the error by about 2 (Euler) or 4 (second order)
+        assert error(40, solver) < error(20, solver) / (1.8 if solver == "euler" else 3)
+        if solver != "euler":
+            # 5 steps of a second order solver beat 10 Euler steps
+            assert error(5, solver) < euler_error
+
+
+@pytest.mark.parametrize("solver", list(CFM_SOLVERS))
+def test_solver_options(s3gen, solver, monkeypatch):
+    estimator, n_calls = s3gen.flow.decoder.estimator, []
+    forward = estimator.forward
+    monkeypatch.setattr(estimator, "forward", lambda *args, **kwargs: n_calls.append(1) or forward(*args, **kwargs))
+    speech_tokens = torch.randint(0, 6561, (1, 10))
+    mels = s3gen.flow_inference(speech_tokens, ref_dict=make_ref_dict(), finalize=True, n_timesteps=4, solver=solver)
+    assert len(n_calls) == 4 * CFM_SOLVERS[solver]
+    assert mels.shape == (1, 80, 20) and mels.isfinite().all()
+
+
+def test_decoder_context(s3gen):
+    decoder = s3gen.flow.decoder.estimator
+    g = torch.Generator().manual_seed(0)
+    n_frames = 30
+    mask = torch.ones(2, 1, n_frames)
+    mask[1, :, 20:] = 0
+    x, mu, cond = (torch.randn(2, 80, n_frames, generator=g) for _ in range(3))
+    spks, t = torch.randn(2, 80, generator=g), torch.rand(2, generator=g)
+    context = decoder.prepare(mask, mu, spks, cond)
+    with torch.inference_mode():
+        out = decoder(x, mask, mu, t, spks, cond)
+        out_with_context = decoder(x, mask, mu, t, spks, cond, context=context)
+    assert torch.equal(out, out_with_context)
+
+
+def test_batch_matches_single(s3gen):
+    ref_dicts = [make_ref_dict(0), make_ref_dict(1)]
+    # a shorter prompt, with an odd number of mel frames
+    ref_dicts[1].update(
+        prompt_token=ref_dicts[1]["prompt_token"][:, :20],
+        prompt_token_len=torch.tensor([20]),
+        prompt_feat=ref_dicts[1]["prompt_feat"][:, :41],
+    )
+    g = torch.Generator().manual_seed(1)
+    all_speech_tokens = [torch.randint(0, 6561, (n,), generator=g) for n in (30, 17)]
+
+    mels, mel_lens = s3gen.forward_batch(all_speech_tokens, ref_dicts)
+    wavs = s3gen.inference_batch(all_speech_tokens, ref_dicts)
+    for speech_tokens, ref_dict, mel, mel_len, wav in zip(all_speech_tokens, ref_dicts, mels, mel_lens, wavs):
+        reference = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True)[0]
+        assert mel_len == reference.size(1)
+        assert torch.allclose(mel[:, :mel_len], reference, atol=1e-4)
+        assert wav.shape == synthesize(s3gen, speech_tokens[None], ref_dict).shape
+
+
+def test_stream(s3gen):
+    speech_tokens = torch.randint(0, 6561, (30,), generator=torch.Generator().manual_seed(1))
+    stream = s3gen.stream(make_ref_dict(), context_tokens=5)
+    # the mels of the last `pre_lookahead_len` tokens are not final yet
+    assert stream.push(speech_tokens[:3]).shape == (1, 0)
+    blocks = [stream.push(speech_tokens[3:12]), stream.push(speech_tokens[12:])]
+    blocks.append(stream.flush())
+    assert all(block.size(1) > 0 for block in blocks)
+    wav = torch.cat(blocks, dim=1)
+    assert wav.shape == synthesize(s3gen, speech_tokens[None]).shape and wav.isfinite().all()
+    with pytest.raises(AssertionError):
+        stream.push(speech_tokens)
+
+
+def test_stream_approximates_offline(s3gen):
+    speech_tokens = torch.randint(0, 6561, (30,), generator=torch.Generator().manual_seed(1))
+    ref_dict = make_ref_dict()
+    offline = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True)
+    stream, blocks = s3gen.stream(ref_dict, context_tokens=5), []
+    final_mels = stream._final_mels
+    stream._final_mels = lambda finalize: blocks.append(final_mels(finalize)) or blocks[-1]
+    for start in range(0, 30, 10):
+        stream.push(speech_tokens[start:start + 10])
+    stream.flush()
+    streamed = torch.cat(blocks, dim=2)
+    assert streamed.shape == offline.shape
+    # the windows carry the noise of their frames (about 1.0 without it); the rest is the lookahead and the
+    # context the windows don't see
+    assert (streamed - offline).norm() / offline.norm() < 0.35
@@ -0,0 +1,502 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+from transformers import DynamicCache
+
+from chatterbox.models.t3 import T3
+from chatterbox.models.t3.inference.alignment_stream_analyzer import AlignmentStreamAnalyzer
+from chatterbox.models.t3.inference.attention_spy import AttentionSpy
+from chatterbox.models.t3.inference.prefix_cache import PrefixKVCache
+from chatterbox.models.t3.inference.scheduler import T3BatchScheduler
+from chatterbox.models.t3.inference.speculative import NGramDraft
+from chatterbox.models.t3.quantization import (
+    QuantizedLinear,
+    compare_t3,
+    load_quantized_t3,
+    quantize_t3,
+    save_quantized_t3,
+    set_activation_quantization,
+)
+from chatterbox.models.t3.llama_configs import LLAMA_CONFIGS, LLAMA_520M_CONFIG_DICT
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+from chatterbox.models.t3.modules.t3_config import T3Config
+
+
+LLAMA_CONFIGS["Llama_test"] = dict(
+    LLAMA_520M_CONFIG_DICT,
+    hidden_size=64,
+    intermediate_size=128,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=4,
+    head_dim=16,
+)
+
+
+class TinyT3Config(T3Config):
+    llama_config_name = "Llama_test"
+    use_perceiver_resampler = False
+    alignment_layer_idx = 1
+
+
+@pytest.fixture(scope="module")
+def t3():
+    torch.manual_seed(0)
+    return T3(TinyT3Config()).eval()
+
+
+def make_cond(hp, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return T3Cond(
+        speaker_emb=torch.randn(1, hp.speaker_embed_size, generator=g),
+        cond_prompt_speech_tokens=torch.randint(0, 6561, (1, 10), generator=g),
+        emotion_adv=0.5 * torch.ones(1, 1, 1),
+    )
+
+
+def make_text(hp, n=12, seed=0, cfg=False):
+    g = torch.Generator().manual_seed(seed)
+    text = torch.randint(1, hp.start_text_token, (1, n), generator=g)
+    text = torch.cat([torch.tensor([[hp.start_text_token]]), text, torch.tensor([[hp.stop_text_token]])], dim=1)
+    return torch.cat([text, text]) if cfg else text
+
+
+def run(t3, seed=0, **kwargs):
+    torch.manual_seed(seed)
+    return t3.inference(**kwargs)
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_static_cache_matches_dynamic(t3, cfg_weight):
+    kwargs = dict(
+        text_tokens=make_text(t3.hp, cfg=cfg_weight > 0),
+        max_new_tokens=20,
+        cfg_weight=cfg_weight,
+    )
+    static = run(t3, t3_cond=make_cond(t3.hp), cache_implementation="static", **kwargs)
+    dynamic = run(t3, t3_cond=make_cond(t3.hp), cache_implementation="dynamic", **kwargs)
+    assert static.shape[1] > 0
+    assert torch.equal(static, dynamic)
+
+
+def test_attention_spy_is_opt_in_per_layer(t3):
+    kwargs = dict(
+        t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp), max_new_tokens=5, cache_implementation="dynamic"
+    )
+    steps = []
+    with AttentionSpy(t3.tfmr, [1], callback=lambda idx, attn: steps.append((idx, attn))):
+        spied = run(t3, **kwargs)
+    plain = run(t3, **kwargs)
+
+    assert torch.equal(spied, plain)
+    assert {idx for idx, _ in steps} == {1}
+    assert len(steps) >= spied.size(1)  # prefill + one per step
+    prefill = steps[0][1]
+    assert prefill.shape[-1] == prefill.shape[-2]
+    assert torch.all(prefill.triu(1) == 0)  # causal even though SDPA ran without a mask
+    assert "forward" not in vars(t3.tfmr.layers[1].self_attn)
+
+
+def force_eos_after(t3, n_tokens):
+    """
+    Makes every row of a (greedy) batch emit EOS after its own number of tokens, by looking up the per-row
+    number of tokens in a forward hook on the speech head.
+    """
+    stop = t3.hp.stop_speech_token
+    step = {"i": -1}
+
+    def hook(module, input, logits):
+        step["i"] += 1
+        for row, n in enumerate(n_tokens):
+            if step["i"] >= n:
+                logits[row % len(n_tokens), -1, stop] = 1e4
+        return logits
+
+    return t3.speech_head.register_forward_hook(hook)
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+@pytest.mark.parametrize("cache_implementation", ["static", "dynamic"])
+def test_inference_batch_matches_sequential(t3, cfg_weight, cache_implementation):
+    conds = [make_cond(t3.hp, seed=s) for s in range(3)]
+    texts = [make_text(t3.hp, n=n, seed=s) for s, n in enumerate([12, 5, 20])]
+    kwargs = dict(max_new_tokens=15, top_p=0.0, cfg_weight=cfg_weight, cache_implementation=cache_implementation)
+    n_tokens = [7, 15, 3]
+
+    sequential = []
+    for cond, text, n in zip(conds, texts, n_tokens):
+        handle = force_eos_after(t3, [n])
+        sequential.append(run(t3, t3_cond=cond, text_tokens=text, **kwargs))
+        handle.remove()
+
+    handle = force_eos_after(t3, n_tokens)
+    batched = t3.inference_batch(t3_conds=conds, text_tokens=texts, **kwargs)
+    handle.remove()
+
+    assert [b.size(1) for b in batched] == [8, 15, 4]
+    for b, s in zip(batched, sequential):
+        assert torch.equal(b, s)
+
+
+def test_scheduler_matches_sequential(t3):
+    stop = t3.hp.stop_speech_token
+
+    def eos_hook(module, input, logits):
+        # stop on a row-local condition, so each request ends the same way in or out of the batch
+        last = logits[:, -1]
+        last[last.argmax(dim=-1) % 11 == 0, stop] = 1e4
+        return logits
+
+    handle = t3.speech_head.register_forward_hook(eos_hook)
+    try:
+        requests = [(make_cond(t3.hp, seed=s), make_text(t3.hp, n=n, seed=s)) for s, n in enumerate([12, 5, 20, 7, 9])]
+        budgets = [30, 8, 15, 30, 4]
+        for cfg_weight in [0.0, 0.5]:
+            kwargs = dict(top_p=0.0, cfg_weight=cfg_weight)
+            sequential = [
+                run(t3, t3_cond=cond, text_tokens=text, max_new_tokens=budget, **kwargs)
+                for (cond, text), budget in zip(requests, budgets)
+            ]
+            # 4 rows: CFG requests have to wait for earlier ones to leave the batch
+            with T3BatchScheduler(t3, max_rows=4, max_len=128) as scheduler:
+                futures = [
+                    scheduler.submit(cond, text, max_new_tokens=budget, **kwargs)
+                    for (cond, text), budget in zip(requests, budgets)
+                ]
+                scheduled = [f.result(timeout=60) for f in futures]
+
+            assert [s.size(1) for s in scheduled] == [23, 8, 15, 23, 4]
+            for a, b in zip(scheduled, sequential):
+                assert torch.equal(a, b)
+    finally:
+        handle.remove()
+
+
+def test_scheduler_rejects_requests_that_never_fit(t3):
+    with T3BatchScheduler(t3, max_rows=1, max_len=128) as scheduler:
+        cfg = scheduler.submit(make_cond(t3.hp), make_text(t3.hp), max_new_tokens=4, cfg_weight=0.5)
+        plain = scheduler.submit(make_cond(t3.hp), make_text(t3.hp), max_new_tokens=4)
+        with pytest.raises(ValueError):
+            cfg.result(timeout=10)
+        assert plain.result(timeout=60).size(1) <= 4
+
+
+def test_compiled_decode_step_is_reused(t3):
+    kwargs = dict(
+        t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp, cfg=True), max_new_tokens=10, top_p=0.0, cfg_weight=0.5
+    )
+    eager = run(t3, **kwargs)
+    compiled = run(t3, compile_mode="default", **kwargs)
+    step = t3._compiled_steps[(1, True, "default", None)]
+    assert torch.equal(compiled, eager)
+
+    # same shapes: the compiled step and its cache are reused
+    assert torch.equal(run(t3, compile_mode="default", **kwargs), eager)
+    assert t3._compiled_steps[(1, True, "default", None)] is step
+
+
+def test_compiled_steps_are_bounded(t3, monkeypatch):
+    monkeypatch.setattr(torch, "compile", lambda fn, **kwargs: fn)
+    monkeypatch.setattr(t3, "max_compiled_steps", 2)
+    monkeypatch.setattr(t3, "_compiled_steps", type(t3._compiled_steps)())
+    steps = {N: t3._get_compiled_step(N, False, 64, "default") for N in (1, 2)}
+    assert t3._get_compiled_step(1, False, 64, "default") is steps[1]  # now the most recently used
+    t3._get_compiled_step(3, False, 64, "default")
+    assert [key[0] for key in t3._compiled_steps] == [1, 3]
+
+
+def test_backend_is_built_once(t3):
+    keys = set(t3.state_dict())
+    backend = t3.patched_model
+    run(t3, t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp), max_new_tokens=3)
+    assert t3.patched_model is backend
+    assert set(t3.state_dict()) == keys
+
+
+def test_no_decode_step_after_the_budget(t3, monkeypatch):
+    steps = []
+    decode_step = t3._decode_step
+    monkeypatch.setattr(t3, "_decode_step", lambda *args, **kwargs: steps.append(1) or decode_step(*args, **kwargs))
+    tokens = run(t3, t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp), max_new_tokens=5, top_p=0.0)
+    assert len(steps) == tokens.size(1) - 1 == 4  # the prefill gives the logits of the first token
+
+
+def test_lazy_eos_check_trims_overshoot(t3):
+    conds = [make_cond(t3.hp, seed=s) for s in range(2)]
+    texts = [make_text(t3.hp, n=n, seed=s) for s, n in enumerate([12, 5])]
+    kwargs = dict(t3_conds=conds, text_tokens=texts, max_new_tokens=30, top_p=0.0)
+
+    handle = force_eos_after(t3, [3, 6])
+    eager = t3.inference_batch(**kwargs)
+    handle.remove()
+
+    steps = []
+    handle = force_eos_after(t3, [3, 6])
+    lazy = t3.inference_batch(eos_check_interval=5, progress_callback=steps.append, **kwargs)
+    handle.remove()
+
+    assert [t.size(1) for t in lazy] == [4, 7]
+    for a, b in zip(lazy, eager):
+        assert torch.equal(a, b)
+    assert steps == list(range(1, 11))  # ran on until the check at step 10
+
+
+@pytest.mark.parametrize("draft_tokens", [0, 3])
+def test_token_callback_streams_the_output(t3, draft_tokens):
+    conds = [make_cond(t3.hp, seed=s) for s in range(2)]
+    texts = [make_text(t3.hp, n=n, seed=s) for s, n in enumerate([12, 5])]
+    streamed = []
+    handle = force_eos_after(t3, [3, 6])
+    out = t3.inference_batch(
+        t3_conds=conds,
+        text_tokens=texts,
+        max_new_tokens=30,
+        draft_tokens=draft_tokens,
+        token_callback=streamed.append,
+    )
+    handle.remove()
+    streamed = torch.cat(streamed, dim=1)
+    for row, tokens in zip(streamed, out):
+        assert torch.equal(row[:tokens.size(1)], tokens[0])
+        assert (row[tokens.size(1):] == t3.hp.stop_speech_token).all()
+
+
+def test_cfg_rows_share_the_conditioning_prefix(t3):
+    embeds, len_cond = t3.prepare_inference_embeds(
+        t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp), cfg_weight=0.5
+    )
+    full = t3.prefill(embeds, DynamicCache())
+    shared = t3.prefill(embeds, DynamicCache(), shared_prefix_len=len_cond)
+    assert torch.allclose(shared.logits[:, -1], full.logits[:, -1], atol=1e-5)
+    for k_full, k_shared in zip(full.past_key_values.key_cache, shared.past_key_values.key_cache):
+        assert torch.allclose(k_shared, k_full, atol=1e-5)
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_prefix_cache_matches_uncached(t3, monkeypatch, cfg_weight):
+    short_cond = make_cond(t3.hp, seed=1)
+    short_cond.cond_prompt_speech_tokens = short_cond.cond_prompt_speech_tokens[:, :6]
+    kwargs = dict(
+        t3_conds=[make_cond(t3.hp), short_cond],
+        text_tokens=[make_text(t3.hp, n=12), make_text(t3.hp, n=7, seed=1)],
+        max_new_tokens=15,
+        cfg_weight=cfg_weight,
+    )
+    torch.manual_seed(0)
+    expected = t3.inference_batch(**kwargs)
+
+    monkeypatch.setattr(t3, "prefix_cache", PrefixKVCache())
+    prefix_kv = t3._prefix_kv
+    n_computed = []
+    monkeypatch.setattr(t3, "_prefix_kv", lambda *args, **kw: n_computed.append(1) or prefix_kv(*args, **kw))
+    for _ in range(2):
+        torch.manual_seed(0)
+        cached = t3.inference_batch(**kwargs)
+        assert all(torch.equal(c, e) for c, e in zip(cached, expected))
+    assert len(n_computed) == len(t3.prefix_cache) == 2  # computed on the first call only
+
+
+def test_ngram_draft_proposes_the_latest_continuation():
+    draft = NGramDraft(max_ngram=2)
+    assert draft.propose(3) == []
+    for token in [1, 2, 3, 1, 2, 4, 1]:
+        draft.append(token)
+    assert draft.propose(3) == [2, 4, 1]  # after the latest "1"
+    draft.append(2)
+    assert draft.propose(3) == [4, 1, 2]  # after the latest "1 2"
+    draft.append(5)
+    assert draft.propose(3) == []
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+@pytest.mark.parametrize("cache_implementation", ["static", "dynamic"])
+def test_speculative_decoding_matches_plain(t3, cfg_weight, cache_implementation):
+    fed = []
+
+    def cycle_hook(module, input, logits):
+        # make the next token follow from the last fed one, so the utterance cycles and drafts get accepted
+        tokens = fed[-1]
+        n = min(tokens.size(1), logits.size(1))
+        next_token = (tokens[:, -n:] * 3 + 1) % 5 + 100
+        next_token = next_token.repeat(logits.size(0) // next_token.size(0), 1)
+        logits[:, -n:].scatter_add_(2, next_token[..., None], torch.full_like(logits[:, -n:, :1], 10.0))
+        return logits
+
+    handles = [
+        t3.speech_emb.register_forward_hook(lambda module, input, output: fed.append(input[0])),
+        t3.speech_head.register_forward_hook(cycle_hook),
+    ]
+    verify_calls = []
+    try:
+        kwargs = dict(
+            t3_conds=[make_cond(t3.hp), make_cond(t3.hp, seed=1)],
+            text_tokens=[make_text(t3.hp, n=12), make_text(t3.hp, n=5, seed=1)],
+            max_new_tokens=40,
+            cfg_weight=cfg_weight,
+            cache_implementation=cache_implementation,
+        )
+        torch.manual_seed(0)
+        plain = t3.inference_batch(**kwargs)
+
+        verify_step = t3._verify_step
+        t3._verify_step = lambda *args, **step: verify_calls.append(1) or verify_step(*args, **step)
+        torch.manual_seed(0)
+        speculative = t3.inference_batch(draft_tokens=4, **kwargs)
+    finally:
+        t3.__dict__.pop("_verify_step", None)
+        for handle in handles:
+            handle.remove()
+
+    assert all(torch.equal(a, b) for a, b in zip(speculative, plain))
+    assert len(verify_calls) < 40 / 2
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+def test_layer_subset_matches_a_model_without_the_others(t3, cfg_weight):
+    reference = T3(t3.hp).eval()
+    reference.load_state_dict(t3.state_dict())
+    reference.tfmr.layers = reference.tfmr.layers[1:]
+    kwargs = dict(t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp), max_new_tokens=20, cfg_weight=cfg_weight)
+
+    state_keys = t3.state_dict().keys()
+    assert t3.layers_for_depth(0.5) == [0] and t3.layers_for_depth(1.0) is None
+    subset = run(t3, layers=[1], **kwargs)
+    assert torch.equal(subset, run(reference, **kwargs))
+    assert t3.state_dict().keys() == state_keys
+    assert t3.backend([0, 1]) is t3.backend(None) is t3.patched_model
+
+
+def test_alignment_analyzer_rows_are_independent(t3):
+    eos = t3.hp.stop_speech_token
+    text_lens, text_end, n_steps = [8, 5], 20, 40
+
+    def attention(row_lens, frame, n_queries):
+        # frame f attends text position f // 2 until the end of its text, then stays on its last token
+        attn = torch.zeros(len(row_lens), n_queries, text_end + 1 + frame)
+        for row, text_len in enumerate(row_lens):
+            attn[row, -1, text_end - text_len + min(frame // 2, text_len - 1)] = 1.0
+        return attn
+
+    def run_analyzer(row_lens):
+        analyzer = AlignmentStreamAnalyzer(
+            t3.tfmr, row_lens, text_end, text_end + 1, n_steps, alignment_layer_idx=1, eos_idx=eos
+        )
+        outputs = []
+        try:
+            for frame in range(n_steps):
+                analyzer.last_aligned_attn = attention(row_lens, frame, n_queries=text_end + 1 if frame == 0 else 1)
+                outputs.append(analyzer.step(torch.zeros(len(row_lens), t3.hp.speech_tokens_dict_size)))
+        finally:
+            analyzer.close()
+        return torch.stack(outputs, dim=1)  # (N, steps, vocab)
+
+    batched = run_analyzer(text_lens)
+    for row, text_len in enumerate(text_lens):
+        assert torch.equal(batched[row], run_analyzer([text_len])[0])
+        eos_logits = batched[row, :, eos]
+        assert (eos_logits[:2] < 0).all()  # suppressed before the end of the text
+        forced = (eos_logits > 0).nonzero()
+        assert len(forced) > 0 and forced[0].item() < n_steps - 10  # the long tail is cut
+    assert "forward" not in t3.tfmr.layers[1].self_attn.__dict__  # the spy is detached
+
+
+@pytest.mark.parametrize("cfg_weight", [0.0, 0.5])
+@pytest.mark.parametrize("cache_implementation", ["static", "dynamic"])
+def test_alignment_analysis_in_batch_decoding(t3, cfg_weight, cache_implementation):
+    tokens = t3.inference_batch(
+        t3_conds=[make_cond(t3.hp), make_cond(t3.hp, seed=1)],
+        text_tokens=[make_text(t3.hp, n=12), make_text(t3.hp, n=5, seed=1)],
+        max_new_tokens=15,
+        cfg_weight=cfg_weight,
+        cache_implementation=cache_implementation,
+        analyze_alignment=True,
+    )
+    assert [t.size(1) for t in tokens] == [15, 15]
+    assert "forward" not in t3.tfmr.layers[1].self_attn.__dict__
+
+
+def test_concurrent_alignment_analysis(t3):
+    kwargs = [
+        dict(t3_cond=make_cond(t3.hp, seed=s), text_tokens=make_text(t3.hp, n=n, seed=s), max_new_tokens=15, top_p=0.0)
+        for s, n in enumerate([12, 5, 8])
+    ]
+    alone = [t3.inference(analyze_alignment=True, **kw) for kw in kwargs]
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        concurrent = list(pool.map(lambda kw: t3.inference(analyze_alignment=True, **kw), kwargs))
+    for a, b in zip(concurrent, alone):
+        assert torch.equal(a, b)
+    assert "forward" not in t3.tfmr.layers[1].self_attn.__dict__
+
+
+@pytest.mark.parametrize("draft_tokens", [0, 3])
+def test_per_utterance_budgets(t3, draft_tokens):
+    kwargs = dict(
+        t3_conds=[make_cond(t3.hp), make_cond(t3.hp, seed=1), make_cond(t3.hp, seed=2)],
+        text_tokens=[make_text(t3.hp, n=12), make_text(t3.hp, n=5, seed=1), make_text(t3.hp, n=8, seed=2)],
+        draft_tokens=draft_tokens,
+    )
+    torch.manual_seed(0)
+    shared = t3.inference_batch(max_new_tokens=20, **kwargs)
+    torch.manual_seed(0)
+    budgeted = t3.inference_batch(max_new_tokens=[20, 6, 11], **kwargs)
+    assert [t.size(1) for t in budgeted] == [20, 6, 11]
+    assert all(torch.equal(b, s[:, :b.size(1)]) for b, s in zip(budgeted, shared))
+
+
+@pytest.mark.parametrize("bits,group_size", [(8, None), (4, None), (4, 16)])
+def test_quantized_linear(bits, group_size):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(64, 32, bias=True)
+    quantized = QuantizedLinear.from_linear(linear, bits=bits, group_size=group_size)
+    weight = quantized.dequantize()
+    qmax = 2 ** (bits - 1) - 1
+    assert quantized.int_weight().abs().max() <= qmax
+    step = quantized.scale.repeat_interleave(group_size or 64, dim=1)
+    assert ((weight - linear.weight).abs() <= step / 2 + 1e-6).all()
+
+    x = torch.randn(3, 5, 64)
+    expected = torch.nn.functional.linear(x, weight, linear.bias)
+    assert torch.allclose(quantized(x), expected, atol=1e-5)
+    # per-channel int8 can opt into fbgemm on CPU, which also quantizes the activations
+    quantized.quantize_activations = True
+    assert torch.allclose(quantized(x), expected, atol=0.05 if bits == 8 and group_size is None else 1e-5)
+
+
+@pytest.mark.parametrize("bits", [8, 4])
+def test_quantized_t3(t3, tmp_path, bits):
+    quantized = T3(t3.hp).eval()
+    quantized.load_state_dict(t3.state_dict())
+    quantize_t3(quantized, bits=bits)
+    assert isinstance(quantized.speech_head, QuantizedLinear)
+    assert isinstance(quantized.tfmr.layers[0].mlp.down_proj, QuantizedLinear)
+
+    # weight-only, and with the activations quantized too (int8 on CPU)
+    for quantize_activations in [False, True]:
+        set_activation_quantization(quantized, quantize_activations)
+        stats = compare_t3(t3, quantized, make_cond(t3.hp), make_text(t3.hp), max_new_tokens=20)
+        # a random model's distributions are nearly flat, so its top-1 token is brittle
+        assert stats["top1_agreement"] > 0.5 and stats["mean_kl"] < 0.01
+    set_activation_quantization(quantized, False)
+
+    save_quantized_t3(quantized, tmp_path / "t3.safetensors")
+    loaded = load_quantized_t3(tmp_path / "t3.safetensors", hp=t3.hp).eval()
+    kwargs = dict(t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp, cfg=True), max_new_tokens=10)
+    assert torch.equal(run(loaded, **kwargs), run(quantized, **kwargs))
+
+
+def test_bfloat16_t3_matches_fp32(t3):
+    bf16 = T3(t3.hp).eval()
+    bf16.load_state_dict(t3.state_dict())
+    bf16.to(torch.bfloat16)
+    stats = compare_t3(t3, bf16, make_cond(t3.hp), make_text(t3.hp), max_new_tokens=20)
+    assert stats["mean_kl"] < 0.01
+    tokens = run(bf16, t3_cond=make_cond(t3.hp), text_tokens=make_text(t3.hp, cfg=True), max_new_tokens=10)
+    assert tokens.shape == (1, 10)
+
+
+def test_prepare_conditioning_leaves_the_conditionals_as_is(t3):
+    t3_cond = make_cond(t3.hp)
+    with torch.inference_mode():
+        t3.prepare_conditioning(t3_cond)
+    assert t3_cond.cond_prompt_speech_emb is None
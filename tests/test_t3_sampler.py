@@ -0,0 +1,87 @@
+import pytest
+import torch
+from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+
+from chatterbox.models.t3.inference.sampler import (
+    TokenHistory,
+    apply_cfg,
+    apply_min_p,
+    apply_repetition_penalty,
+    apply_top_p,
+    sample_tokens,
+    update_token_counts,
+)
+
+
+V = 8194
+
+
+def make_logits(B=4, seed=0, scale=3.0):
+    g = torch.Generator().manual_seed(seed)
+    return scale * torch.randn(B, V, generator=g)
+
+
+def test_repetition_penalty_matches_hf():
+    logits = make_logits()
+    history = torch.randint(0, V, (4, 50), generator=torch.Generator().manual_seed(1))
+    counts = update_token_counts(torch.zeros(4, V, dtype=torch.int32), history)
+    expected = RepetitionPenaltyLogitsProcessor(penalty=1.2)(history, logits.clone())
+    assert torch.allclose(apply_repetition_penalty(logits, counts, 1.2), expected)
+
+
+@pytest.mark.parametrize("min_p", [0.0, 0.05, 0.5])
+def test_min_p_matches_hf(min_p):
+    logits = make_logits()
+    expected = MinPLogitsWarper(min_p=min_p)(None, logits.clone()) if min_p > 0 else logits
+    assert torch.equal(apply_min_p(logits, min_p).isinf(), expected.isinf())
+
+
+@pytest.mark.parametrize("top_p", [0.0, 0.3, 0.8, 0.95, 0.99])
+@pytest.mark.parametrize("scale", [0.5, 3.0, 8.0])
+def test_top_p_matches_hf(top_p, scale):
+    for seed in range(5):
+        logits = apply_min_p(make_logits(seed=seed, scale=scale), 0.01 * seed)
+        expected = TopPLogitsWarper(top_p=top_p)(None, logits.clone())
+        assert torch.equal(apply_top_p(logits, top_p).isinf(), expected.isinf())
+
+
+def test_per_row_params_match_shared():
+    logits = make_logits()
+    counts = torch.zeros(4, V, dtype=torch.int32)
+    kwargs = dict(temperature=0.7, repetition_penalty=1.3, min_p=0.1, top_p=0.0)
+    shared = sample_tokens(logits, counts, **kwargs)
+    per_row = sample_tokens(logits, counts, **{k: torch.full((4,), v) for k, v in kwargs.items()})
+    assert torch.equal(shared, per_row)
+    assert torch.equal(shared[:, 0], logits.argmax(dim=-1))  # top_p=0 keeps only the most likely token
+
+
+def test_samples_follow_the_distribution():
+    logits = torch.log(torch.tensor([[0.5, 0.3, 0.2, 0.0]])).expand(20000, -1)
+    counts = torch.zeros_like(logits, dtype=torch.int32)
+    tokens = sample_tokens(
+        logits, counts, temperature=1.0, repetition_penalty=1.0, min_p=0.0, top_p=1.0,
+        generator=torch.Generator().manual_seed(0),
+    )
+    freqs = torch.bincount(tokens[:, 0], minlength=4) / tokens.size(0)
+    assert torch.allclose(freqs, torch.tensor([0.5, 0.3, 0.2, 0.0]), atol=0.02)
+
+
+def test_cfg_mix():
+    logits = make_logits(B=4)
+    mixed = apply_cfg(logits, torch.tensor([0.5, 0.0]), 2)
+    assert torch.allclose(mixed[0], logits[0] + 0.5 * (logits[0] - logits[2]))
+    assert torch.equal(mixed[1], logits[1])
+    assert apply_cfg(logits, 0.5, 4) is logits
+
+
+def test_token_history():
+    history = TokenHistory(2, capacity=10, vocab_size=V, device="cpu", initial_token=6561)
+    steps = torch.randint(0, 100, (6, 2, 1), generator=torch.Generator().manual_seed(0))
+    for tokens in steps:
+        history.append(tokens)
+
+    expected = torch.cat(list(steps), dim=1)
+    assert torch.equal(history.tokens, expected)
+    counts = update_token_counts(torch.zeros(2, V, dtype=torch.int32), expected)
+    counts[:, 6561] += 1
+    assert torch.equal(history.counts, counts)
@@ -0,0 +1,43 @@
+import torch
+
+from chatterbox.voice_registry import VoiceRegistry, save_voices
+
+
+def test_round_trip(tmp_path, make_conds):
+    voices = {"alice": make_conds(0), "bob": make_conds(1)}
+    voices["bob"].gen["prompt_feat"] = voices["bob"].gen["prompt_feat"][:, :30]  # ragged lengths
+    save_voices(tmp_path / "voices.safetensors", voices)
+
+    registry = VoiceRegistry(tmp_path / "voices.safetensors")
+    assert registry.ids == ["alice", "bob"] and "bob" in registry and "carol" not in registry
+    for voice_id, conds in voices.items():
+        loaded = registry.get(voice_id)
+        assert torch.equal(loaded.t3.speaker_emb, conds.t3.speaker_emb)
+        assert torch.equal(loaded.t3.cond_prompt_speech_tokens, conds.t3.cond_prompt_speech_tokens)
+        assert torch.equal(loaded.t3.emotion_adv, conds.t3.emotion_adv)
+        for key in ["prompt_token", "prompt_token_len", "prompt_feat", "embedding"]:
+            assert torch.equal(loaded.gen[key], conds.gen[key]), key
+
+    assert registry.get("alice", exaggeration=0.8).t3.emotion_adv.item() == torch.tensor(0.8).item()
+
+
+def test_voices_are_views(tmp_path, make_conds):
+    save_voices(tmp_path / "voices.safetensors", {"alice": make_conds(0), "bob": make_conds(1)})
+    registry = VoiceRegistry(tmp_path / "voices.safetensors")
+    alice, bob = registry.get("alice"), registry.get("bob")
+    # both voices point into the same storage: the mapped file
+    storage = lambda t: t.untyped_storage().data_ptr()
+    assert storage(alice.gen["prompt_feat"]) == storage(bob.gen["prompt_feat"])
+    assert bob.gen["prompt_feat"].data_ptr() == alice.gen["prompt_feat"].data_ptr() + 50 * 80 * 4
+
+
+def test_rewriting_a_served_bundle(tmp_path, make_conds):
+    fpath = tmp_path / "voices.safetensors"
+    save_voices(fpath, {"alice": make_conds(0)})
+    serving = VoiceRegistry(fpath)
+    alice = serving.get("alice")
+    save_voices(fpath, {**serving.all(), "bob": make_conds(1)})
+    # the bundle is replaced, not rewritten: the mapping of the serving registry stays intact
+    assert torch.equal(serving.get("alice").gen["prompt_feat"], alice.gen["prompt_feat"])
+    assert VoiceRegistry(fpath).ids == ["alice", "bob"]
+    assert [p.name for p in tmp_path.iterdir()] == ["voices.safetensors"]